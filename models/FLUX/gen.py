@@ -1,4 +1,3 @@
-import os
 import torch
 
 from optimum.quanto import freeze, qfloat8, quantize
@@ -47,7 +46,6 @@ class FLUXD:
 
     def generate(self, input_text, img_num, save_dir):
         # avoid out of memory, b=1
-        os.makedirs(save_dir, exist_ok=True)
         outputs = []
         for i in range(img_num):
             image = self.pipe(
@@ -60,9 +58,7 @@ class FLUXD:
                 generator=torch.Generator("cpu").manual_seed(0)
             ).images[0]
 
-            path = os.path.join(save_dir, f"image_{i}.png")
-            image.save(path)
-            outputs.append(path)
+            outputs.append(image)
 
         return outputs
 
@@ -103,7 +99,6 @@ class FLUXS:
         self.pipe.enable_model_cpu_offload()
 
     def generate(self, input_text, img_num, save_dir):
-        os.makedirs(save_dir, exist_ok=True)
         outputs = []
         for i in range(img_num):
             image = self.pipe(
@@ -116,9 +111,7 @@ class FLUXS:
                 generator=torch.Generator("cpu").manual_seed(i)
             ).images[0]
 
-            path = os.path.join(save_dir, f"image_{i}.png")
-            image.save(path)
-            outputs.append(path)
+            outputs.append(image)
 
         return outputs
 
@@ -83,6 +83,60 @@ def load_pil_images(conversations: List[Dict[str, str]]) -> List[PIL.Image.Image
     return pil_images
 
 
+def load_images(conversations):
+    # generated images are passed in memory, saved images are loaded by path
+    images = [image for message in conversations for image in message.get("images", [])]
+    if all(isinstance(image, str) for image in images):
+        return load_pil_images(conversations)
+    return [image.convert("RGB") for image in images]
+
+
+def prepare_batch(vl_gpt, vl_chat_processor, input_img, prompts, suffix_ids=()):
+    """
+    Left-pad several questions of one image into a batch, the image is encoded once. The tokens of suffix_ids
+    are appended to each question after the assistant role. Returns the input embeddings and attention mask.
+    Shared by the Janus and JanusFlow adapters, whose processors and models have the same interface here.
+    """
+    conversations = [
+        [
+            {
+                "role": "User",
+                "content": "<image_placeholder>\n" + prompt,
+                "images": [input_img],
+            },
+            {"role": "Assistant", "content": ""},
+        ]
+        for prompt in prompts
+    ]
+
+    # load the image once, questions are left-padded into one batch
+    pil_images = load_images(conversations[0])
+    prepare_inputs = vl_chat_processor.batchify([
+        vl_chat_processor.process_one(conversations=conversation, images=pil_images)
+        for conversation in conversations
+    ]).to(vl_gpt.device)
+
+    # run image encoder on the first row only and share the image embeddings across questions
+    images_seq_mask = prepare_inputs.images_seq_mask
+    images_embeds = vl_gpt.prepare_inputs_embeds(
+        input_ids=prepare_inputs.input_ids[:1].clone(),
+        pixel_values=prepare_inputs.pixel_values[:1],
+        images_seq_mask=images_seq_mask[:1],
+        images_emb_mask=prepare_inputs.images_emb_mask[:1],
+    )[images_seq_mask[:1]]
+
+    inputs_embeds = vl_gpt.language_model.get_input_embeddings()(prepare_inputs.input_ids.clamp(min=0))
+    inputs_embeds[images_seq_mask] = images_embeds.repeat(len(prompts), 1)
+    attention_mask = prepare_inputs.attention_mask
+
+    if len(suffix_ids) > 0:
+        suffix_ids = torch.tensor(suffix_ids, device=inputs_embeds.device).expand(len(prompts), -1)
+        inputs_embeds = torch.cat([inputs_embeds, vl_gpt.language_model.get_input_embeddings()(suffix_ids)], dim=1)
+        attention_mask = torch.cat([attention_mask, torch.ones_like(suffix_ids, dtype=attention_mask.dtype)], dim=1)
+
+    return inputs_embeds, attention_mask
+
+
 def load_json(filepath):
     with open(filepath, "r") as f:
         data = json.load(f)
@@ -26,7 +26,8 @@ from transformers import AutoModelForCausalLM
 
 # root at uni_eval
 from janus.models import MultiModalityCausalLM, VLChatProcessor
-from janus.utils.io import load_pil_images
+from janus.utils.io import load_images, prepare_batch
+from option_scoring import OPTION_LETTERS, option_token_ids
 
 
 @torch.inference_mode()
@@ -82,6 +83,10 @@ def generate(
     visual_img = np.zeros((parallel_size, img_size, img_size, 3), dtype=np.uint8)
     visual_img[:, :, :] = dec
 
+    # keep images in memory without save_dir
+    if save_dir == '':
+        return [PIL.Image.fromarray(visual_img[i]) for i in range(parallel_size)]
+
     outputs = []
     os.makedirs(save_dir, exist_ok=True)
     for i in range(parallel_size):
@@ -111,8 +116,9 @@ class Janus:
         )
         prompt = sft_format + self.vl_chat_processor.image_start_tag
         
-        gen_img_paths = generate(self.vl_gpt, self.vl_chat_processor, prompt, parallel_size=img_num, save_dir=save_dir)
-        return gen_img_paths
+        # return images in memory, uni_eval archives them to save_dir in the background
+        gen_imgs = generate(self.vl_gpt, self.vl_chat_processor, prompt, parallel_size=img_num)
+        return gen_imgs
 
     def understand(self, input_img, prompt):
         conversation = [
@@ -125,7 +131,7 @@ class Janus:
         ]
         
         # load images and prepare for inputs
-        pil_images = load_pil_images(conversation)
+        pil_images = load_images(conversation)
         prepare_inputs = self.vl_chat_processor(
             conversations=conversation, images=pil_images, force_batchify=True
         ).to(self.vl_gpt.device)
@@ -147,3 +153,44 @@ class Janus:
         
         answer = self.tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
         return answer
+
+    @torch.inference_mode()
+    def understand_batch(self, input_img, prompts):
+        inputs_embeds, attention_mask = prepare_batch(self.vl_gpt, self.vl_chat_processor, input_img, prompts)
+
+        # run the model to get all responses in one call
+        outputs = self.vl_gpt.language_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            pad_token_id=self.tokenizer.eos_token_id,
+            bos_token_id=self.tokenizer.bos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            max_new_tokens=512,
+            do_sample=False,
+            use_cache=True,
+        )
+
+        answers = self.tokenizer.batch_decode(outputs.cpu().tolist(), skip_special_tokens=True)
+        return answers
+
+    @torch.inference_mode()
+    def score_options(self, input_img, prompts):
+        """
+        Score the options A-E of several questions of one image with a single forward pass, instead of
+        generating the replies. Returns the probabilities of the options for each question.
+        """
+        # the reply follows "<|Assistant|>:" after a space
+        prefix_ids, option_ids = option_token_ids(self.tokenizer, [" (%s)" % _ for _ in OPTION_LETTERS])
+        inputs_embeds, attention_mask = prepare_batch(self.vl_gpt, self.vl_chat_processor, input_img, prompts, prefix_ids)
+
+        # positions start at the first token of each left-padded row, as generate() does
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        # the base model runs without the lm head, which is applied to the last position only
+        hidden_states = self.vl_gpt.language_model.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+        ).last_hidden_state
+        logits = self.vl_gpt.language_model.lm_head(hidden_states[:, -1])[:, option_ids]
+
+        return logits.float().softmax(-1).tolist()
@@ -26,7 +26,7 @@ import torchvision
 from transformers import AutoModelForCausalLM
 
 from janus.janusflow.models import MultiModalityCausalLM, VLChatProcessor
-from janus.utils.io import load_pil_images
+from janus.utils.io import load_images, prepare_batch
 from diffusers.models import AutoencoderKL
 
 
@@ -62,6 +62,17 @@ def generate(
     attention_mask = torch.ones((2*batchsize, inputs_embeds.shape[1]+577)).to(vl_gpt.device)
     attention_mask[batchsize:, 1:inputs_embeds.shape[1]] = 0
     attention_mask = attention_mask.int()
+
+    # the prompt only attends to itself, so its kv cache (cond and uncond) is computed once
+    # and every ode step runs only the t_emb and z_emb tokens against it
+    outputs = vl_gpt.language_model.model(inputs_embeds=inputs_embeds,
+                                         use_cache=True,
+                                         attention_mask=attention_mask[:, :inputs_embeds.shape[1]],
+                                         past_key_values=None)
+    past_key_values = outputs.past_key_values
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+
     for step in range(num_inference_steps):
         # prepare inputs for the llm
         z_input = torch.cat([z, z], dim=0) # for cfg
@@ -71,25 +82,15 @@ def generate(
         z_emb, t_emb, hs = z_enc[0], z_enc[1], z_enc[2]
         z_emb = z_emb.view(z_emb.shape[0], z_emb.shape[1], -1).permute(0, 2, 1)
         z_emb = vl_gpt.vision_gen_enc_aligner(z_emb)
-        llm_emb = torch.cat([inputs_embeds, t_emb.unsqueeze(1), z_emb], dim=1)
+        llm_emb = torch.cat([t_emb.unsqueeze(1), z_emb], dim=1)
 
         # input to the llm
         # we apply attention mask for CFG: 1 for tokens that are not masked, 0 for tokens that are masked.
-        if step == 0:
-            outputs = vl_gpt.language_model.model(inputs_embeds=llm_emb, 
-                                             use_cache=True, 
-                                             attention_mask=attention_mask,
-                                             past_key_values=None)
-            past_key_values = []
-            for kv_cache in past_key_values:
-                k, v = kv_cache[0], kv_cache[1]
-                past_key_values.append((k[:, :, :inputs_embeds.shape[1], :], v[:, :, :inputs_embeds.shape[1], :]))
-            past_key_values = tuple(past_key_values)
-        else:
-            outputs = vl_gpt.language_model.model(inputs_embeds=llm_emb, 
-                                             use_cache=True, 
-                                             attention_mask=attention_mask,
-                                             past_key_values=past_key_values)
+        # the legacy tuple cache is not extended in place, so it holds the prompt only at every step
+        outputs = vl_gpt.language_model.model(inputs_embeds=llm_emb, 
+                                         use_cache=True, 
+                                         attention_mask=attention_mask,
+                                         past_key_values=past_key_values)
         hidden_states = outputs.last_hidden_state
         
         # transform hidden_states back to v
@@ -106,6 +107,10 @@ def generate(
     dec = dec.to(torch.float32).cpu().numpy().transpose(0, 2, 3, 1)
     dec = np.clip((dec + 1) / 2 * 255, 0, 255).astype(np.uint8)
 
+    # keep images in memory without save_dir
+    if save_dir == '':
+        return [PIL.Image.fromarray(dec[i]) for i in range(batchsize)]
+
     outputs = []
     os.makedirs(save_dir, exist_ok=True)
     for i in range(batchsize):
@@ -139,7 +144,7 @@ class JanusFlow:
         prompt = sft_format + self.vl_chat_processor.image_gen_tag
 
         return generate(self.vl_gpt, self.vl_chat_processor, self.vae, prompt, \
-            cfg_weight=2.0, num_inference_steps=30, batchsize=img_num, save_dir=save_dir)
+            cfg_weight=2.0, num_inference_steps=30, batchsize=img_num)
 
 
     def understand(self, input_img, prompt):
@@ -153,7 +158,7 @@ class JanusFlow:
         ]
         
         # load images and prepare for inputs
-        pil_images = load_pil_images(conversation)
+        pil_images = load_images(conversation)
         prepare_inputs = self.vl_chat_processor(
             conversations=conversation, images=pil_images, force_batchify=True
         ).to(self.vl_gpt.device)
@@ -175,3 +180,22 @@ class JanusFlow:
         
         answer = self.tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
         return answer
+
+    @torch.inference_mode()
+    def understand_batch(self, input_img, prompts):
+        inputs_embeds, attention_mask = prepare_batch(self.vl_gpt, self.vl_chat_processor, input_img, prompts)
+
+        # run the model to get all responses in one call
+        outputs = self.vl_gpt.language_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            pad_token_id=self.tokenizer.eos_token_id,
+            bos_token_id=self.tokenizer.bos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            max_new_tokens=512,
+            do_sample=False,
+            use_cache=True,
+        )
+
+        answers = self.tokenizer.batch_decode(outputs.cpu().tolist(), skip_special_tokens=True)
+        return answers
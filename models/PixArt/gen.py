@@ -1,4 +1,3 @@
-import os
 import torch
 from diffusers import PixArtAlphaPipeline
 
@@ -12,12 +11,4 @@ class PixArt:
     def generate(self, input_text, img_num, save_dir):
         images = self.pipe([input_text] * img_num).images
 
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-
-        return outputs
+        return images
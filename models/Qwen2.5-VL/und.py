@@ -1,6 +1,192 @@
 import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, DynamicCache
 from qwen_vl_utils import process_vision_info
+from option_scoring import OPTION_LETTERS, option_token_ids
+
+
+def prepare_batch(model, processor, img, prompts, suffix=""):
+    """
+    Left-pad several questions of one image into a batch, the image is preprocessed and encoded once.
+    suffix is appended to each prompt after the generation prompt.
+    """
+    messages = [
+        [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "image": img,
+                    },
+                    {"type": "text", "text": prompt},
+                ],
+            }
+        ]
+        for prompt in prompts
+    ]
+    texts = [
+        processor.apply_chat_template(message, tokenize=False, add_generation_prompt=True) + suffix
+        for message in messages
+    ]
+
+    # encode the shared image once
+    image_inputs, _ = process_vision_info(messages[0])
+    image_inputs = processor.image_processor(images=image_inputs, return_tensors="pt")
+    image_grid_thw = image_inputs.image_grid_thw.to(model.device)
+    pixel_values = image_inputs.pixel_values.to(model.device, dtype=model.visual.dtype)
+    image_embeds = model.visual(pixel_values, grid_thw=image_grid_thw)
+
+    # expand the image pads as the processor does, then left-pad all questions into one batch
+    num_image_tokens = int(image_grid_thw.prod()) // processor.image_processor.merge_size ** 2
+    texts = [text.replace("<|image_pad|>", "<|image_pad|>" * num_image_tokens) for text in texts]
+    processor.tokenizer.padding_side = "left"
+    inputs = processor.tokenizer(texts, padding=True, return_tensors="pt").to(model.device)
+
+    inputs_embeds = model.get_input_embeddings()(inputs.input_ids)
+    image_mask = inputs.input_ids == model.config.image_token_id
+    inputs_embeds[image_mask] = image_embeds.repeat(len(prompts), 1).to(inputs_embeds.dtype)
+
+    return inputs, inputs_embeds, image_grid_thw.repeat(len(prompts), 1)
+
+
+def generate_from_embeds(model, inputs, inputs_embeds, image_grid_thw, max_new_tokens=256):
+    """
+    model.generate() from precomputed input embeddings with the 3-D rope index of the image tokens.
+    generate() drops input_ids on prefill once inputs_embeds are given, so the rope index would fall back to
+    1-D text positions. The prompt but its last token is prefilled here with the rope index of input_ids, then
+    generate() goes on from the cache, where forward() offsets the positions by model.rope_deltas as it does
+    after a prefill from input_ids. Returns the generated ids with the prompt.
+    """
+    position_ids, rope_deltas = model.get_rope_index(
+        inputs.input_ids, image_grid_thw=image_grid_thw, attention_mask=inputs.attention_mask
+    )
+    past_key_values = DynamicCache()
+    # the base model runs without the lm head, no logits are needed for the prefilled positions
+    model.model(
+        inputs_embeds=inputs_embeds[:, :-1],
+        attention_mask=inputs.attention_mask[:, :-1],
+        position_ids=position_ids[..., :-1],
+        past_key_values=past_key_values,
+        use_cache=True,
+    )
+    model.rope_deltas = rope_deltas
+
+    # the last prompt token is a text token, so it is embedded from input_ids by generate()
+    return model.generate(
+        input_ids=inputs.input_ids,
+        attention_mask=inputs.attention_mask,
+        past_key_values=past_key_values,
+        max_new_tokens=max_new_tokens,
+    )
+
+
+@torch.inference_mode()
+def understand_batch(model, processor, img, prompts, max_new_tokens=256):
+    """
+    Answer several questions of one image in a call, the image is preprocessed and encoded once.
+    """
+    inputs, inputs_embeds, image_grid_thw = prepare_batch(model, processor, img, prompts)
+
+    # Inference: Generation of the outputs
+    generated_ids = generate_from_embeds(model, inputs, inputs_embeds, image_grid_thw, max_new_tokens)
+    generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+    output_text = processor.batch_decode(
+        generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+
+    return output_text
+
+
+@torch.inference_mode()
+def understand_many(model, processor, imgs, prompts, max_batch_tokens=65536, max_new_tokens=256):
+    """
+    Answer (image, question) pairs collected from many cases. The pairs are sorted by their number of visual
+    tokens and grouped into batches of at most max_batch_tokens padded prompt and new tokens, so rows of a batch
+    have similar lengths. Each batch is left-padded and generated together, finished rows are padded until all
+    rows of the batch stop.
+    """
+    # preprocess each distinct image once, in-memory images are told apart by id
+    keys = [img if isinstance(img, str) else id(img) for img in imgs]
+    images = {}
+    for key, img in zip(keys, imgs):
+        if key not in images:
+            image_inputs, _ = process_vision_info([{"role": "user", "content": [{"type": "image", "image": img}]}])
+            images[key] = processor.image_processor(images=image_inputs, return_tensors="pt")
+    merge_length = processor.image_processor.merge_size ** 2
+    num_image_tokens = [int(images[key].image_grid_thw.prod()) // merge_length for key in keys]
+
+    texts = [
+        processor.apply_chat_template(
+            [{"role": "user", "content": [{"type": "image", "image": img}, {"type": "text", "text": prompt}]}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        for img, prompt in zip(imgs, prompts)
+    ]
+    # the single <|image_pad|> of a text is expanded to the visual tokens of its image
+    lengths = [len(ids) - 1 + n for ids, n in zip(processor.tokenizer(texts).input_ids, num_image_tokens)]
+
+    batches, batch = [], []
+    for i in sorted(range(len(texts)), key=lambda i: (num_image_tokens[i], lengths[i])):
+        if len(batch) > 0 and (len(batch) + 1) * (max(lengths[j] for j in batch + [i]) + max_new_tokens) > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+
+    replies = [None] * len(texts)
+    processor.tokenizer.padding_side = "left"
+    for batch in batches:
+        # encode the distinct images of the batch in one call
+        batch_keys = list(dict.fromkeys(keys[i] for i in batch))
+        pixel_values = torch.cat([images[key].pixel_values for key in batch_keys])
+        pixel_values = pixel_values.to(model.device, dtype=model.visual.dtype)
+        grid_thw = torch.cat([images[key].image_grid_thw for key in batch_keys]).to(model.device)
+        image_embeds = model.visual(pixel_values, grid_thw=grid_thw)
+        image_embeds = dict(zip(batch_keys, image_embeds.split([int(_.prod()) // merge_length for _ in grid_thw])))
+
+        batch_texts = [texts[i].replace("<|image_pad|>", "<|image_pad|>" * num_image_tokens[i]) for i in batch]
+        inputs = processor.tokenizer(batch_texts, padding=True, return_tensors="pt").to(model.device)
+        inputs_embeds = model.get_input_embeddings()(inputs.input_ids)
+        image_mask = inputs.input_ids == model.config.image_token_id
+        inputs_embeds[image_mask] = torch.cat([image_embeds[keys[i]] for i in batch]).to(inputs_embeds.dtype)
+
+        image_grid_thw = torch.cat([images[keys[i]].image_grid_thw for i in batch]).to(model.device)
+        generated_ids = generate_from_embeds(model, inputs, inputs_embeds, image_grid_thw, max_new_tokens)
+        output_text = processor.batch_decode(
+            generated_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        for i, text in zip(batch, output_text):
+            replies[i] = text
+
+    return replies
+
+
+@torch.inference_mode()
+def score_options(model, processor, img, prompts):
+    """
+    Score the options A-E of several questions of one image with a single forward pass, instead of
+    generating the replies. Returns the probabilities of the options for each question.
+    """
+    prefix_ids, option_ids = option_token_ids(processor.tokenizer, ["(%s)" % _ for _ in OPTION_LETTERS])
+    inputs, inputs_embeds, image_grid_thw = prepare_batch(
+        model, processor, img, prompts, processor.tokenizer.decode(prefix_ids)
+    )
+
+    # the rope index is computed from input_ids and the attention mask, so left padding is fine
+    position_ids, _ = model.get_rope_index(
+        inputs.input_ids, image_grid_thw=image_grid_thw, attention_mask=inputs.attention_mask
+    )
+    # the base model runs without the lm head, which is applied to the last position only
+    hidden_states = model.model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=inputs.attention_mask,
+        position_ids=position_ids,
+    ).last_hidden_state
+    logits = model.lm_head(hidden_states[:, -1])[:, option_ids]
+
+    return logits.float().softmax(-1).tolist()
 
 
 class QWenVL:
@@ -52,6 +238,15 @@ class QWenVL:
 
         return output_text[0]
 
+    def understand_batch(self, img, prompts):
+        return understand_batch(self.model, self.processor, img, prompts)
+
+    def understand_many(self, imgs, prompts):
+        return understand_many(self.model, self.processor, imgs, prompts)
+
+    def score_options(self, img, prompts):
+        return score_options(self.model, self.processor, img, prompts)
+
 
 # auto device_map for larger models
 class QWenVL_:
@@ -103,3 +298,38 @@ class QWenVL_:
         )
 
         return output_text[0]
+
+    def understand_batch(self, img, prompts):
+        return understand_batch(self.model, self.processor, img, prompts)
+
+    def understand_many(self, imgs, prompts):
+        return understand_many(self.model, self.processor, imgs, prompts)
+
+    def score_options(self, img, prompts):
+        return score_options(self.model, self.processor, img, prompts)
+
+
+if __name__ == '__main__':
+    # check the batched paths against understand(), python models/Qwen2.5-VL/und.py [image] at the root of uni_eval
+    import sys
+    from PIL import Image
+
+    img = Image.open(sys.argv[1] if len(sys.argv) > 1 else 'assets/example.jpg').convert('RGB')
+    prompts = [
+        'What is the main object in this image? (A) a person (B) an animal (C) a building (D) a vehicle (E) none of them',
+        'What is the dominant color of this image? (A) red (B) green (C) blue (D) white (E) black',
+        'Describe this image in one sentence.',
+    ]
+
+    model = QWenVL()
+    model.model.to('cuda')
+    expected = [model.understand(img, prompt) for prompt in prompts]
+    checks = [
+        ('understand_batch', model.understand_batch(img, prompts)),
+        ('understand_many', model.understand_many([img] * len(prompts), prompts)),
+    ]
+    for name, replies in checks:
+        for prompt, reply, ref in zip(prompts, replies, expected):
+            if reply != ref:
+                print('%s differs from understand() on %r:\n  %r\n  %r' % (name, prompt, reply, ref))
+        print('%s: %d/%d replies match understand()' % (name, sum(a == b for a, b in zip(replies, expected)), len(prompts)))
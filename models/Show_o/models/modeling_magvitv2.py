@@ -205,6 +205,15 @@ class LFQuantizer(nn.Module):
             .long()
         )
 
+    def quantize_to_indices(self, z):
+        """
+        Inference-only quantization of the encoder output z (batch, channel, height, width) to
+        codebook indices (batch, height * width). The bits are thresholded and packed directly,
+        without the straight-through estimator and the entropy / commitment losses of forward.
+        """
+        bits = (z > 0).to(self.power_vals.dtype)
+        return (bits * self.power_vals.reshape(1, -1, 1, 1)).sum(1).reshape(z.shape[0], -1)
+
     def get_codebook_entry(self, indices, shape=None):
         if shape is None:
             h, w = int(math.sqrt(indices.shape[-1])), int(math.sqrt(indices.shape[-1]))
@@ -420,9 +429,10 @@ class MAGVITv2(ModelMixin, ConfigMixin):
         output = (quantized_states, codebook_indices)
         return output
 
+    @torch.no_grad()
     def get_code(self, pixel_values):
         hidden_states = self.encoder(pixel_values)
-        codebook_indices = self.quantize.get_indices(self.quantize(hidden_states)['z']).reshape(pixel_values.shape[0], -1)
+        codebook_indices = self.quantize.quantize_to_indices(hidden_states)
 
         return codebook_indices
 
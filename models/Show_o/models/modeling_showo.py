@@ -181,11 +181,14 @@ class Showo(ModelMixin, ConfigMixin):
         return sampled_ids
 
     @torch.no_grad()
-    def mmu_generate(self, idx=None, input_embeddings=None, attention_mask=None, max_new_tokens=100, temperature=1.0, top_k=None, eot_token=None):
+    def mmu_generate(self, idx=None, input_embeddings=None, attention_mask=None, max_new_tokens=100, temperature=1.0, top_k=None, eot_token=None, use_cache=True):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache, the image and prompt are prefilled once and each step only feeds the new token
+        with the kv cache. A new token attends to all previous tokens, so the grown mask of the uncached
+        path equals no mask for a single query, and greedy outputs are the same.
         """
         try:
             device = idx.device
@@ -193,28 +196,39 @@ class Showo(ModelMixin, ConfigMixin):
             device = input_embeddings.device
 
         result = []
+        past_key_values = None
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            # idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            # logits, _ = self(idx_cond)
-            logits = self(idx, input_embeddings=input_embeddings, attention_mask=attention_mask)
-
-            L = attention_mask.shape[-1]
-            attention_mask = attention_mask.squeeze()
-            attention_mask_a = torch.hstack(
-                [
-                    attention_mask,  # L, L
-                    torch.zeros((L, 1)).to(device) + torch.finfo(logits.dtype).min,
-                ]
-            )
-            attention_mask_b = torch.vstack(
-                [
-                    attention_mask_a,  # L, L+1
-                    torch.hstack([attention_mask[-1, :], torch.tensor([0]).to(device)]).unsqueeze(0),
-                ]
-            )
-            attention_mask = attention_mask_b
+            if use_cache:
+                if input_embeddings is None:
+                    outputs = self.showo(input_ids=idx, attention_mask=attention_mask,
+                                         past_key_values=past_key_values, use_cache=True)
+                else:
+                    outputs = self.showo(inputs_embeds=input_embeddings, attention_mask=attention_mask,
+                                         past_key_values=past_key_values, use_cache=True)
+                logits, past_key_values = outputs['logits'], outputs['past_key_values']
+                attention_mask = None
+            else:
+                # if the sequence context is growing too long we must crop it at block_size
+                # idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+                # forward the model to get the logits for the index in the sequence
+                # logits, _ = self(idx_cond)
+                logits = self(idx, input_embeddings=input_embeddings, attention_mask=attention_mask)
+
+                L = attention_mask.shape[-1]
+                attention_mask = attention_mask.squeeze()
+                attention_mask_a = torch.hstack(
+                    [
+                        attention_mask,  # L, L
+                        torch.zeros((L, 1)).to(device) + torch.finfo(logits.dtype).min,
+                    ]
+                )
+                attention_mask_b = torch.vstack(
+                    [
+                        attention_mask_a,  # L, L+1
+                        torch.hstack([attention_mask[-1, :], torch.tensor([0]).to(device)]).unsqueeze(0),
+                    ]
+                )
+                attention_mask = attention_mask_b
 
             # pluck the logits at the final step and scale by desired temperature
             logits = logits[:, -1, :] / temperature
@@ -227,12 +241,12 @@ class Showo(ModelMixin, ConfigMixin):
             # sample from the distribution
             idx_next = torch.multinomial(probs, num_samples=1)
             result.append(idx_next[0][0])
-            # append sampled index to the running sequence and continue
+            # append sampled index to the running sequence and continue, only the new token is fed with the cache
             if self.config.w_clip_vit:
                 idx_next_embeddings = self.showo.model.embed_tokens(idx_next)
-                input_embeddings = torch.cat([input_embeddings, idx_next_embeddings], dim=1)
+                input_embeddings = idx_next_embeddings if use_cache else torch.cat([input_embeddings, idx_next_embeddings], dim=1)
             else:
-                idx = torch.cat((idx, idx_next), dim=1)
+                idx = idx_next if use_cache else torch.cat((idx, idx_next), dim=1)
 
             if eot_token is not None and idx_next.cpu() == eot_token:
                 break
@@ -2,7 +2,6 @@ import argparse
 import numpy as np
 import os
 import torch
-import string
 from PIL import Image
 import random
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
@@ -13,17 +12,6 @@ from training.utils import get_config, flatten_omega_conf, image_transform
 from transformers import AutoTokenizer
 import torch.nn.functional as F
 
-def save_image(response, input_text="", path='generated_samples/showo'):
-    os.makedirs(path, exist_ok=True)
-    outputs = []
-    trans = str.maketrans(' ', '-', string.punctuation)
-    save_prompt = input_text.translate(trans)
-    for i in range(len(response)):
-        response[i].save(os.path.join(path, f"image_{i}.png"))
-        outputs.append(os.path.join(path, f"image_{i}.png"))
-    return outputs
-
-
 def get_vq_model_class(model_type):
     if model_type == "magvitv2":
         return MAGVITv2
@@ -128,18 +116,25 @@ class Show_o:
         images = images.permute(0, 2, 3, 1).cpu().numpy().astype(np.uint8)
         pil_images = [Image.fromarray(image) for image in images]
 
-        outputs = save_image(pil_images, input_text, save_dir)
-
-        return outputs
+        # return images in memory, uni_eval archives them to save_dir in the background
+        return pil_images
 
 
     def understand(self, input_img, prompt):
+        return self.understand_image_tokens(self.encode_image(input_img), prompt)
 
-        # print(f"\033[91m {prompt} \033[0m")
 
-        # q1 = f"<|image|>{prompt}"
+    def understand_batch(self, input_img, prompts):
+        # encode the image once and share the image tokens across questions
+        image_tokens = self.encode_image(input_img)
+        return [self.understand_image_tokens(image_tokens, prompt) for prompt in prompts]
+
+
+    def encode_image(self, input_img):
 
-        image_ori = Image.open(input_img).convert('RGB')
+        # generated images are passed in memory, saved images by path
+        image_ori = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
+        image_ori = image_ori.convert('RGB')
         image = image_transform(image_ori, resolution=self.config.dataset.params.resolution).to(self.device)
         image = image.unsqueeze(0)
 
@@ -147,6 +142,15 @@ class Show_o:
 
         image_tokens = self.vq_model.get_code(image) + len(self.uni_prompting.text_tokenizer)
 
+        return image_tokens
+
+
+    def understand_image_tokens(self, image_tokens, prompt):
+
+        # print(f"\033[91m {prompt} \033[0m")
+
+        # q1 = f"<|image|>{prompt}"
+
 
         input_ids = self.uni_prompting.text_tokenizer(['USER: \n' + prompt + ' ASSISTANT:'])[
             'input_ids']
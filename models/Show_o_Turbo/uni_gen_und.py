@@ -2,7 +2,6 @@ import argparse
 import numpy as np
 import os
 import torch
-import string
 from PIL import Image
 import random
 from tqdm import tqdm
@@ -197,17 +196,6 @@ def denoise(model, input_ids, input_ids_minus_lm_vocab_size, uncond_input_ids, u
     return input_ids, input_ids_minus_lm_vocab_size, temperature, sampled_ids
 
 
-def save_image(response, input_text="", path='generated_samples/showoturbo'):
-    os.makedirs(path, exist_ok=True)
-    outputs = []
-    trans = str.maketrans(' ', '-', string.punctuation)
-    save_prompt = input_text.translate(trans)
-    for i in range(len(response)):
-        response[i].save(os.path.join(path, f"image_{i}.png"))
-        outputs.append(os.path.join(path, f"image_{i}.png"))
-    return outputs
-
-
 def get_vq_model_class(model_type):
     if model_type == "magvitv2":
         return MAGVITv2
@@ -327,26 +315,40 @@ class Show_o_Turbo:
         images = images.permute(0, 2, 3, 1).cpu().numpy().astype(np.uint8)
         pil_images = [Image.fromarray(image) for image in images]
 
-        outputs = save_image(pil_images, input_text, save_dir)
-
-        return outputs
+        return pil_images
 
 
     def understand(self, input_img, prompt):
+        return self.understand_image_tokens(self.encode_image(input_img), prompt)
 
-        # print(f"\033[91m {prompt} \033[0m")
 
-        # q1 = f"<|image|>{prompt}"
-        max_new_tokens = 16
-        max_new_seq_len = 512
+    def understand_batch(self, input_img, prompts):
+        # encode the image once and share the image tokens across questions
+        image_tokens = self.encode_image(input_img)
+        return [self.understand_image_tokens(image_tokens, prompt) for prompt in prompts]
 
 
-        image_ori = Image.open(input_img).convert('RGB')
+    def encode_image(self, input_img):
+
+        image_ori = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
+        image_ori = image_ori.convert('RGB')
         image = image_transform(image_ori, resolution=self.config.dataset.params.resolution).to(self.device)
         image = image.unsqueeze(0)
 
 
         image_tokens = self.vq_model.get_code(image) + len(self.uni_prompting.text_tokenizer)
+
+        return image_tokens
+
+
+    def understand_image_tokens(self, image_tokens, prompt):
+
+        # print(f"\033[91m {prompt} \033[0m")
+
+        # q1 = f"<|image|>{prompt}"
+        max_new_tokens = 16
+        max_new_seq_len = 512
+
         batch_size = 1
 
         prompt = clean_prompt(prompt)
@@ -1,4 +1,4 @@
-import os, torch
+import torch
 from torch import autocast
 from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler, DiffusionPipeline, StableDiffusion3Pipeline
 
@@ -11,15 +11,7 @@ class SDV15:
 
     def generate(self, input_text, img_num, save_dir):
         images = self.pipe([input_text] * img_num).images
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-
-        return outputs
+        return images
 
 
 class SDV21:
@@ -32,15 +24,7 @@ class SDV21:
 
     def generate(self, input_text, img_num, save_dir):
         images = self.pipe([input_text] * img_num).images
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-
-        return outputs
+        return images
 
 
 class SDXL:
@@ -52,15 +36,7 @@ class SDXL:
 
     def generate(self, input_text, img_num, save_dir):
         images = self.pipe([input_text] * img_num).images
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-
-        return outputs
+        return images
 
 
 class SD3M:
@@ -78,15 +54,7 @@ class SD3M:
             guidance_scale=7.0,
         ).images
 
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-        
-        return outputs
+        return images
 
 
 class SD35M:
@@ -102,12 +70,4 @@ class SD35M:
             guidance_scale=4.5,
         ).images
 
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-
-        for i in range(len(images)):
-            path = os.path.join(save_dir, f"image_{i}.png")
-            images[i].save(path)
-            outputs.append(path)
-
-        return outputs
+        return images
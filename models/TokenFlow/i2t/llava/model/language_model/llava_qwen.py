@@ -123,7 +123,10 @@ class LlavaQwenForCausalLM(Qwen2ForCausalLM, LlavaMetaForCausalLM):
         position_ids = kwargs.pop("position_ids", None)
         attention_mask = kwargs.pop("attention_mask", None)
         if "inputs_embeds" in kwargs:
-            raise NotImplementedError("`inputs_embeds` is not supported")
+            if images is not None:
+                raise NotImplementedError("`inputs_embeds` is not supported with `images`")
+            # multimodal embeddings are already merged by the caller, e.g., a shared image prefix
+            return super().generate(position_ids=position_ids, attention_mask=attention_mask, **kwargs)
 
         if images is not None:
             (inputs, position_ids, attention_mask, _, inputs_embeds, _) = self.prepare_inputs_labels_for_multimodal(inputs, position_ids, attention_mask, None, None, images, image_sizes=image_sizes)
@@ -215,9 +215,69 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                                                                       )
         return inputs_embeds, attention_mask, labels
     
+    def prefill_text_codes(self, prefix_text_codes):
+        """
+        prefill the text prompts (except the last token, which predicts the first scale) into the kv cache
+        prompts are left padded, so the blocks of each scale are aligned across the batch
+        :return: legacy kv cache (None for empty prompts), key padding mask, left padding length of each row
+        """
+        device = prefix_text_codes[0].device
+        text_lens = [len(codes) - 1 for codes in prefix_text_codes]
+        max_text_len = max(text_lens)
+        pads = torch.tensor([max_text_len - l for l in text_lens], device=device)
+
+        key_valid = torch.arange(max_text_len, device=device)[None] >= pads[:, None]
+        if max_text_len == 0:
+            return None, key_valid, pads
+
+        lvl_embed = self.get_model().lvl_embed(torch.zeros((1,), dtype=torch.long, device=device))
+        inputs_embeds = torch.zeros((len(prefix_text_codes), max_text_len, lvl_embed.shape[-1]), dtype=lvl_embed.dtype, device=device)
+        for i, codes in enumerate(prefix_text_codes):
+            if text_lens[i] > 0:
+                inputs_embeds[i, -text_lens[i]:] = self.get_model().embed_tokens(codes[:-1]) + lvl_embed
+
+        # causal mask over the valid (non-padding) keys
+        causal = torch.ones((max_text_len, max_text_len), dtype=torch.bool, device=device).tril()
+        attention_mask = torch.zeros((len(prefix_text_codes), 1, max_text_len, max_text_len), dtype=inputs_embeds.dtype, device=device)
+        attention_mask.masked_fill_(~(causal[None, None] & key_valid[:, None, None, :]), torch.finfo(inputs_embeds.dtype).min)
+        position_ids = (torch.arange(max_text_len, device=device)[None] - pads[:, None]).clamp(min=0)
+
+        past_key_values = self.forward(input_ids=None, attention_mask=attention_mask, position_ids=position_ids,
+                                       inputs_embeds=inputs_embeds, use_cache=True, return_dict=False)[1]
+        return past_key_values, key_valid, pads
+
+    def prepare_scale_inputs(self, input_codes, prefix_lens, si, pred_for_curr_shape=None):
+        """
+        input embeddings of the si-th scale block, the same as those rows of prepare_generation_inputs
+        the block of the first scale is the last text token, the others are the upsampled features of previous scales
+        """
+        vision_tower = self.get_vision_tower()
+        image_token_start = getattr(self, 'image_token_start', 0)
+        scales = vision_tower.scale_rq_layers
+        pn = scales[si]
+        begin = sum(p * p for p in scales[:si])
+        device = input_codes[0].device
+
+        if si == 0:
+            last_text_codes = torch.stack([codes[prefix_lens[i] - 1] for i, codes in enumerate(input_codes)])
+            scale_embeds = self.get_model().embed_tokens(last_text_codes)[:, None]
+        else:
+            # codes of scales to be generated are filled by padding_value image_token_start+1 as prepare_generation_inputs
+            vision_code_inds = torch.ones((len(input_codes), vision_tower.num_patches), dtype=torch.long, device=device)
+            for i, codes in enumerate(input_codes):
+                vision_code_inds[i, :len(codes) - prefix_lens[i]] = codes[prefix_lens[i]:] - image_token_start
+            img_embeds, _ = self.encode_images(vision_code_inds, pred_for_curr_shape=pred_for_curr_shape)
+            scale_embeds = img_embeds[:, begin - 1:begin - 1 + pn * pn]
+
+        # level embedding (0 for the first scale, si+1 for the others) and abs positional encoding
+        scale_embeds = scale_embeds + self.get_model().lvl_embed(torch.full((pn * pn,), 0 if si == 0 else si + 1, device=device))
+        pos_1LC = self.get_model().pos_1LC
+        scale_embeds = scale_embeds + pos_1LC.reshape(-1, pos_1LC.shape[-1])[begin:begin + pn * pn].to(scale_embeds)
+        return scale_embeds
+
     @torch.no_grad()
     def autoregressive_infer_cfg(self, B, prefix_text_codes=None, g_seed=None, 
-                                 cfg=1.5, topk_list=[600], topp_list=[0.6]
+                                 cfg=1.5, topk_list=[600], topp_list=[0.6], use_cache=True
     ) -> torch.Tensor:   # returns reconstructed image (B, 3, H, W) in [0, 1]
         """
         only used for inference, on autoregressive mode
@@ -227,6 +287,8 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         :param cfg: classifier-free guidance ratio
         :param top_k: top-k sampling
         :param top_p: top-p sampling
+        :param use_cache: prefill the text once and only forward the new pn*pn block of each scale with the kv cache,
+                          a block attends to all previous blocks and itself, so no dense mask is rebuilt
         """
 
         vision_tower = self.get_vision_tower()
@@ -254,6 +316,10 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         ctx_length = getattr(self.config, 'tokenizer_model_max_length', None)
         print('context length: ', ctx_length)
 
+        if use_cache:
+            prefix_lens = [len(i) for i in prefix_text_codes]
+            past_key_values, key_valid, pads = self.prefill_text_codes(prefix_text_codes)
+
         # multi_step_inferience strategy
         multi_step_infer_start = 1
         # topk_list = [top_k, 100, 1]
@@ -262,35 +328,61 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
             ratio = si / (len(vision_tower.scale_rq_layers) - 1)
 
             for loop in range(len(topk_list)):
-                inputs_embeds, \
-                attention_mask, \
-                labels = self.prepare_generation_inputs(input_codes, 
-                                                        img_ind_list=img_ind_list,
-                                                        padding_value=image_token_start+1,
-                                                        pred_for_curr_shape=None if loop == 0 else si-1)
-                if loop == 0:
-                    max_len = max([cur_Ls[i]+pn*pn for i in range(2*B)])
-                else:
-                    max_len = max([cur_Ls[i] for i in range(2*B)])
-                inputs_embeds = inputs_embeds[:, :max_len]
-                attention_mask = attention_mask[:, :, :max_len, :max_len]
-
-                logits = self.forward(
-                                        input_ids=None,
-                                        attention_mask=attention_mask,
-                                        position_ids=None,
-                                        past_key_values=None,
-                                        inputs_embeds=inputs_embeds,
-                                        labels=None,
-                                        use_cache=False,
-                                        output_attentions=False,
-                                        output_hidden_states=False,
-                                        return_dict=False
-                                    )[0]
-                if loop == 0:
-                    logits = torch.stack([logits[i, cur_Ls[i]:cur_Ls[i]+pn*pn] for i in range(2*B)], dim=0)  # no use cache
+                if use_cache:
+                    # refinement loops re-predict the current scale, its loop-0 cache is kept for later scales
+                    if loop == 0:
+                        past = past_key_values
+                        key_valid = torch.cat([key_valid, key_valid.new_ones((2*B, pn*pn))], dim=1)
+                    else:
+                        past = tuple((k[:, :, :-pn*pn], v[:, :, :-pn*pn]) for k, v in past_key_values)
+                    inputs_embeds = self.prepare_scale_inputs(input_codes, prefix_lens, si,
+                                                              pred_for_curr_shape=None if loop == 0 else si-1)
+                    past_len = key_valid.shape[1] - pn*pn
+                    attention_mask = torch.zeros((2*B, 1, pn*pn, past_len + pn*pn), dtype=inputs_embeds.dtype, device=device)
+                    attention_mask.masked_fill_(~key_valid[:, None, None, :], torch.finfo(inputs_embeds.dtype).min)
+                    position_ids = past_len + torch.arange(pn*pn, device=device)[None] - pads[:, None]
+
+                    logits, new_key_values = self.forward(
+                                            input_ids=None,
+                                            attention_mask=attention_mask,
+                                            position_ids=position_ids,
+                                            past_key_values=past,
+                                            inputs_embeds=inputs_embeds,
+                                            use_cache=True,
+                                            return_dict=False
+                                        )[:2]
+                    if loop == 0:
+                        past_key_values = new_key_values
                 else:
-                    logits = torch.stack([logits[i, cur_Ls[i]-pn*pn:cur_Ls[i]] for i in range(2*B)], dim=0)  # no use cache
+                    inputs_embeds, \
+                    attention_mask, \
+                    labels = self.prepare_generation_inputs(input_codes, 
+                                                            img_ind_list=img_ind_list,
+                                                            padding_value=image_token_start+1,
+                                                            pred_for_curr_shape=None if loop == 0 else si-1)
+                    if loop == 0:
+                        max_len = max([cur_Ls[i]+pn*pn for i in range(2*B)])
+                    else:
+                        max_len = max([cur_Ls[i] for i in range(2*B)])
+                    inputs_embeds = inputs_embeds[:, :max_len]
+                    attention_mask = attention_mask[:, :, :max_len, :max_len]
+
+                    logits = self.forward(
+                                            input_ids=None,
+                                            attention_mask=attention_mask,
+                                            position_ids=None,
+                                            past_key_values=None,
+                                            inputs_embeds=inputs_embeds,
+                                            labels=None,
+                                            use_cache=False,
+                                            output_attentions=False,
+                                            output_hidden_states=False,
+                                            return_dict=False
+                                        )[0]
+                    if loop == 0:
+                        logits = torch.stack([logits[i, cur_Ls[i]:cur_Ls[i]+pn*pn] for i in range(2*B)], dim=0)  # no use cache
+                    else:
+                        logits = torch.stack([logits[i, cur_Ls[i]-pn*pn:cur_Ls[i]] for i in range(2*B)], dim=0)  # no use cache
 
                 t = cfg * ratio
                 logits_BlV = (1+t) * logits[:B] - t * logits[B:]
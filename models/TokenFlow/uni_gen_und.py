@@ -7,11 +7,9 @@ from tqdm import tqdm
 import json
 import gc
 from PIL import Image
-import os
 from t2i.llava_t2i.model import *
 import transformers
 from transformers import TextStreamer
-import string
 import cv2
 import i2t.llava as llava
 from i2t.llava.model.builder import load_pretrained_model
@@ -39,16 +37,10 @@ multi_step_infer_strategy = {
 
 
 
-def save_image(response, input_text="", path='generated_samples/tokenflow'):
-    os.makedirs(path, exist_ok=True)
-    outputs = []
-    trans = str.maketrans(' ', '-', string.punctuation)
-    save_prompt = input_text.translate(trans)
-    for i in range(response.shape[0]):
-        # print(f"\033[92m {response[i].numpy().max(), response[i].numpy().min()} \033[0m")
-        Image.fromarray(response[i].numpy().astype(np.uint8)).save(os.path.join(path, f"image_{i}.png"))
-        outputs.append(os.path.join(path, f"image_{i}.png"))
-    return outputs
+def load_image(input_img):
+    # generated images are passed in memory, saved images by path
+    image = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
+    return image.convert("RGB")
 
 
 class TokenFlowOld:
@@ -149,7 +141,7 @@ class TokenFlowOld:
                                                      cfg=self.cfg, topk_list=topk_list, topp_list=topp_list,
                                                      g_seed=None)
 
-        outputs = save_image(samples, input_text, save_dir)
+        outputs = [Image.fromarray(sample.numpy().astype(np.uint8)) for sample in samples]
 
         return outputs
 
@@ -177,7 +169,7 @@ class TokenFlowOld:
         else:
             roles = conv.roles
 
-        image = Image.open(input_img).convert("RGB")
+        image = load_image(input_img)
         image_size = image.size
         # Similar operation in model_worker.py
         image_tensor = process_images([image], self.image_processor, self.model.config)
@@ -384,8 +376,8 @@ class TokenFlow:
                 g_seed=None
             )
 
-        # 保存结果
-        outputs = save_image(samples, input_text, save_dir)
+        # 直接返回内存中的图像, uni_eval 在后台保存到 save_dir
+        outputs = [Image.fromarray(sample.numpy().astype(np.uint8)) for sample in samples]
         return outputs
 
 
@@ -406,7 +398,7 @@ class TokenFlow:
         roles = conv.roles
 
         # 处理输入图像
-        image = Image.open(input_img).convert("RGB")
+        image = load_image(input_img)
         image_size = image.size
         # print(f"\033[92m {image_size} \033[0m")
         image_tensor = process_images([image], self.image_processor, self.model.config)
@@ -474,3 +466,71 @@ class TokenFlow:
 
         return outputs
 
+
+    # -------------------- 批量图像理解接口 --------------------
+    def understand_batch(self, input_img, prompts):
+        # 显存管理
+        if self.gen_model_loaded:
+            self._release_model("gen")
+
+        self._init_understand_model()  # 确保理解模型已加载
+
+        # 处理输入图像, 所有问题共用
+        image = load_image(input_img)
+        image_size = image.size
+        image_tensor = process_images([image], self.image_processor, self.model.config)
+        if isinstance(image_tensor, list):
+            image_tensor = [img.to(self.model.device, dtype=torch.float16) for img in image_tensor]
+        else:
+            image_tensor = image_tensor.to(self.model.device, dtype=torch.float16)
+
+        # 编码每个问题
+        input_ids_list = []
+        for prompt in prompts:
+            conv = conv_templates["qwen_2_5"].copy()
+            inp = prompt
+            if self.model.config.mm_use_im_start_end:
+                inp = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + inp
+            else:
+                inp = DEFAULT_IMAGE_TOKEN + '\n' + inp
+            conv.append_message(conv.roles[0], inp)
+            conv.append_message(conv.roles[1], None)
+            input_ids_list.append(tokenizer_image_token(conv.get_prompt(), self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'))
+
+        # 图像之前的系统prompt对所有问题相同, 图像前缀只编码一次
+        image_pos = torch.where(input_ids_list[0] == IMAGE_TOKEN_INDEX)[0][0].item()
+        prefix_ids = input_ids_list[0][:image_pos + 1].unsqueeze(0).to(self.model.device)
+
+        with torch.inference_mode():
+            _, _, _, _, prefix_embeds, _ = self.model.prepare_inputs_labels_for_multimodal(
+                prefix_ids, None, None, None, None, image_tensor, image_sizes=[image_size])
+
+            embed_tokens = self.model.get_model().embed_tokens
+            inputs_embeds_list = [
+                torch.cat([prefix_embeds[0], embed_tokens(input_ids[image_pos + 1:].to(self.model.device))], dim=0)
+                for input_ids in input_ids_list
+            ]
+
+            # 左填充成一个batch
+            max_len = max(x.shape[0] for x in inputs_embeds_list)
+            inputs_embeds = prefix_embeds.new_zeros((len(prompts), max_len, prefix_embeds.shape[-1]))
+            attention_mask = torch.zeros((len(prompts), max_len), dtype=torch.long, device=self.model.device)
+            for i, x in enumerate(inputs_embeds_list):
+                inputs_embeds[i, -x.shape[0]:] = x
+                attention_mask[i, -x.shape[0]:] = 1
+
+            # 执行推理
+            output_ids = self.model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                do_sample=True if self.temperature > 0 else False,
+                temperature=self.temperature,
+                max_new_tokens=self.max_new_tokens,
+                use_cache=True
+            )
+
+        # 解析输出
+        outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+        return outputs
+
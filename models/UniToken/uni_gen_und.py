@@ -1,22 +1,14 @@
 import argparse
 import numpy as np
-import os
 from unitoken.inference_solver_anyres import FlexARInferenceSolverAnyRes
 import torch
-import string
 from PIL import Image
 
 
-def save_image(response, input_text="", path='generated_samples/unitoken'):
-    os.makedirs(path, exist_ok=True)
-    outputs = []
-    trans = str.maketrans(' ', '-', string.punctuation)
-    save_prompt = input_text.translate(trans)
-    for i in range(len(response)):
-        a1, image = response[i][0], response[i][1][0]
-        image.save(os.path.join(path, f"image_{i}.png"))
-        outputs.append(os.path.join(path, f"image_{i}.png"))
-    return outputs
+def load_image(input_img):
+    # generated images are passed in memory, saved images by path
+    image = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
+    return image.convert('RGB')
 
 
 class UniToken:
@@ -46,7 +38,7 @@ class UniToken:
 
         # print(f"\033[92m {len(generated)} \033[0m")
 
-        outputs = save_image(generated, input_text, save_dir)
+        outputs = [response[1][0] for response in generated]
 
         return outputs
 
@@ -57,7 +49,7 @@ class UniToken:
 
         q1 = f"<|image|>{prompt}"
 
-        images = [Image.open(input_img).convert('RGB')]
+        images = [load_image(input_img)]
         qas = [[q1, None]]
 
         # `len(images)` should be equal to the number of appearance of "<|image|>" in qas
@@ -75,4 +67,23 @@ class UniToken:
         return a1
 
 
+    def understand_batch(self, input_img, prompts):
+
+        # load the image once for all questions
+        image = load_image(input_img)
+
+        answers = []
+        for prompt in prompts:
+            generated = self.inference_solver.generate(
+                images=[image],
+                qas=[[f"<|image|>{prompt}", None]],
+                max_gen_len=512,
+                temperature=1.0,
+                logits_processor=self.inference_solver.create_logits_processor(cfg=4.0, image_top_k=2000),
+            )
+            answers.append(generated[0])
+
+        return answers
+
+
 
@@ -178,24 +178,39 @@ class FlexARItemProcessor(MMConvItemProcessor):
 
             return input_tokens_item
 
-    def decode_image(self, tokens: List[int]) -> Image.Image:
+    def img_toks_from_bpe(self, tokens: List[int]):
         if tokens[0] == self.token2id(self.image_start_token):
             tokens = tokens[1:]
         if tokens[-1] == self.token2id(self.image_end_token):
             tokens = tokens[:-1]
 
         h_grids, w_grids = tokens[0] - 8804, tokens[1] - 8804
-        tokens = tokens[2:]
-        h, w = h_grids * self.patch_size, w_grids * self.patch_size
         h_latent_dim, w_latent_dim = h_grids * 2, w_grids * 2
 
-        for i in range(len(tokens)):
-            if (i + 1) % (w_latent_dim + 1) != 0:
-                tokens[i] = self.chameleon_ori_translation.bpe2img[tokens[i]]
-
-        assert len(tokens) == h_latent_dim * (w_latent_dim + 1)
-        tokens = torch.tensor(tokens, dtype=torch.int64).cuda()
+        assert len(tokens) - 2 == h_latent_dim * (w_latent_dim + 1)
+        tokens = torch.tensor(tokens[2:], dtype=torch.int64).cuda()
 
+        # drop the new line token ending each row, then translate bpe ids to image ids by the lookup table
         tokens = tokens.view(h_latent_dim, w_latent_dim + 1)[:, :-1].flatten()
+        tokens = self.chameleon_ori_translation.convert_bpe2img_dense(tokens)
 
-        return self.chameleon_ori_image_tokenizer.pil_from_img_toks(tokens, h_latent_dim, w_latent_dim)
+        return tokens, h_latent_dim, w_latent_dim
+
+    def decode_image(self, tokens: List[int]) -> Image.Image:
+        return self.decode_images([tokens])[0]
+
+    def decode_images(self, tokens_list: List[List[int]]) -> List[Image.Image]:
+        # images of the same size are decoded by the VQGAN in one batch
+        groups = {}
+        for i, tokens in enumerate(tokens_list):
+            img_toks, h_latent_dim, w_latent_dim = self.img_toks_from_bpe(tokens)
+            groups.setdefault((h_latent_dim, w_latent_dim), []).append((i, img_toks))
+
+        images = [None] * len(tokens_list)
+        for (h_latent_dim, w_latent_dim), group in groups.items():
+            img_toks = torch.stack([img_toks for _, img_toks in group])
+            pil_images = self.chameleon_ori_image_tokenizer.pils_from_img_toks(img_toks, h_latent_dim, w_latent_dim)
+            for (i, _), pil_image in zip(group, pil_images):
+                images[i] = pil_image
+
+        return images
@@ -1,6 +1,9 @@
 import argparse
+from collections import OrderedDict
 import copy
+import hashlib
 import math
+import os
 from typing import List, Optional, Union
 
 from PIL import Image
@@ -179,10 +182,11 @@ class MultiModalLogitsProcessor(LogitsProcessor):
         self.image_start_token_id = image_start_token_id
         self.image_end_token_id = image_end_token_id
         self.image_next_line_token_id = image_next_line_token_id
-        self.image_start_token_id_index = None
+        # the image boundaries of each returned sequence are tracked by its row index
+        self.image_start_token_id_index = {}
         self.patch_size = patch_size
-        self.h_latent_dim = None
-        self.w_latent_dim = None
+        self.h_latent_dim = {}
+        self.w_latent_dim = {}
 
         self.vocab_list = [i for i in range(voc_size)]
         self.image_token_list = [i for i in range(4, 8195 + 1)]
@@ -205,24 +209,29 @@ class MultiModalLogitsProcessor(LogitsProcessor):
 
     # @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        
-        self.num_image_start_tokens = (input_ids[0] == self.image_start_token_id).sum()
-        self.num_image_end_tokens = (input_ids[0] == self.image_end_token_id).sum()
+        return torch.cat(
+            [self.process_row(i, input_ids[i], scores[i : i + 1]) for i in range(input_ids.shape[0])], dim=0
+        )
+
+    def process_row(self, i, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+
+        self.num_image_start_tokens = (input_ids == self.image_start_token_id).sum()
+        self.num_image_end_tokens = (input_ids == self.image_end_token_id).sum()
 
         # print(self.num_image_start_tokens, self.num_image_end_tokens)
 
         if self.num_image_start_tokens == self.num_image_end_tokens:
-            self.h_latent_dim, self.w_latent_dim = None, None
-            self.image_start_token_id_index = None
+            self.h_latent_dim[i], self.w_latent_dim[i] = None, None
+            self.image_start_token_id_index[i] = None
             return scores
 
         elif self.num_image_start_tokens == self.num_image_end_tokens + 1:
-            if self.image_start_token_id_index is None:
-                self.image_start_token_id_index = torch.where(input_ids[0] == self.image_start_token_id)[0]
-                print(self.image_start_token_id_index)
-                self.image_start_token_id_index = torch.where(input_ids[0] == self.image_start_token_id)[0][-1].item()
+            if self.image_start_token_id_index.get(i) is None:
+                image_start_token_id_index = torch.where(input_ids == self.image_start_token_id)[0]
+                print(image_start_token_id_index)
+                self.image_start_token_id_index[i] = image_start_token_id_index[-1].item()
 
-            new_token_num = len(input_ids[0][self.image_start_token_id_index + 1 :])
+            new_token_num = len(input_ids[self.image_start_token_id_index[i] + 1 :])
             # print(f"num new tokens: {new_token_num}")
             ## Temporary Solution for Gaurantee Image Generation Success Rate
             if new_token_num < 2:   # Resolution Token Generation, Designated as 8820 (for 512x512 output resolution)
@@ -232,27 +241,28 @@ class MultiModalLogitsProcessor(LogitsProcessor):
                 return resolution_constrained_scores
 
             if new_token_num >= 2:
-                if self.h_latent_dim is None or self.w_latent_dim is None:
+                if self.h_latent_dim.get(i) is None or self.w_latent_dim.get(i) is None:
                     h_grids, w_grids = (
-                        input_ids[0][self.image_start_token_id_index + 1] - 8804,
-                        input_ids[0][self.image_start_token_id_index + 2] - 8804,
+                        input_ids[self.image_start_token_id_index[i] + 1] - 8804,
+                        input_ids[self.image_start_token_id_index[i] + 2] - 8804,
                     )
                     # print(f"h_grids: {h_grids}, w_grids: {w_grids}")
-                    self.h_latent_dim, self.w_latent_dim = h_grids * 2, w_grids * 2
-                    print(f"h_latent_dim: {self.h_latent_dim}, w_latent_dim: {self.w_latent_dim}")
+                    self.h_latent_dim[i], self.w_latent_dim[i] = h_grids * 2, w_grids * 2
+                    print(f"h_latent_dim: {self.h_latent_dim[i]}, w_latent_dim: {self.w_latent_dim[i]}")
+                h_latent_dim, w_latent_dim = self.h_latent_dim[i], self.w_latent_dim[i]
 
-                tokens = input_ids[0][self.image_start_token_id_index + 3 :]
-                if (len(tokens) + 1) % (self.w_latent_dim + 1) == 0:
+                tokens = input_ids[self.image_start_token_id_index[i] + 3 :]
+                if (len(tokens) + 1) % (w_latent_dim + 1) == 0:
                     new_line_constrained_scores = torch.full_like(scores, -math.inf)
                     new_line_constrained_scores[:, self.image_next_line_token_id] = 0
                     # print(f"new line: {len(tokens)+1}")
                     return new_line_constrained_scores
-                elif (len(tokens) + 1) == (self.w_latent_dim + 1) * self.h_latent_dim + 1:
+                elif (len(tokens) + 1) == (w_latent_dim + 1) * h_latent_dim + 1:
                     eos_image_constrained_scores = torch.full_like(scores, -math.inf)
                     eos_image_constrained_scores[:, self.image_end_token_id] = 0
                     # print(f"eos image: {len(tokens)+1}")
                     return eos_image_constrained_scores
-                elif (len(tokens) + 1) % (self.w_latent_dim + 1) != 0:
+                elif (len(tokens) + 1) % (w_latent_dim + 1) != 0:
                     image_constrained_scores = torch.where(self.suppress_token_mask, -float("inf"), scores)
                     return image_constrained_scores
         else:
@@ -295,15 +305,17 @@ class InterleavedTopKLogitsWarper(LogitsWarper):
     # @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
 
-        self.num_image_start_tokens = (input_ids[0] == self.image_start_token_id).sum()
-        self.num_image_end_tokens = (input_ids[0] == self.image_end_token_id).sum()
+        self.num_image_start_tokens = (input_ids == self.image_start_token_id).sum(dim=-1)
+        self.num_image_end_tokens = (input_ids == self.image_end_token_id).sum(dim=-1)
 
-        if self.num_image_start_tokens == self.num_image_end_tokens + 1:
-            top_k = min(self.image_top_k, scores.size(-1))
-        else:
-            top_k = min(self.text_top_k, scores.size(-1))  # Safety check
+        # rows inside an image use image_top_k, the others use text_top_k
+        top_k = torch.where(
+            self.num_image_start_tokens == self.num_image_end_tokens + 1, self.image_top_k, self.text_top_k
+        ).clamp(max=scores.size(-1))  # Safety check
+        max_top_k = min(max(self.image_top_k, self.text_top_k), scores.size(-1))
         # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = scores < torch.topk(scores, top_k)[0][..., -1, None]
+        top_k_scores = torch.topk(scores, max_top_k)[0].gather(-1, top_k[:, None] - 1)
+        indices_to_remove = scores < top_k_scores
         scores_processed = scores.masked_fill(indices_to_remove, self.filter_value)
         return scores_processed
 
@@ -317,7 +329,7 @@ class FlexARInferenceSolverAnyRes:
 
         return parser
 
-    def __init__(self, model_path, precision, target_size=512):
+    def __init__(self, model_path, precision, target_size=512, image_cache_size=8):
         self.dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
 
         self.model = ChameleonGenForConditionalGenerationBase.from_pretrained(
@@ -351,9 +363,190 @@ class FlexARInferenceSolverAnyRes:
         # self.vit.cuda().to(self.dtype)
         self.item_processor = FlexARItemProcessor(target_size=target_size)
 
+        # LRU cache of encoded images, so the questions about an image encode it only once
+        # each entry holds the VQ tokens and the continuous image feature (on GPU) of an image
+        self.image_cache = OrderedDict()
+        self.image_cache_size = image_cache_size
+        self.item_processor.transform["<|image|>"] = self.process_image
+
+    def get_image_cache(self, image: Image.Image | str):
+        """
+        Get the cache entry of an image, keyed by its content hash (or path and modification time for a path).
+        The least recently used entry is evicted when the cache is full.
+        """
+        if isinstance(image, Image.Image):
+            key = (image.mode, image.size, hashlib.sha1(image.tobytes()).hexdigest())
+        else:
+            key = (image, os.path.getmtime(image) if os.path.exists(image) else None)
+
+        if key in self.image_cache:
+            self.image_cache.move_to_end(key)
+        else:
+            self.image_cache[key] = {}
+            while len(self.image_cache) > self.image_cache_size:
+                self.image_cache.popitem(last=False)
+
+        return self.image_cache[key]
+
+    def process_image(self, image: Image.Image | str):
+        # the media dict is modified by process_item, return a copy of the cached one
+        entry = self.get_image_cache(image)
+        if "image_toks" not in entry:
+            entry["image_toks"] = self.item_processor.process_image(image)
+
+        return dict(entry["image_toks"])
+
+    @torch.no_grad()
+    def encode_image_feature(self, image: Image.Image):
+        entry = self.get_image_cache(image)
+        if "image_feature" in entry:
+            return entry["image_feature"]
+
+        image_tensor = process_images([image], self.vit_processor.image_processor, self.anyres_cfg)[0]
+        image_size = image.size
+        # vit_feat = self.vit(image_tensor.to(self.model.device).to(self.dtype), interpolate_pos_encoding=True).last_hidden_state
+        vit_feat = self.model.vit(image_tensor.to(self.model.device).to(self.dtype), interpolate_pos_encoding=True).last_hidden_state
+        image_feature = self.model.adapter(vit_feat)
+        eol_token = self.model.model.embed_tokens(torch.tensor(8803, dtype=torch.int64, device=self.model.device))
+
+        if image_feature.shape[0] > 1:
+            base_image_feature = image_feature[0]
+            image_feature = image_feature[1:]
+            # Recover 2D grid pinpoints
+            num_patch_width, num_patch_height = get_anyres_image_grid_shape(image_size, self.image_grid_pinpoints, self.model.vit.config.image_size)
+            height = width = self.model.vit.config.image_size // self.model.vit.config.patch_size
+            image_feature = image_feature.view(num_patch_height, num_patch_width, height, width, -1)
+            # Unpad image features
+            image_feature = image_feature.permute(4, 0, 2, 1, 3).contiguous()
+            image_feature = image_feature.flatten(1, 2).flatten(2, 3)
+            image_feature = unpad_image(image_feature, image_size)
+            image_feature = torch.cat((
+                image_feature,
+                eol_token[:, None, None].expand(*image_feature.shape[:-1], 1).to(self.model.device)
+            ), dim=-1)
+            image_feature = image_feature.flatten(1, 2).transpose(0, 1)
+            image_feature = torch.cat((base_image_feature, image_feature), dim=0)
+        else:
+            image_feature = image_feature[0]
+            image_feature = torch.cat((
+                image_feature,
+                eol_token[None].to(self.model.device)
+            ), dim=0)
+
+        entry["image_feature"] = image_feature
+        return image_feature
+
     def get_streamer(self):
         return TextStreamer(self.item_processor.tokenizer)
 
+    @torch.no_grad()
+    def sample_with_batched_cfg(
+        self,
+        prompt: torch.LongTensor,
+        generation_config: GenerationConfig,
+        logits_processor: LogitsProcessorList,
+        guidance_scale: float,
+        streamer=None,
+    ):
+        """
+        Sample `num_return_sequences` sequences of a prompt with classifier-free guidance, where the conditional and
+        unconditional rows of all sequences run in one batch with one forward per step.
+        Like the context of LLMImageStartTriggeredUnbatchedClassifierFreeGuidanceLogitsProcessor, the unconditional
+        row of a sequence only attends to the tokens from the start token of its current image, which is done by
+        masking the earlier positions out, so each sequence tracks its own image boundaries.
+        Returns the generated ids of each sequence without the prompt, cut after the first eos token.
+        """
+        image_start_id = self.item_processor.token2id(self.item_processor.image_start_token)
+        image_end_id = self.item_processor.token2id(self.item_processor.image_end_token)
+        eos_token_ids = set(generation_config.eos_token_id)
+        pad_token_id = generation_config.eos_token_id[0]
+        num = generation_config.num_return_sequences
+        prompt_len = prompt.shape[1]
+        max_length = min(prompt_len + generation_config.max_new_tokens, generation_config.max_length)
+
+        # the start position of the current image of each sequence, None out of images
+        prompt_ids = prompt[0].tolist()
+        image_start = None
+        if prompt_ids.count(image_start_id) == prompt_ids.count(image_end_id) + 1:
+            image_start = len(prompt_ids) - 1 - prompt_ids[::-1].index(image_start_id)
+        image_starts = [image_start] * num
+
+        # rows [0, num) are conditional and rows [num, 2 * num) are unconditional
+        input_ids = prompt.repeat(2 * num, 1)
+        attention_mask = torch.ones_like(input_ids)
+        if image_start is not None:
+            attention_mask[num:, :image_start] = 0
+        model_input_ids = input_ids
+        past_key_values = transformers.DynamicCache()
+        unfinished = [True] * num
+        if streamer is not None:
+            streamer.put(prompt.cpu())
+
+        while input_ids.shape[1] < max_length:
+            cur_len = input_ids.shape[1]
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -model_input_ids.shape[1] :]
+            outputs = self.model(
+                model_input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[:, -1].float()
+            scores, unconditional_logits = logits[:num], logits[num:]
+            del outputs
+
+            # guidance starts once the resolution tokens of an image are generated
+            guided = [start is not None and cur_len - start - 1 >= 2 for start in image_starts]
+            if guidance_scale != 1.0 and any(guided):
+                scores_processed = guidance_scale * (scores - unconditional_logits) + unconditional_logits
+                guided = torch.tensor(guided, device=scores.device)[:, None]
+                scores = torch.where(guided, scores_processed, scores)
+
+            scores = logits_processor(input_ids[:num], scores)
+            if generation_config.temperature is not None and generation_config.temperature != 1.0:
+                scores = scores / generation_config.temperature
+            if generation_config.do_sample:
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(scores, dim=-1)
+            next_tokens = torch.where(
+                torch.tensor(unfinished, device=next_tokens.device), next_tokens, pad_token_id
+            )
+
+            for i, token in enumerate(next_tokens.tolist()):
+                if not unfinished[i]:
+                    continue
+                if token == image_start_id:
+                    image_starts[i] = cur_len
+                    attention_mask[num + i, :cur_len] = 0
+                elif token == image_end_id:
+                    image_starts[i] = None
+                if token in eos_token_ids:
+                    unfinished[i] = False
+
+            model_input_ids = next_tokens.repeat(2)[:, None]
+            input_ids = torch.cat([input_ids, model_input_ids], dim=1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones(2 * num, 1)], dim=1)
+            if streamer is not None:
+                streamer.put(next_tokens.cpu())
+            if not any(unfinished):
+                break
+
+        if streamer is not None:
+            streamer.end()
+
+        generation_results = []
+        for generation_result in input_ids[:num, prompt_len:].tolist():
+            for j, token in enumerate(generation_result):
+                if token in eos_token_ids:
+                    generation_result = generation_result[: j + 1]
+                    break
+            generation_results.append(generation_result)
+
+        return generation_results
+
     @torch.no_grad()
     def generate_img(
         self,
@@ -364,7 +557,12 @@ class FlexARInferenceSolverAnyRes:
         logits_processor=None,
         streamer=None,
         num_return_sequences=1,
+        batched_cfg=True,
     ):
+        """
+        With `batched_cfg`, the CFG processor in `logits_processor` is replaced by sample_with_batched_cfg(), which
+        runs the conditional and unconditional sequences in one batch. Otherwise model.generate() is used.
+        """
 
         conversations = []
         for q, a in qas:
@@ -408,6 +606,33 @@ class FlexARInferenceSolverAnyRes:
         if logits_processor is None:
             logits_processor = self.create_logits_processor()
 
+        cfg_processors = [
+            processor for processor in logits_processor
+            if isinstance(processor, LLMImageStartTriggeredUnbatchedClassifierFreeGuidanceLogitsProcessor)
+        ]
+        if batched_cfg and len(cfg_processors) == 1:
+            logits_processor = LogitsProcessorList(
+                [processor for processor in logits_processor if processor not in cfg_processors]
+            )
+            with torch.cuda.amp.autocast(dtype=self.dtype):
+                generation_results = self.sample_with_batched_cfg(
+                    prompt,
+                    generation_config,
+                    logits_processor,
+                    cfg_processors[0].guidance_scale,
+                    streamer=streamer,
+                )
+                # the manually added tokens belong to the answer part as in the model.generate() path
+                forced_ids = prompt[0, prompt_len:].tolist()
+                generation_results = [forced_ids + generation_result for generation_result in generation_results]
+
+                for i, generation_result in enumerate(generation_results):
+                    if len(generation_result) > 0 and generation_result[-1] == 8710: # [eos] 8710
+                        generation_results[i] = generation_result[:-1]
+                decoded_results = self.decode_ids_batch(generation_results)
+
+            return decoded_results[0] if num_return_sequences == 1 else decoded_results
+
         if num_return_sequences == 1:
             with torch.cuda.amp.autocast(dtype=self.dtype):
                 generation_result = self.model.generate(
@@ -427,13 +652,12 @@ class FlexARInferenceSolverAnyRes:
                 generation_results = self.model.generate(
                     prompt, generation_config, logits_processor=logits_processor, streamer=streamer
                 )[:, prompt_len:].tolist()
-                decoded_results = []
 
-                for generation_result in generation_results:
+                for i, generation_result in enumerate(generation_results):
                     if len(generation_result) > 0 and generation_result[-1] == 8710: # [eos] 8710
-                        generation_result = generation_result[:-1]
-                    decoded_result = self.decode_ids(generation_result)
-                    decoded_results.append(decoded_result)    
+                        generation_results[i] = generation_result[:-1]
+                # images of all sequences are decoded in one batch
+                decoded_results = self.decode_ids_batch(generation_results)
         
             return decoded_results
 
@@ -484,37 +708,7 @@ class FlexARInferenceSolverAnyRes:
         else:
             # Generate continuous visual tokens
             assert len(images) == 1     # Only has 1 sample per-batch
-            image_tensor = process_images(images, self.vit_processor.image_processor, self.anyres_cfg)[0]
-            image_size = images[0].size
-            # vit_feat = self.vit(image_tensor.to(self.model.device).to(self.dtype), interpolate_pos_encoding=True).last_hidden_state
-            vit_feat = self.model.vit(image_tensor.to(self.model.device).to(self.dtype), interpolate_pos_encoding=True).last_hidden_state
-            image_feature = self.model.adapter(vit_feat)
-            eol_token = self.model.model.embed_tokens(torch.tensor(8803, dtype=torch.int64, device=self.model.device))
-
-            if image_feature.shape[0] > 1:
-                base_image_feature = image_feature[0]
-                image_feature = image_feature[1:]
-                # Recover 2D grid pinpoints
-                num_patch_width, num_patch_height = get_anyres_image_grid_shape(image_size, self.image_grid_pinpoints, self.model.vit.config.image_size)
-                height = width = self.model.vit.config.image_size // self.model.vit.config.patch_size
-                image_feature = image_feature.view(num_patch_height, num_patch_width, height, width, -1)
-                # Unpad image features
-                image_feature = image_feature.permute(4, 0, 2, 1, 3).contiguous()
-                image_feature = image_feature.flatten(1, 2).flatten(2, 3)
-                image_feature = unpad_image(image_feature, image_size)
-                image_feature = torch.cat((
-                    image_feature,
-                    eol_token[:, None, None].expand(*image_feature.shape[:-1], 1).to(self.model.device)
-                ), dim=-1)
-                image_feature = image_feature.flatten(1, 2).transpose(0, 1)
-                image_feature = torch.cat((base_image_feature, image_feature), dim=0)
-            else:
-                image_feature = image_feature[0]
-                image_feature = torch.cat((
-                    image_feature,
-                    eol_token[None].to(self.model.device)
-                ), dim=0)
-            continuous_tokens = image_feature
+            continuous_tokens = self.encode_image_feature(images[0])
 
             # Insert continuous tokens into discrete tokens
             # Use format of "<soi>[discrete_tokens]<sep>[continuous_tokens]<eoi>"
@@ -567,41 +761,51 @@ class FlexARInferenceSolverAnyRes:
                 generation_results = self.model.generate(
                     prompt, generation_config, logits_processor=logits_processor, streamer=streamer
                 )[:, prompt_len:].tolist()
-                decoded_results = []
 
-                for generation_result in generation_results:
+                for i, generation_result in enumerate(generation_results):
                     if len(generation_result) > 0 and generation_result[-1] == 8710: # [eos] 8710
-                        generation_result = generation_result[:-1]
-                    decoded_result = self.decode_ids(generation_result)
-                    decoded_results.append(decoded_result)    
+                        generation_results[i] = generation_result[:-1]
+                # images of all sequences are decoded in one batch
+                decoded_results = self.decode_ids_batch(generation_results)
         
             return decoded_results
 
-    def decode_ids(self, tokens: List[int]):
-        generated_images = []
-        generation_result_processed = []
+    def split_ids(self, tokens: List[int]):
+        """
+        Split generated ids into text ids, where each image is replaced by <|image|>, and the ids of each image.
+        An image without the end token is dropped with the ids after it.
+        """
+        image_start_id = self.item_processor.token2id(self.item_processor.image_start_token) # 8197
+        image_end_id = self.item_processor.token2id(self.item_processor.image_end_token) # 8196
+        text_ids, image_ids = [], []
         i = 0
-        while i < len(tokens):
-            token_id = tokens[i]
-            if token_id == self.item_processor.token2id(self.item_processor.image_start_token): # 8197
-                cache = []
-                for j in range(i + 1, len(tokens)):
-                    if tokens[j] != self.item_processor.token2id(self.item_processor.image_end_token): # 8196
-                        cache.append(tokens[j])
-                        i = j + 1
-                    else:
-                        image = self.decode_image(cache)
-                        generated_images.append(image)
-                        generation_result_processed.append(self.item_processor.token2id("<|image|>"))
-                        i = j + 1
-                        break
-            else:
-                generation_result_processed.append(token_id)
-                i += 1
+        while image_start_id in tokens[i:]:
+            start = tokens.index(image_start_id, i)
+            text_ids += tokens[i:start]
+            if image_end_id not in tokens[start + 1:]:
+                return text_ids, image_ids
+            end = tokens.index(image_end_id, start + 1)
+            image_ids.append(tokens[start + 1:end])
+            text_ids.append(self.item_processor.token2id("<|image|>"))
+            i = end + 1
+        text_ids += tokens[i:]
+
+        return text_ids, image_ids
+
+    def decode_ids(self, tokens: List[int]):
+        return self.decode_ids_batch([tokens])[0]
+
+    def decode_ids_batch(self, tokens_list: List[List[int]]):
+        splits = [self.split_ids(tokens) for tokens in tokens_list]
+        images = self.item_processor.decode_images([ids for _, image_ids in splits for ids in image_ids])
 
-        generated = self.item_processor.tokenizer.decode(generation_result_processed)
+        decoded_results = []
+        for text_ids, image_ids in splits:
+            generated = self.item_processor.tokenizer.decode(text_ids)
+            decoded_results.append((generated, images[:len(image_ids)]))
+            images = images[len(image_ids):]
 
-        return generated, generated_images
+        return decoded_results
 
     def decode_image(self, tokens: List[int]):
         return self.item_processor.decode_image(tokens)
@@ -120,6 +120,15 @@ class ImageTokenizer:
         pixels = self._vq_model.decode(codebook_entry)
         return self._pil_from_chw_tensor(pixels[0])
 
+    def pils_from_img_toks(self, tokens: torch.Tensor, h_latent_dim=32, w_latent_dim=32) -> list[PIL.Image]:
+        # decode a batch of images of the same size in one call, tokens: (batch, h_latent_dim * w_latent_dim)
+        emb_dim = self._vq_model.quantize.embedding.weight.shape[-1]
+        codebook_entry = self._vq_model.quantize.get_codebook_entry(
+            tokens.flatten(), (tokens.shape[0], h_latent_dim, w_latent_dim, emb_dim)
+        )
+        pixels = self._vq_model.decode(codebook_entry)
+        return [self._pil_from_chw_tensor(chw_tensor) for chw_tensor in pixels]
+
     def latent_embedding_from_pil(self, img: PIL.Image):
         img = self._whiten_transparency(img)
 
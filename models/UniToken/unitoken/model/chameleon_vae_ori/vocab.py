@@ -88,6 +88,16 @@ class VocabTranslation:
         sorted_img = torch.tensor(sorted(self.bpe2img.values()), device=self._device)
         return sorted_bpe, sorted_img
 
+    @cached_property
+    def bpe2img_mapping_tensor(self) -> torch.LongTensor:
+        mapping = torch.zeros(
+            max(self.bpe2img.keys()) + 1,
+            dtype=torch.int64,
+            device=self._device,
+        )
+        mapping[torch.tensor(list(self.bpe2img.keys()))] = torch.tensor(list(self.bpe2img.values()), device=self._device)
+        return mapping
+
     @cached_property
     def img2bpe_mapping_tensor(self) -> torch.LongTensor:
         mapping = torch.zeros(
@@ -103,5 +113,8 @@ class VocabTranslation:
         bpe_tok, img_tok = self.bpe2img_search_tensors
         return img_tok[torch.searchsorted(bpe_tok, bpe_batch)]
 
+    def convert_bpe2img_dense(self, bpe_batch: torch.Tensor) -> torch.Tensor:
+        return self.bpe2img_mapping_tensor[bpe_batch]
+
     def convert_img2bp2(self, img_batch: torch.Tensor) -> torch.Tensor:
         return self.img2bpe_mapping_tensor[img_batch]
@@ -0,0 +1,39 @@
+from argparse import ArgumentParser
+import json
+import pickle
+
+from tqdm import tqdm
+
+from xllmx.data.pretokenized import PretokenizedWriter
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="record file produced by concat_record.py",
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--items_per_shard",
+        type=int,
+        default=100000,
+    )
+    args = parser.parse_args()
+
+    with open(args.record) as f:
+        record = json.load(f)
+
+    print(f"pack {len(record)} items of {args.record} into {args.out_dir}")
+
+    with PretokenizedWriter(args.out_dir, items_per_shard=args.items_per_shard) as writer:
+        for record_item in tqdm(record):
+            with open(record_item["file"], "rb") as f:
+                item = pickle.load(f)
+            tokens, labels = item.pop("token"), item.pop("label")
+            writer.write(tokens, labels, **item)
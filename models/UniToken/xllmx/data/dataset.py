@@ -1,4 +1,6 @@
+import bisect
 import copy
+from itertools import accumulate
 import json
 import logging
 import os
@@ -15,6 +17,7 @@ from torch.utils.data import Dataset
 import yaml
 
 from .item_processor import ItemProcessorBase
+from .pretokenized import PretokenizedRecord, is_pretokenized
 
 logger = logging.getLogger(__name__)
 
@@ -41,8 +44,11 @@ class FinetuneConversationDataset(Dataset):
             cache_dir = None
             self.meta_collection, self.annotations_collection = self._collect_annotations()
 
+        # cumulative lengths of the metas for locating an index by bisection
+        self.cum_lens = list(accumulate([_["len"] for _ in self.meta_collection]))
+
     def __len__(self):
-        return sum([_["len"] for _ in self.meta_collection])
+        return self.cum_lens[-1] if self.cum_lens else 0
 
     def _collect_annotations(self):
         meta_collection = []
@@ -61,7 +67,15 @@ class FinetuneConversationDataset(Dataset):
 
         meta_path, meta_type = meta["path"], meta["type"]
         meta_ext = os.path.splitext(meta_path)[-1]
-        if meta_ext == ".json":
+        if is_pretokenized(meta_path):
+            # items are read from the memory-mapped token arrays written by PretokenizedWriter
+            annotations = PretokenizedRecord(meta_path)
+            meta["pretokenized"] = True
+            meta["len"] = len(annotations)
+            meta["item_len_list"] = annotations.lengths().tolist()
+            logger.info(f"{meta_path}, type{meta_type}: len {len(annotations)} (pre-tokenized)")
+            return meta, annotations
+        elif meta_ext == ".json":
             with open(meta_path) as f:
                 annotations = json.load(f)
         elif meta_ext == ".jsonl":
@@ -117,6 +131,9 @@ class FinetuneConversationDataset(Dataset):
         with h5py.File(Path(cache_dir) / "data.h5", "w") as file:
             dt = h5py.vlen_dtype(str)
             for i, annotations in enumerate(annotations_collection):
+                if isinstance(annotations, PretokenizedRecord):
+                    # already on disk, reopened from meta["path"]
+                    continue
                 serialized_ann = [json.dumps(_) for _ in annotations]
                 h5_ann = file.create_dataset(f"ann{i}", (len(serialized_ann),), dtype=dt)
                 h5_ann[:] = serialized_ann
@@ -143,12 +160,18 @@ class FinetuneConversationDataset(Dataset):
             sleep(1)
         cache_file = h5py.File(Path(cache_dir) / "data.h5", "r")
         meta_collection = json.loads(cache_file["meta_collection"].asstr()[()])
-        annotations_collection = [cache_file[f"ann{i}"] for i in range(len(meta_collection))]
+        annotations_collection = [
+            PretokenizedRecord(meta["path"]) if meta.get("pretokenized", False) else cache_file[f"ann{i}"]
+            for i, meta in enumerate(meta_collection)
+        ]
         return meta_collection, annotations_collection
 
     def get_item_func(self, meta_idx, idx_in_meta):
         data_item = self.annotations_collection[meta_idx][idx_in_meta]
-        if self.cache_on_disk:
+        if self.meta_collection[meta_idx].get("pretokenized", False):
+            # a new dict for each read, no need to copy
+            pass
+        elif self.cache_on_disk:
             data_item = json.loads(data_item)
         else:
             data_item = copy.deepcopy(data_item)
@@ -156,25 +179,14 @@ class FinetuneConversationDataset(Dataset):
         return self.item_processor.process_item(data_item, training_mode=True)
 
     def tie_index_to_meta(self, idx: int):
-        # Initialize the starting index
-        start_idx = 0
-
-        # Iterate through the list of dictionaries
-        for i, meta in enumerate(self.meta_collection):
-            # Calculate the ending index for the current collection
-            end_idx = start_idx + meta["len"]
-
-            # Check if the given index falls within the current collection
-            if start_idx <= idx < end_idx:
-                # Calculate the new index within the current collection
-                new_index = idx - start_idx
-                return i, new_index
-
-            # Update the starting index for the next collection
-            start_idx = end_idx
-
-        # If the index is out of range of all collections, raise an error
-        raise IndexError("Index out of range")
+        if not 0 <= idx < len(self):
+            # If the index is out of range of all collections, raise an error
+            raise IndexError("Index out of range")
+
+        # the first collection that ends after the given index
+        i = bisect.bisect_right(self.cum_lens, idx)
+        start_idx = self.cum_lens[i - 1] if i > 0 else 0
+        return i, idx - start_idx
 
     def __getitem__(self, index):
         meta_idx, idx_in_meta = self.tie_index_to_meta(index)
@@ -0,0 +1,127 @@
+import bisect
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+TOKEN_DTYPE = np.int32
+
+
+def is_pretokenized(path) -> bool:
+    return (Path(path) / INDEX_FILE).exists()
+
+
+class PretokenizedWriter:
+    """
+    Write pre-tokenized items into shards of flat token / label arrays. Each shard consists of
+    `{name}.tokens.bin` and `{name}.labels.bin` (int32), `{name}.offsets.npy` (int64, number of items + 1)
+    and `{name}.items.json` with the other fields of each item (e.g. "id", "raw_image").
+    `index.json` lists the shards and is written on close, so a directory with it is complete.
+    """
+
+    def __init__(self, out_dir, items_per_shard=100000):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.items_per_shard = items_per_shard
+        self.shards = []
+        self._open_shard()
+
+    def _open_shard(self):
+        self.name = f"shard_{len(self.shards):05d}"
+        self.token_file = open(self.out_dir / f"{self.name}.tokens.bin", "wb")
+        self.label_file = open(self.out_dir / f"{self.name}.labels.bin", "wb")
+        self.offsets = [0]
+        self.items = []
+
+    def _close_shard(self):
+        self.token_file.close()
+        self.label_file.close()
+        np.save(self.out_dir / f"{self.name}.offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        with open(self.out_dir / f"{self.name}.items.json", "w") as f:
+            json.dump(self.items, f)
+        self.shards.append({"name": self.name, "num_items": len(self.items), "num_tokens": self.offsets[-1]})
+
+    def write(self, tokens, labels, **fields):
+        assert len(tokens) == len(labels)
+        if len(self.items) >= self.items_per_shard:
+            self._close_shard()
+            self._open_shard()
+        self.token_file.write(np.asarray(tokens, dtype=TOKEN_DTYPE).tobytes())
+        self.label_file.write(np.asarray(labels, dtype=TOKEN_DTYPE).tobytes())
+        self.offsets.append(self.offsets[-1] + len(tokens))
+        self.items.append(fields)
+
+    def close(self):
+        self._close_shard()
+        with open(self.out_dir / INDEX_FILE, "w") as f:
+            json.dump({"dtype": np.dtype(TOKEN_DTYPE).name, "shards": self.shards}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class PretokenizedRecord:
+    """
+    Read-only sequence over a directory written by PretokenizedWriter. Items are dicts with "token" and "label"
+    lists, read from memory-mapped shards, plus the other fields written with them. The shard of an item is
+    found by bisecting the cumulative item counts, and the shards are mapped lazily in each process.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(Path(path) / INDEX_FILE) as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        self.shards = index["shards"]
+        self.cum_items = np.cumsum([shard["num_items"] for shard in self.shards]).tolist()
+        self._maps = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_maps"] = {}
+        return state
+
+    def __len__(self):
+        return self.cum_items[-1] if self.cum_items else 0
+
+    def _shard(self, shard_idx):
+        if shard_idx not in self._maps:
+            name = os.path.join(self.path, self.shards[shard_idx]["name"])
+            num_tokens = self.shards[shard_idx]["num_tokens"]
+
+            def load_tokens(kind):
+                if num_tokens == 0:
+                    return np.zeros(0, dtype=self.dtype)
+                return np.memmap(f"{name}.{kind}.bin", dtype=self.dtype, mode="r", shape=(num_tokens,))
+
+            with open(f"{name}.items.json") as f:
+                items = json.load(f)
+            offsets = np.load(f"{name}.offsets.npy", mmap_mode="r")
+            self._maps[shard_idx] = (load_tokens("tokens"), load_tokens("labels"), offsets, items)
+        return self._maps[shard_idx]
+
+    def lengths(self) -> np.ndarray:
+        """Token length of every item, without reading the tokens."""
+        if len(self.shards) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.diff(self._shard(i)[2]) for i in range(len(self.shards))])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Index out of range")
+        shard_idx = bisect.bisect_right(self.cum_items, idx)
+        idx_in_shard = idx - (self.cum_items[shard_idx - 1] if shard_idx > 0 else 0)
+        tokens, labels, offsets, items = self._shard(shard_idx)
+        start, end = int(offsets[idx_in_shard]), int(offsets[idx_in_shard + 1])
+        item = dict(items[idx_in_shard])
+        item["token"] = tokens[start:end].tolist()
+        item["label"] = labels[start:end].tolist()
+        return item
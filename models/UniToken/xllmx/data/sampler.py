@@ -1,6 +1,6 @@
 from collections import defaultdict
 import logging
-from typing import Iterator, List, Optional
+from typing import Iterator, Optional
 
 import numpy as np
 from torch.utils.data import Sampler
@@ -10,41 +10,31 @@ from xllmx.data.dataset import FinetuneConversationDataset
 logger = logging.getLogger(__name__)
 
 
-# todo too slow to be used
-def mild_shuffle(items: List, shuffle_factor, engine: np.random.Generator):
+def mild_shuffle(items: np.ndarray, shuffle_factor, engine: np.random.Generator):
     """
-    Perform a mild shuffle on the list of items.
+    Perform a mild shuffle on the array of items in O(n), no item moves further than len(items) * shuffle_factor.
 
     Args:
         engine: random engine
-        items (list): The list of items to shuffle.
+        items (np.ndarray): The array of items to shuffle.
         shuffle_factor (float): max swap range is computed as len(item) * shuffle_factor.
 
     Returns:
-        list: The mildly shuffled list.
+        np.ndarray: The mildly shuffled array.
     """
 
     n = len(items)
     swap_range = int(shuffle_factor * n)
-    shuffled_items = [None for _ in items]
-    cache = list(range(swap_range))
-    for i in range(n):
-        if i + swap_range < n:
-            cache.append(i + swap_range)
-        if len(cache) == 0 or cache[0] != i:  # already swapped
-            assert shuffled_items[i] is not None
-            continue
-        else:
-            cache = cache[1:]
-            if len(cache) == 0:
-                shuffled_items[i] = items[i]
-            else:
-                cache_idx = engine.integers(low=0, high=len(cache))
-                j = cache[cache_idx]
-                del cache[cache_idx]
-                shuffled_items[i], shuffled_items[j] = items[j], items[i]
+    if swap_range <= 1:
+        return items.copy()
+    # shuffle within windows of swap_range items, the windows start at a random offset
+    offset = engine.integers(low=0, high=swap_range)
+    n_windows = (offset + n + swap_range - 1) // swap_range
+    positions = np.full(n_windows * swap_range, -1, dtype=np.int64)
+    positions[offset : offset + n] = np.arange(n)
+    positions = engine.permuted(positions.reshape(n_windows, swap_range), axis=1).reshape(-1)
 
-    return shuffled_items
+    return items[positions[positions >= 0]]
 
 
 class FinetuneDistSampler(Sampler):
@@ -59,6 +49,7 @@ class FinetuneDistSampler(Sampler):
         acc_grad=1,
         length_clustering=True,
         allow_mixed_task_among_acc=False,
+        mild_shuffle_factor=None,
     ):
         """
         Distributed Sampler ensuring data in a batch are of the same type (e.g. text, image-text)
@@ -71,6 +62,8 @@ class FinetuneDistSampler(Sampler):
         :param acc_grad:
         :param length_clustering:
         :param allow_mixed_task_among_acc:
+        :param mild_shuffle_factor: with length_clustering, mildly shuffle items within this fraction of a group
+            instead of shuffling them among neighboring batches
         """
         # super().__init__()
 
@@ -87,6 +80,7 @@ class FinetuneDistSampler(Sampler):
         self.acc_grad = acc_grad
         self.length_clustering = length_clustering
         self.allow_mixed_task_among_acc = allow_mixed_task_among_acc
+        self.mild_shuffle_factor = mild_shuffle_factor
 
         self.epoch = 0
         self.start_iter = 0
@@ -108,7 +102,8 @@ class FinetuneDistSampler(Sampler):
         global_bsz_acc = self.batch_size * self.num_replicas * self.acc_grad
         rng = np.random.default_rng(self.seed + self.epoch)
 
-        group_indices_and_len = defaultdict(list)
+        group_indices = defaultdict(list)
+        group_lens = defaultdict(list)
 
         # Initialize the starting index
         start_idx = 0
@@ -117,85 +112,77 @@ class FinetuneDistSampler(Sampler):
         for i, meta in enumerate(self.dataset.meta_collection):
             # Calculate the ending index for the current collection
             end_idx = start_idx + meta["len"]
-            indices = list(range(start_idx, end_idx))
-            assert len(indices) == len(meta["item_len_list"])
-            indices_and_len = [[idx, length] for idx, length in zip(indices, meta["item_len_list"])]
+            indices = np.arange(start_idx, end_idx)
+            lens = np.asarray(meta["item_len_list"], dtype=np.int64)
+            assert len(indices) == len(lens)
             if meta.get("ratio", 1.0) != 1.0:
-                indices_and_len = list(rng.choice(indices_and_len, int(meta["len"] * meta["ratio"]), replace=False))
-                logger.info(f"meta{i}: sample (ratio = {meta['ratio']}) {len(indices_and_len)} items")
-            group_indices_and_len[meta["type"]].extend(indices_and_len)
+                # the same draws as choosing rows of an [idx, length] array
+                chosen = rng.choice(len(indices), int(meta["len"] * meta["ratio"]), replace=False)
+                indices, lens = indices[chosen], lens[chosen]
+                logger.info(f"meta{i}: sample (ratio = {meta['ratio']}) {len(indices)} items")
+            group_indices[meta["type"]].append(indices)
+            group_lens[meta["type"]].append(lens)
 
             # Update the starting index for the next collection
             start_idx = end_idx
 
-        for group_name, indices_and_len in group_indices_and_len.items():
-            group_indices_and_len[group_name] = indices_and_len[
-                : len(indices_and_len) // global_bsz_acc * global_bsz_acc
-            ]
+        for group_name in group_indices:
+            indices = np.concatenate(group_indices[group_name])
+            lens = np.concatenate(group_lens[group_name])
+            group_len = len(indices) // global_bsz_acc * global_bsz_acc
+            group_indices[group_name], group_lens[group_name] = indices[:group_len], lens[:group_len]
 
         if self.shuffle:
-            group_indices = {}
             if self.length_clustering:
-                for group_name, indices_and_len in group_indices_and_len.items():
-                    indices_and_len.sort(key=lambda x: x[1])
-                    group_indices[group_name] = [_[0] for _ in indices_and_len]
-
-                # option1: shuffle among neighboring items
                 for group_name, indices in group_indices.items():
-                    result = []
-                    for pos in range(0, len(indices), global_batch_size * 500):
-                        sublist = indices[pos : pos + global_batch_size * 500]
-                        rng.shuffle(sublist)
-                        result.extend(sublist)
-                    group_indices[group_name] = result
-                # option2: mild shuffle
-                #     group_indices[group_name] = mild_shuffle(indices, 0.1, rng)
+                    # stable, like sorting [idx, length] pairs by length
+                    indices = indices[np.argsort(group_lens[group_name], kind="stable")]
+                    if self.mild_shuffle_factor is None:
+                        # option1: shuffle among neighboring items
+                        for pos in range(0, len(indices), global_batch_size * 500):
+                            rng.shuffle(indices[pos : pos + global_batch_size * 500])
+                    else:
+                        # option2: mild shuffle
+                        indices = mild_shuffle(indices, self.mild_shuffle_factor, rng)
+                    group_indices[group_name] = indices
                 # option3: do nothing
                 # pass
             else:
-                for group_name, indices_and_len in group_indices_and_len.items():
-                    rng.shuffle(indices_and_len)
-                    group_indices[group_name] = [_[0] for _ in indices_and_len]
+                for group_name, indices in group_indices.items():
+                    rng.shuffle(indices)
 
-            del group_indices_and_len
+            del group_lens
 
+            # each row is a global batch, or acc_grad global batches of the same group
             if self.allow_mixed_task_among_acc:
-                global_batched_indices = [
-                    indices[i : i + global_batch_size]
-                    for group_name, indices in group_indices.items()
-                    for i in range(0, len(indices), global_batch_size)
-                ]
+                global_batched_indices = np.concatenate(
+                    [indices.reshape(-1, global_batch_size) for indices in group_indices.values()]
+                )
             else:
                 global_batched_indices = []
                 for group_name, indices in group_indices.items():
-                    group_batched_indices = [
-                        indices[i : i + global_batch_size] for i in range(0, len(indices), global_batch_size)
-                    ]
+                    group_batched_indices = indices.reshape(-1, global_batch_size)
                     rng.shuffle(group_batched_indices)
-                    group_batched_indices = [
-                        sum(group_batched_indices[i : i + self.acc_grad], start=[])
-                        for i in range(0, len(group_batched_indices), self.acc_grad)
-                    ]
-                    global_batched_indices.extend(group_batched_indices)
+                    global_batched_indices.append(group_batched_indices.reshape(-1, global_bsz_acc))
+                global_batched_indices = np.concatenate(global_batched_indices)
             rng.shuffle(global_batched_indices)
-            indices = [_ for batch_indices in global_batched_indices for _ in batch_indices]
+            indices = global_batched_indices.reshape(-1)
         else:
             raise NotImplementedError()
 
         assert len(indices) == self.total_size
 
-        own_indices = []
-        for start_pos in range(self.rank * self.batch_size, len(indices), self.num_replicas * self.batch_size):
-            own_indices += indices[start_pos : start_pos + self.batch_size]
+        # the rank-th batch of each global batch
+        own_indices = indices.reshape(-1, self.num_replicas, self.batch_size)[:, self.rank].reshape(-1)
         # subsample
         assert len(own_indices) == self.num_samples
 
         if self.start_iter * self.batch_size > len(own_indices):
-            own_indices = []
+            own_indices = own_indices[:0]
         else:
             own_indices = own_indices[self.start_iter * self.batch_size :]
 
-        return iter(own_indices)
+        return iter(own_indices.tolist())
 
     def __len__(self) -> int:
         return self.num_samples
@@ -196,6 +196,13 @@ class FinetuneSolverBase(ABC):
             help="gather items with similar length to the same batch",
         )
         parser.add_argument("--disable_length_clustering", action="store_false", dest="length_clustering")
+        parser.add_argument(
+            "--mild_shuffle_factor",
+            default=None,
+            type=float,
+            help="with length clustering, mildly shuffle items within this fraction of a group "
+            "instead of shuffling them among neighboring batches",
+        )
         parser.add_argument("--num_workers", default=8, type=int)
         parser.add_argument(
             "--pin_mem",
@@ -435,6 +442,7 @@ class FinetuneSolverBase(ABC):
             acc_grad=self.args.accum_iter,
             seed=self.args.seed,
             length_clustering=self.args.length_clustering,
+            mild_shuffle_factor=self.args.mild_shuffle_factor,
         )
         dataloader_train = torch.utils.data.DataLoader(
             dataset_train,
@@ -1,8 +1,6 @@
 import argparse
 import numpy as np
-import os
 import torch
-import string
 from PIL import Image
 import requests
 import sys
@@ -30,31 +28,31 @@ class VARGPT:
         self.processor = VARGPTLlavaProcessor.from_pretrained(model_id)
 
     def generate(self, input_text, img_num, save_dir):
-        os.makedirs(save_dir, exist_ok=True)
-        outputs = []
-        trans = str.maketrans(' ', '-', string.punctuation)
-        save_prompt = input_text.translate(trans)
-
+        conversation = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"Please design a drawing of {input_text}"},
+                ],
+            },
+        ]
+        prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
 
-        for i in range(img_num):
-            outputs.append(os.path.join(save_dir, f"image_{i}.png"))
+        # the prompt is decoded once and all images are generated in one pass over the VAR scales
+        inputs = self.processor(text=prompt, return_tensors='pt').to(0, torch.float32)
+        recon_B3HW = self.model.generate_images(
+            inputs['input_ids'],
+            inputs['attention_mask'],
+            num_images=img_num,
+            max_new_tokens=1000)
 
-            conversation = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": f"Please design a drawing of {input_text}"},
-                    ],
-                },
-            ]
-            prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
+        if recon_B3HW is None:
+            return [''] * img_num
 
-            inputs = self.processor(text=prompt, return_tensors='pt').to(0, torch.float32)
-            self.model._IMAGE_GEN_PATH = os.path.join(save_dir, f"image_{i}.png")
-            output = self.model.generate(
-                **inputs,
-                max_new_tokens=1000,
-                do_sample=False)
+        outputs = []
+        for img in recon_B3HW:
+            img = img.permute(1, 2, 0).mul(255).cpu().numpy()
+            outputs.append(Image.fromarray(img.astype(np.uint8)))
 
         return outputs
 
@@ -73,8 +71,9 @@ class VARGPT:
         ]
         prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
 
+        # generated images are passed in memory, saved images by path
         try:
-            raw_image = Image.open(input_img)
+            raw_image = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
         except:
             return ''
 
@@ -90,5 +89,39 @@ class VARGPT:
         # print(f"\033[92m {ans} \033[0m")
         return f"({ans})"
 
+    def understand_batch(self, input_img, prompts):
+
+        # the question comes before the image in VARGPT's template, so there is no shared
+        # prefix to reuse, load the image once and answer all questions in one batched generate
+        conversations = [
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image"},
+                    ],
+                },
+            ]
+            for prompt in prompts
+        ]
+        texts = [self.processor.apply_chat_template(conversation, add_generation_prompt=True) for conversation in conversations]
+
+        try:
+            raw_image = input_img if isinstance(input_img, Image.Image) else Image.open(input_img)
+        except:
+            return [''] * len(prompts)
+
+        self.processor.tokenizer.padding_side = 'left'
+        inputs = self.processor(images=[raw_image] * len(prompts), text=texts, padding=True, return_tensors='pt').to(0, torch.bfloat16)
+
+        output = self.model.generate(
+            **inputs,
+            max_new_tokens=512,
+            do_sample=False)
+
+        convs = self.processor.batch_decode(output, skip_special_tokens=True)
+        return [f"({conv.split('ASSISTANT: ')[-1]})" for conv in convs]
+
 
 
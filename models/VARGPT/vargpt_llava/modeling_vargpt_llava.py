@@ -23,6 +23,7 @@ import torch.utils.checkpoint
 from torch import nn
 
 from transformers.activations import ACT2FN
+from transformers.cache_utils import DynamicCache
 import PIL.Image as PImage, PIL.ImageDraw as PImageDraw
 import numpy as np
 import torchvision
@@ -671,66 +672,13 @@ class VARGPTLlavaForConditionalGeneration(LlavaPreTrainedModel, GenerationMixin)
         if inference_image_gen:
             B = input_ids.shape[0]
             assert B==1, "batch size must be 1 for inference"
-            # sos = cond_BD = self.vargpt_gen.class_emb(torch.cat((input_ids[0], torch.full_like(input_ids[0], fill_value=self.config.special_tokens['image_gen_start_token_id'] +1)), dim=0)) # torch.Size([2, 1, 3584])
-            sos = cond_BD = self.vargpt_gen.class_emb(torch.cat((torch.full_like(input_ids[0], fill_value=self.config.special_tokens['image_gen_start_token_id'] +1), torch.full_like(input_ids[0], fill_value=self.config.special_tokens['image_gen_start_token_id'] +1)), dim=0)) # torch.Size([2, 1, 3584])
-            lvl_pos = self.vargpt_gen.lvl_embed(self.vargpt_gen.lvl_1L) + self.vargpt_gen.pos_1LC
-            next_token_map = sos.unsqueeze(1).expand(2 * B, self.vargpt_gen.first_l, -1) + self.vargpt_gen.pos_start.expand(2 * B, self.vargpt_gen.first_l, -1) + lvl_pos[:, :self.vargpt_gen.first_l]
-            cur_L = 0
-            f_hat = sos.new_zeros(B, self.vargpt_gen.Cvae, self.vargpt_gen.patch_nums[-1], self.vargpt_gen.patch_nums[-1])
-
-            next_token_map = self.image_gen_projector(next_token_map).view(-1, next_token_map.shape[1], self.config.hidden_size)
-
-            top_k, top_p = 900, 0.96
-            cfg = 1.5
-            more_smooth = False
-            self.vargpt_gen.set_kv_caching(True)
-            for si, pn in enumerate(self.vargpt_gen.patch_nums):   # si: i-th segment
-                ratio = si / self.vargpt_gen.num_stages_minus_1
-                cur_L += pn*pn
-                cond_BD_or_gss = self.vargpt_gen.shared_ada_lin(cond_BD)
-                x = next_token_map[:B] # 
-               
-                outputs = self.language_model(
-                    attention_mask = None, 
-                    position_ids=None,
-                    past_key_values=past_key_values,
-                    inputs_embeds=x,
-                    use_cache=use_cache,
-                    output_attentions=output_attentions,
-                    output_hidden_states=True,
-                    return_dict=return_dict,
-                    cache_position=None,
-                    num_logits_to_keep=num_logits_to_keep,
-                )
-
-                hidden_states = outputs.hidden_states[-1]
-                # cfg
-                gaussian_noise = torch.randn(B, hidden_states.shape[1], hidden_states.shape[2], device=hidden_states.device, dtype=hidden_states.dtype)  # 保持设备一致
-                hidden_states = torch.cat([hidden_states, gaussian_noise], dim=0)  # [2*B, num, num2]
-
-                encoded_x = self.image_gen_projector_out(hidden_states).view(hidden_states.shape[0], hidden_states.shape[1], self.vargpt_gen.C)
-                logits_BlV = self.vargpt_gen.forward_inference(encoded_x, cond_BD_or_gss, cond_BD)
-
-                t = cfg * ratio
-                logits_BlV = (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
-        
-                idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=None, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
-                if not more_smooth: # this is the default case
-                    h_BChw = self.vargpt_gen.vae_quant_proxy[0].embedding(idx_Bl)   # B, l, Cvae
-                else:   # not used when evaluating FID/IS/Precision/Recall
-                    gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)   # refer to mask-git
-                    h_BChw = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=None) @ self.vargpt_gen.vae_quant_proxy[0].embedding.weight.unsqueeze(0)
-                
-                h_BChw = h_BChw.transpose_(1, 2).reshape(B, self.vargpt_gen.Cvae, pn, pn)
-                f_hat, next_token_map = self.vargpt_gen.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.vargpt_gen.patch_nums), f_hat, h_BChw)
-                if si != self.vargpt_gen.num_stages_minus_1:   # prepare for next stage
-                    next_token_map = next_token_map.view(B, self.vargpt_gen.Cvae, -1).transpose(1, 2)
-                    next_token_map = self.vargpt_gen.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + self.vargpt_gen.patch_nums[si+1] ** 2]
-                    next_token_map = self.image_gen_projector(next_token_map).view(-1, next_token_map.shape[1], self.config.hidden_size)
-                    next_token_map = next_token_map.repeat(2, 1, 1)   # double the batch sizes due to CFG
-            self.vargpt_gen.set_kv_caching(False)
-            
-            recon_B3HW = self.vargpt_gen.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)   # de-normalize, from [-1, 1] to [0, 1]
+            recon_B3HW, outputs = self.autoregressive_infer_image(
+                past_key_values, B,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                return_dict=return_dict,
+                num_logits_to_keep=num_logits_to_keep,
+            )
             chw = torchvision.utils.make_grid(recon_B3HW, nrow=8, padding=0, pad_value=1.0)
             chw = chw.permute(1, 2, 0).mul_(255).cpu().numpy()
             chw = PImage.fromarray(chw.astype(np.uint8))
@@ -800,6 +748,134 @@ class VARGPTLlavaForConditionalGeneration(LlavaPreTrainedModel, GenerationMixin)
             attentions=outputs.attentions,
             image_hidden_states=image_features if pixel_values is not None else None,
         )
+    @torch.no_grad()
+    def autoregressive_infer_image(self, past_key_values, B=1, top_k=900, top_p=0.96, cfg=1.5, more_smooth=False,
+                                   use_cache=True, output_attentions=None, return_dict=True, num_logits_to_keep=0):
+        """
+        Generate B images over the VAR scales on top of the text kv cache (past_key_values holds B rows),
+        the batch of the VAR head is doubled for CFG.
+
+        Returns:
+            recon_B3HW: decoded images in [0, 1], and the language model outputs of the last scale
+        """
+        sos = cond_BD = self.vargpt_gen.class_emb(torch.full((2 * B,), fill_value=self.config.special_tokens['image_gen_start_token_id'] +1, device=self.device)) # torch.Size([2B, 3584])
+        lvl_pos = self.vargpt_gen.lvl_embed(self.vargpt_gen.lvl_1L) + self.vargpt_gen.pos_1LC
+        next_token_map = sos.unsqueeze(1).expand(2 * B, self.vargpt_gen.first_l, -1) + self.vargpt_gen.pos_start.expand(2 * B, self.vargpt_gen.first_l, -1) + lvl_pos[:, :self.vargpt_gen.first_l]
+        cur_L = 0
+        f_hat = sos.new_zeros(B, self.vargpt_gen.Cvae, self.vargpt_gen.patch_nums[-1], self.vargpt_gen.patch_nums[-1])
+
+        next_token_map = self.image_gen_projector(next_token_map).view(-1, next_token_map.shape[1], self.config.hidden_size)
+
+        self.vargpt_gen.set_kv_caching(True)
+        for si, pn in enumerate(self.vargpt_gen.patch_nums):   # si: i-th segment
+            ratio = si / self.vargpt_gen.num_stages_minus_1
+            cur_L += pn*pn
+            cond_BD_or_gss = self.vargpt_gen.shared_ada_lin(cond_BD)
+            x = next_token_map[:B] # 
+           
+            outputs = self.language_model(
+                attention_mask = None, 
+                position_ids=None,
+                past_key_values=past_key_values,
+                inputs_embeds=x,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=True,
+                return_dict=return_dict,
+                cache_position=None,
+                num_logits_to_keep=num_logits_to_keep,
+            )
+
+            hidden_states = outputs.hidden_states[-1]
+            # cfg
+            gaussian_noise = torch.randn(B, hidden_states.shape[1], hidden_states.shape[2], device=hidden_states.device, dtype=hidden_states.dtype)  # 保持设备一致
+            hidden_states = torch.cat([hidden_states, gaussian_noise], dim=0)  # [2*B, num, num2]
+
+            encoded_x = self.image_gen_projector_out(hidden_states).view(hidden_states.shape[0], hidden_states.shape[1], self.vargpt_gen.C)
+            logits_BlV = self.vargpt_gen.forward_inference(encoded_x, cond_BD_or_gss, cond_BD)
+
+            t = cfg * ratio
+            logits_BlV = (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
+    
+            idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=None, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+            if not more_smooth: # this is the default case
+                h_BChw = self.vargpt_gen.vae_quant_proxy[0].embedding(idx_Bl)   # B, l, Cvae
+            else:   # not used when evaluating FID/IS/Precision/Recall
+                gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)   # refer to mask-git
+                h_BChw = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=None) @ self.vargpt_gen.vae_quant_proxy[0].embedding.weight.unsqueeze(0)
+            
+            h_BChw = h_BChw.transpose_(1, 2).reshape(B, self.vargpt_gen.Cvae, pn, pn)
+            f_hat, next_token_map = self.vargpt_gen.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.vargpt_gen.patch_nums), f_hat, h_BChw)
+            if si != self.vargpt_gen.num_stages_minus_1:   # prepare for next stage
+                next_token_map = next_token_map.view(B, self.vargpt_gen.Cvae, -1).transpose(1, 2)
+                next_token_map = self.vargpt_gen.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + self.vargpt_gen.patch_nums[si+1] ** 2]
+                next_token_map = self.image_gen_projector(next_token_map).view(-1, next_token_map.shape[1], self.config.hidden_size)
+                next_token_map = next_token_map.repeat(2, 1, 1)   # double the batch sizes due to CFG
+        self.vargpt_gen.set_kv_caching(False)
+        
+        recon_B3HW = self.vargpt_gen.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)   # de-normalize, from [-1, 1] to [0, 1]
+
+        return recon_B3HW, outputs
+
+    @torch.no_grad()
+    def generate_images(self, input_ids, attention_mask=None, num_images=1, max_new_tokens=1000,
+                        top_k=900, top_p=0.96, cfg=1.5):
+        """
+        Batched image generation that returns images directly instead of saving to _IMAGE_GEN_PATH.
+        The prompt (batch size 1) is greedily decoded once until the image generation start token as vargpt_sample,
+        then its kv cache is repeated for num_images rows and all images go through the VAR scales together.
+
+        Returns:
+            recon_B3HW: decoded images (num_images, 3, H, W) in [0, 1], None if eos or max_new_tokens is reached before
+                the image generation start token
+        """
+        assert input_ids.shape[0] == 1, "the prompt is shared by all images"
+        start_token_id = self.config.special_tokens['image_gen_start_token_id']
+        # greedy decoding stops at eos as model.generate(do_sample=False)
+        eos_token_id = self.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.config.eos_token_id
+        if eos_token_id is None:
+            eos_token_ids = set()
+        elif isinstance(eos_token_id, int):
+            eos_token_ids = {eos_token_id}
+        else:
+            eos_token_ids = set(eos_token_id)
+        past_key_values = DynamicCache()
+        inputs_embeds = self.get_input_embeddings()(input_ids)
+
+        for _ in range(max_new_tokens):
+            outputs = self.language_model(
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds,
+                use_cache=True,
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+            next_token = outputs.logits[:, -1].argmax(dim=-1)
+            if next_token[0].item() in eos_token_ids:
+                return None
+            if attention_mask is not None:
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, 1))], dim=-1)
+            inputs_embeds = self.get_input_embeddings()(next_token[:, None])
+
+            if next_token[0] == start_token_id:
+                # the start token is cached before the first scale as vargpt_sample
+                self.language_model(
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    inputs_embeds=inputs_embeds,
+                    use_cache=True,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                past_key_values.batch_repeat_interleave(num_images)
+                recon_B3HW, _ = self.autoregressive_infer_image(past_key_values, num_images, top_k=top_k, top_p=top_p, cfg=cfg)
+                return recon_B3HW
+
+        return None
+
     def get_gen_loss(self, labels, other_logits, other_labels, image_gen_logits, image_gen_labels, image_gen_mask_list=None ):
 
         loss = None
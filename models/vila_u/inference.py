@@ -39,6 +39,7 @@ if __name__ == "__main__":
     parser.add_argument("--cfg", type=float, default=3.0, help="The value of the classifier free guidance for image generation.")
     parser.add_argument("--save_path", type=str, default="generated_images/")
     parser.add_argument("--generation_nums", type=int, default=1)
+    parser.add_argument("--cuda_graph", action="store_true", help="Replay the image token decoding step with a CUDA graph.")
     args = parser.parse_args()
 
     if args.model_path is not None:
@@ -64,11 +65,11 @@ if __name__ == "__main__":
             raise ValueError("No visual content input!")
     elif args.prompt is not None:
         if args.video_generation:
-            response = model.generate_video_content(args.prompt, args.cfg, args.generation_nums)
+            response = model.generate_video_content(args.prompt, args.cfg, args.generation_nums, cuda_graph=args.cuda_graph)
             save_video(response, args.save_path)
             exit()
         else:
-            response = model.generate_image_content(args.prompt, args.cfg, args.generation_nums)
+            response = model.generate_image_content(args.prompt, args.cfg, args.generation_nums, cuda_graph=args.cuda_graph)
             save_image(response, args.save_path)
             exit()
     else:
@@ -1,24 +1,7 @@
 import argparse
-import cv2
 import numpy as np
-import os
 import vila_u
-import string
-
-def save_image(response, input_text="", path='generated_samples/vilau'):
-    os.makedirs(path, exist_ok=True)
-    outputs = []
-    trans = str.maketrans(' ', '-', string.punctuation)
-    save_prompt = input_text.translate(trans)
-    for i in range(response.shape[0]):
-        image = response[i].permute(1, 2, 0)
-        image = image.cpu().numpy().astype(np.uint8)
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(os.path.join(path, f"image_{i}.png"), image)
-        outputs.append(os.path.join(path, f"image_{i}.png"))
-
-    return outputs
-
+from PIL import Image
 
 class VILAU:
     def __init__(self, model_path=''):
@@ -30,13 +13,19 @@ class VILAU:
 
     def generate(self, input_text, img_num, save_dir):
         response = self.model.generate_image_content(input_text, self.cfg, img_num)
-        outputs = save_image(response, input_text, save_dir)
+        outputs = [Image.fromarray(image.permute(1, 2, 0).cpu().numpy().astype(np.uint8)) for image in response]
         return outputs
 
     def understand(self, input_img, prompt):
-        image = vila_u.Image(input_img)
+        # generated images are passed in memory, saved images by path
+        image = input_img if isinstance(input_img, Image.Image) else vila_u.Image(input_img)
         response = self.model.generate_content([image, prompt])
         return response
 
+    def understand_batch(self, input_img, prompts):
+        image = input_img if isinstance(input_img, Image.Image) else vila_u.Image(input_img)
+        responses = self.model.generate_content_batch(image, prompts)
+        return responses
+
 
 
@@ -767,6 +767,38 @@ class DataCollatorForSupervisedDataset(object):
     data_args: DataArguments
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        input_ids, labels, images, texts, generation_labels = self.collect_instances(instances)
+
+        input_ids = torch.nn.utils.rnn.pad_sequence(
+            input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id
+        )
+        labels = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX)
+        input_ids = input_ids[:, : self.tokenizer.model_max_length]
+        labels = labels[:, : self.tokenizer.model_max_length]
+        batch = dict(
+            input_ids=input_ids,
+            labels=labels,
+            attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
+        )
+
+        new_images = []
+
+        for ix in range(len(input_ids)):
+            num_images = (input_ids[ix] == IMAGE_TOKEN_INDEX).sum().item()
+            cur_images = images[ix]
+            cur_images = cur_images[:num_images]
+            if len(cur_images) > 0:
+                new_images.append(cur_images)
+
+        batch["images"] = self.stack_images(new_images)
+
+        if len(texts) > 0 and hasattr(self.data_args, 'need_text'):
+            batch["texts"] = texts
+        if len(generation_labels) > 0:
+            batch["generation_labels"] = generation_labels
+        return batch
+
+    def collect_instances(self, instances: Sequence[Dict]):
         input_ids, labels, images, texts, generation_labels = [], [], [], [], []
         
         for instance in instances:
@@ -810,42 +842,105 @@ class DataCollatorForSupervisedDataset(object):
                 Expect to have {len(_images)} images but only found {(_input_ids == IMAGE_TOKEN_INDEX).sum().item()} images in tokens. \
                 Error input_ids: {_input_ids}"
 
-        input_ids = torch.nn.utils.rnn.pad_sequence(
-            input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id
-        )
-        labels = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX)
-        input_ids = input_ids[:, : self.tokenizer.model_max_length]
-        labels = labels[:, : self.tokenizer.model_max_length]
-        batch = dict(
-            input_ids=input_ids,
-            labels=labels,
-            attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
-        )
-
-        new_images = []
+        return input_ids, labels, images, texts, generation_labels
 
-        for ix in range(len(input_ids)):
-            num_images = (input_ids[ix] == IMAGE_TOKEN_INDEX).sum().item()
-            cur_images = images[ix]
-            cur_images = cur_images[:num_images]
-            if len(cur_images) > 0:
-                new_images.append(cur_images)
+    def stack_images(self, images):
+        if len(images) > 0:
+            return torch.cat(images, dim=0)
 
-        if len(new_images) > 0:
-            batch["images"] = torch.cat(new_images, dim=0)
+        if hasattr(self.data_args.image_processor, "crop_size"):
+            crop_size = self.data_args.image_processor.crop_size
         else:
-            if hasattr(self.data_args.image_processor, "crop_size"):
-                crop_size = self.data_args.image_processor.crop_size
+            crop_size = self.data_args.image_processor.size
+        return torch.zeros(1, 3, crop_size["height"], crop_size["width"])
+
+
+@dataclass
+class DataCollatorForSupervisedDatasetSeqPacking(DataCollatorForSupervisedDataset):
+    """Collate a batch into rows of packed samples instead of one padded row per sample.
+
+    Samples are binned first-fit decreasing into rows of `model_max_length` tokens, counting
+    `data_args.image_tokens` tokens for each image placeholder, since that is the length the
+    LLM sees. `seqlens` holds the length of every sample of each row (0 after the last one),
+    from which the model restores per-sample position ids and attention boundaries after the
+    images are embedded. The packing efficiency is logged every `log_interval` batches.
+    """
+
+    log_interval: int = 100
+
+    def __post_init__(self):
+        self.num_batches = 0
+        self.num_tokens = 0
+        self.num_packed_slots = 0
+        self.num_padded_slots = 0
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        input_ids, labels, images, texts, generation_labels = self.collect_instances(instances)
+
+        max_length = self.tokenizer.model_max_length
+        image_tokens = getattr(self.data_args, "image_tokens", 1)
+        input_ids = [x[:max_length] for x in input_ids]
+        labels = [x[:max_length] for x in labels]
+        num_images = [(x == IMAGE_TOKEN_INDEX).sum().item() for x in input_ids]
+        lengths = [len(x) + n * (image_tokens - 1) for x, n in zip(input_ids, num_images)]
+
+        bins, bin_lengths = [], []
+        for ix in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            for b in range(len(bins)):
+                if bin_lengths[b] + lengths[ix] <= max_length:
+                    bins[b].append(ix)
+                    bin_lengths[b] += lengths[ix]
+                    break
             else:
-                crop_size = self.data_args.image_processor.size
-            batch["images"] = torch.zeros(1, 3, crop_size["height"], crop_size["width"])
+                bins.append([ix])
+                bin_lengths.append(lengths[ix])
+
+        seqlens = torch.zeros(len(bins), max(len(b) for b in bins), dtype=torch.long)
+        new_images = []
+        for row, b in enumerate(bins):
+            seqlens[row, : len(b)] = torch.tensor([len(input_ids[ix]) for ix in b])
+            for ix in b:
+                if num_images[ix] > 0:
+                    new_images.append(images[ix][: num_images[ix]])
+
+        packed_input_ids = torch.nn.utils.rnn.pad_sequence(
+            [torch.cat([input_ids[ix] for ix in b]) for b in bins],
+            batch_first=True,
+            padding_value=self.tokenizer.pad_token_id,
+        )
+        packed_labels = torch.nn.utils.rnn.pad_sequence(
+            [torch.cat([labels[ix] for ix in b]) for b in bins], batch_first=True, padding_value=IGNORE_INDEX
+        )
+        attention_mask = torch.arange(packed_input_ids.shape[1]).unsqueeze(0) < seqlens.sum(-1, keepdim=True)
+
+        batch = dict(
+            input_ids=packed_input_ids,
+            labels=packed_labels,
+            attention_mask=attention_mask,
+            seqlens=seqlens,
+            images=self.stack_images(new_images),
+        )
 
         if len(texts) > 0 and hasattr(self.data_args, 'need_text'):
             batch["texts"] = texts
         if len(generation_labels) > 0:
             batch["generation_labels"] = generation_labels
+
+        self.log_efficiency(sum(lengths), len(bins) * max(bin_lengths), len(lengths) * max(lengths))
         return batch
 
+    def log_efficiency(self, num_tokens, num_packed_slots, num_padded_slots):
+        self.num_batches += 1
+        self.num_tokens += num_tokens
+        self.num_packed_slots += num_packed_slots
+        self.num_padded_slots += num_padded_slots
+        if self.num_batches % self.log_interval == 0:
+            logging.warning(
+                f"Sequence packing over {self.num_batches} batches: "
+                f"{self.num_tokens / self.num_packed_slots:.1%} of packed tokens are used, "
+                f"against {self.num_tokens / self.num_padded_slots:.1%} with padding."
+            )
+
 
 def make_supervised_data_module(
     tokenizer: PreTrainedTokenizer,
@@ -856,7 +951,10 @@ def make_supervised_data_module(
     train_dataset = build_datasets(data_args, training_args=training_args, tokenizer=tokenizer, split="train")
     eval_dataset = build_datasets(data_args, training_args=training_args, tokenizer=tokenizer, split="eval")
     
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer, data_args=data_args)
+    if data_args.seq_packing:
+        data_collator = DataCollatorForSupervisedDatasetSeqPacking(tokenizer=tokenizer, data_args=data_args)
+    else:
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer, data_args=data_args)
     return dict(
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
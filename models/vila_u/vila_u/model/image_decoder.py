@@ -0,0 +1,148 @@
+import torch
+import torch.nn.functional as F
+
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb, repeat_kv
+
+
+class StaticImageDecoder:
+    """
+    Fixed-length decoding of image tokens with static shapes.
+
+    Every step feeds one token per row to the LLM, samples the code stack of the new image token with the
+    RQ transformer and embeds it as the input of the next step, which is what `generate` does through the
+    generic sampling loop. Here the kv cache, the attention mask and the code buffer are preallocated for the
+    prompt and all steps, and the step state lives in device tensors updated in place, so a step can be
+    captured once in a CUDA graph and replayed for the remaining steps.
+    """
+
+    def __init__(self, model, cfg: float = 3.0, cuda_graph: bool = False):
+        self.llm = model.llm
+        self.layers = model.llm.model.layers
+        self.vision_tower = model.vision_tower.vision_tower
+        self.mm_projector = model.mm_projector
+        self.cfg = cfg
+        self.cuda_graph = cuda_graph
+
+    @torch.inference_mode()
+    def generate(self, input_ids, attention_mask, num_steps, past_key_values=None):
+        """
+        Decode `num_steps` image tokens after the left padded prompts `input_ids`, whose last token starts the
+        image. `past_key_values` may hold the prefilled cache of all but the last token, as returned by
+        `prepare_cfg_inputs`. Returns the codes of shape (batch, num_steps, depth).
+        """
+        self.vision_tower.rqtransformer.eval()
+        if past_key_values is None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            past_key_values = self.llm.model(
+                input_ids=input_ids[:, :-1],
+                attention_mask=attention_mask[:, :-1],
+                position_ids=position_ids[:, :-1],
+                use_cache=True,
+            ).past_key_values
+
+        self.allocate(input_ids, attention_mask, num_steps, past_key_values)
+
+        self.decode_step()
+        if self.cuda_graph and num_steps > 2:
+            graph = self.capture()
+            for _ in range(num_steps - 2):
+                graph.replay()
+        else:
+            for _ in range(num_steps - 1):
+                self.decode_step()
+
+        codes = self.codes
+        self.release()
+
+        return codes
+
+    def allocate(self, input_ids, attention_mask, num_steps, past_key_values):
+        batch_size, prefix_len = input_ids.shape[0], input_ids.shape[1] - 1
+        max_len = prefix_len + num_steps
+        device = input_ids.device
+
+        self.key_cache, self.value_cache = [], []
+        for key_states, value_states in past_key_values:
+            key_cache = key_states.new_zeros(batch_size, key_states.shape[1], max_len, key_states.shape[3])
+            value_cache = value_states.new_zeros(batch_size, value_states.shape[1], max_len, value_states.shape[3])
+            key_cache[:, :, :prefix_len] = key_states
+            value_cache[:, :, :prefix_len] = value_states
+            self.key_cache.append(key_cache)
+            self.value_cache.append(value_cache)
+
+        self.attention_mask = torch.zeros((batch_size, 1, 1, max_len), dtype=torch.bool, device=device)
+        self.attention_mask[:, 0, 0, :prefix_len] = attention_mask[:, :-1].bool()
+        self.prefix_len = prefix_len
+        self.prefix_position_ids = attention_mask[:, :-1].long().sum(-1, keepdim=True)
+        self.step = torch.zeros(1, dtype=torch.long, device=device)
+
+        depth = self.vision_tower.rqtransformer.pos_emb_d.shape[1]
+        self.codes = torch.zeros((batch_size, num_steps, depth), dtype=torch.long, device=device)
+        self.inputs_embeds = self.llm.model.embed_tokens(input_ids[:, -1:])
+        self.cos, self.sin = self.layers[0].self_attn.rotary_emb(self.inputs_embeds, seq_len=max_len)
+
+    def release(self):
+        self.key_cache = self.value_cache = None
+        self.attention_mask = self.codes = self.inputs_embeds = None
+
+    def capture(self):
+        # torch.cuda.graph needs a warmup on a side stream, which decodes the second token
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.decode_step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self.decode_step()
+
+        return graph
+
+    def decode_step(self):
+        cache_position = self.step + self.prefix_len
+        position_ids = self.prefix_position_ids + self.step
+        self.attention_mask.index_fill_(-1, cache_position, True)
+
+        hidden_states = self.inputs_embeds
+        for layer, key_cache, value_cache in zip(self.layers, self.key_cache, self.value_cache):
+            residual = hidden_states
+            hidden_states = layer.input_layernorm(hidden_states)
+            hidden_states = self.attention(
+                layer.self_attn, hidden_states, position_ids, cache_position, key_cache, value_cache
+            )
+            hidden_states = residual + hidden_states
+
+            residual = hidden_states
+            hidden_states = layer.post_attention_layernorm(hidden_states)
+            hidden_states = residual + layer.mlp(hidden_states)
+        hidden_states = self.llm.model.norm(hidden_states)
+
+        image_hidden_state, code = self.vision_tower.rqtransformer.generate(
+            hidden_states, self.vision_tower.rqvaesiglip, self.cfg
+        )
+        self.codes.index_copy_(1, self.step, code)
+        self.inputs_embeds.copy_(self.mm_projector(image_hidden_state))
+        self.step.add_(1)
+
+    def attention(self, attn, hidden_states, position_ids, cache_position, key_cache, value_cache):
+        bsz = hidden_states.shape[0]
+
+        query_states = attn.q_proj(hidden_states).view(bsz, 1, attn.num_heads, attn.head_dim).transpose(1, 2)
+        key_states = attn.k_proj(hidden_states).view(bsz, 1, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+        value_states = attn.v_proj(hidden_states).view(bsz, 1, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, self.cos, self.sin, position_ids)
+
+        key_cache.index_copy_(2, cache_position, key_states)
+        value_cache.index_copy_(2, cache_position, value_states)
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            repeat_kv(key_cache, attn.num_key_value_groups),
+            repeat_kv(value_cache, attn.num_key_value_groups),
+            attn_mask=self.attention_mask,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, 1, attn.hidden_size)
+
+        return attn.o_proj(attn_output)
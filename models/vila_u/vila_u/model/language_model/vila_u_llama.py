@@ -86,7 +86,16 @@ class VILAULlamaModel(VILAUMetaModel, VILAUMetaForCausalLM, PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        seqlens: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
+        if seqlens is not None:
+            # rows packed by DataCollatorForSupervisedDatasetSeqPacking are split into samples to embed
+            # their images, and packed the same way again below
+            input_ids, attention_mask, labels, samples_per_row = self.unpack_multimodal_data(
+                input_ids, attention_mask, labels, seqlens
+            )
+            position_ids = None
+
         if inputs_embeds is None:
             (
                 input_ids,
@@ -104,7 +113,26 @@ class VILAULlamaModel(VILAUMetaModel, VILAUMetaForCausalLM, PreTrainedModel):
                 images,
             )
             
-        if self.training:
+        if seqlens is not None:
+            (
+                _,
+                new_position_ids,
+                new_attention_mask,
+                _,
+                new_inputs_embeds,
+                new_labels,
+                sorted_seqlens_in_batch,
+            ) = self.pack_multimodal_data(
+                position_ids,
+                attention_mask,
+                past_key_values,
+                inputs_embeds,
+                labels,
+                samples_per_row,
+            )
+            new_input_ids = None
+            past_key_values = None
+        elif self.training:
             (
                 _,
                 new_position_ids,
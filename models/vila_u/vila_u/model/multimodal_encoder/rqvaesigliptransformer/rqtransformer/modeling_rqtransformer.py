@@ -15,8 +15,7 @@ from .configuration_rqtransformer import RQTransformerConfig, AttentionStackConf
 
 def top_k_logits(logits, k):
     v, ix = torch.topk(logits, k)
-    out = logits.clone()
-    out[out < v[:, [-1]]] = -float('Inf')
+    out = logits.masked_fill(logits < v[:, [-1]], -float('Inf'))
 
     return out
 
@@ -57,7 +56,10 @@ def sample_from_logits(logits, temperature=1.0, top_k=None, top_p=None):
     if top_k is not None:
         logits = top_k_logits(logits, top_k)
     
-    if torch.sum(torch.isnan(logits)):
+    # the check syncs with the host, which is not allowed while capturing a CUDA graph
+    if torch.cuda.is_current_stream_capturing():
+        logits = logits.masked_fill(torch.isnan(logits), -float('Inf'))
+    elif torch.sum(torch.isnan(logits)):
         print('WARNING... NaN observed')
         logits[torch.isnan(logits)] = -float('Inf')
 
@@ -124,55 +126,43 @@ class RQTransformer(PreTrainedModel):
         return head_outputs
     
     def generate(self, embed_from_body, model_aux=None, cfg=3.0):
-        generate_idx = 1
+        """
+        Sample the codes of all depths for every position. The depth transformer runs with its kv cache,
+        so each depth step only processes the newest depth token, and the cumulative sum of the code
+        embeddings is kept up to date instead of re-embedding all previous codes.
+        """
         B, seq_len, _ = embed_from_body.shape
+        depth = self.pos_emb_d.shape[1]
 
         embed_from_body = self.in_mlp_2(embed_from_body)
 
-        depth_ctx_full = embed_from_body.view(B, seq_len, 1, -1)
-        depth_ctx_full = depth_ctx_full.reshape(B * seq_len, generate_idx, -1)
-        depth_ctx_full = depth_ctx_full + self.pos_emb_d[:, :generate_idx, :]
+        self.head_transformer.init_cache()
+        depth_ctx = embed_from_body.reshape(B * seq_len, 1, -1)
+        code = []
+        code_emb_sum = None
 
-        head_outputs = self.head_transformer(depth_ctx_full)
-        head_outputs = head_outputs.reshape(B, -1)
-
-        logits = self.classifier_mlp(head_outputs)
-
-        logits = logits[B//2:, :] + cfg * (logits[:B//2, :] - logits[B//2:, :])
-        code = sample_from_logits(logits, temperature=1.0, top_p=0.96, top_k=900)
-        code = code.reshape(B//2, seq_len, 1).repeat(2, 1, self.pos_emb_d.shape[1])
-
-        for i in range(self.pos_emb_d.shape[1]-1):
-            generate_idx += 1
-            depth_ctx = self.embed_with_model_aux(code, model_aux)
-            depth_ctx = torch.cumsum(depth_ctx, dim=-2)[:, :, :i+1, :]
-            if len(depth_ctx.shape) == 3:
-                depth_ctx = depth_ctx.unsqueeze(2)
-            depth_ctx = self.in_mlp_1(depth_ctx)
-
-            depth_ctx_full = torch.cat(
-                [
-                    embed_from_body.view(B, seq_len, 1, -1),
-                    depth_ctx,
-                ],
-                dim=-2,
-            )
-
-            depth_ctx_full = depth_ctx_full.reshape(B * seq_len, generate_idx, -1)
-            depth_ctx_full = depth_ctx_full + self.pos_emb_d[:, :generate_idx, :]
-
-            head_outputs = self.head_transformer(depth_ctx_full)
-            head_outputs = head_outputs[:, -1, :]
+        for i in range(depth):
+            depth_ctx = depth_ctx + self.pos_emb_d[:, i:i+1, :]
+            head_outputs = self.head_transformer.cached_forward(depth_ctx)
+            head_outputs = head_outputs.reshape(B, -1)
 
             logits = self.classifier_mlp(head_outputs)
 
             logits = logits[B//2:, :] + cfg * (logits[:B//2, :] - logits[B//2:, :])
             code_generate = sample_from_logits(logits, temperature=1.0, top_p=0.96, top_k=900)
-            code_generate = code_generate.reshape(B//2, seq_len).repeat(2, 1)
-            code[:, :, i+1] = code_generate
+            code_generate = code_generate.reshape(B//2, seq_len, 1).repeat(2, 1, 1)
+            code.append(code_generate)
+
+            # the running sum is kept in float32 like the accumulation of cumsum
+            code_emb = model_aux.get_code_emb_at_depth(code_generate, i).squeeze(-2)
+            code_emb_sum = code_emb.float() if code_emb_sum is None else code_emb_sum + code_emb.float()
+            if i < depth - 1:
+                depth_ctx = self.in_mlp_1(code_emb_sum.to(code_emb.dtype)).reshape(B * seq_len, 1, -1)
+
+        self.head_transformer.init_cache()
 
-        out_features = self.embed_with_model_aux(code, model_aux)
-        out_features = torch.cumsum(out_features, dim=-2)[:, :, -1, :]
+        code = torch.cat(code, dim=-1)
+        out_features = code_emb_sum.to(code_emb.dtype)
 
         return out_features, code
 
@@ -82,6 +82,10 @@ class RQVAESiglipModel(PreTrainedModel):
     def get_code_emb_with_depth(self, code):
         return self.quantizer.embed_code_with_depth(code)
 
+    @torch.no_grad()
+    def get_code_emb_at_depth(self, code, depth):
+        return self.quantizer.embed_code_at_depth(code, depth)
+
 
 AutoConfig.register("rqvaesiglip_model", RQVAESiglipConfig)
 AutoModel.register(RQVAESiglipConfig, RQVAESiglipModel)
\ No newline at end of file
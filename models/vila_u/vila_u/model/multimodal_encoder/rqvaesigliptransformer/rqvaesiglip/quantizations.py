@@ -314,3 +314,8 @@ class RQBottleneck(nn.Module):
         embeds = torch.cat(embeds, dim=-2)
         
         return embeds, None
+
+    @torch.no_grad()
+    def embed_code_at_depth(self, code, depth):
+        codebook = self.codebooks[0] if self.shared_codebook else self.codebooks[depth]
+        return codebook.embed(code)
@@ -21,6 +21,7 @@ from ..constants import (
     IMAGE_TOKEN_INDEX,
 )
 from ..model.configuration_vila_u import VILAUConfig
+from ..model.image_decoder import StaticImageDecoder
 from ..model.language_model.builder import build_llm_and_tokenizer
 from ..model.multimodal_encoder.builder import build_vision_tower
 from ..model.multimodal_encoder.rqvaesigliptransformer_encoder import RQVAESIGLIPTransformerVisionTower
@@ -532,6 +533,75 @@ class VILAUMetaForCausalLM(ABC):
             sorted_seqlens_in_batch,
         )
 
+    def unpack_multimodal_data(self, input_ids, attention_mask, labels, seqlens):
+        sample_lens = seqlens[seqlens.ne(0)].tolist()
+        attention_mask = attention_mask.bool()
+
+        new_input_ids = torch.split(input_ids[attention_mask], sample_lens)
+        new_labels = torch.split(labels[attention_mask], sample_lens)
+
+        new_input_ids = torch.nn.utils.rnn.pad_sequence(
+            new_input_ids, batch_first=True, padding_value=self.llm.pad_token_id
+        )
+        new_labels = torch.nn.utils.rnn.pad_sequence(new_labels, batch_first=True, padding_value=IGNORE_INDEX)
+        new_attention_mask = torch.arange(new_input_ids.shape[1], device=input_ids.device).unsqueeze(0) < torch.tensor(
+            sample_lens, device=input_ids.device
+        ).unsqueeze(1)
+
+        return (
+            new_input_ids,
+            new_attention_mask,
+            new_labels,
+            seqlens.ne(0).sum(dim=-1),
+        )
+
+    def pack_multimodal_data(
+        self,
+        position_ids,
+        attention_mask,
+        past_key_values,
+        inputs_embeds,
+        labels,
+        samples_per_row,
+    ):
+        new_inputs_embeds = []
+        new_position_ids = []
+        new_labels = []
+
+        attention_mask = attention_mask.bool()
+        seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
+        sample_idx = 0
+
+        for num_samples in samples_per_row.tolist():
+            row = range(sample_idx, sample_idx + num_samples)
+            sample_idx += num_samples
+            new_inputs_embeds.append(torch.cat([inputs_embeds[i][attention_mask[i]] for i in row], 0))
+            new_position_ids.append(
+                torch.cat(
+                    [torch.arange(seqlens_in_batch[i].item(), device=inputs_embeds.device) for i in row],
+                    0,
+                )
+            )
+            new_labels.append(torch.cat([labels[i][attention_mask[i]] for i in row], 0))
+
+        new_inputs_embeds = torch.nn.utils.rnn.pad_sequence(
+            new_inputs_embeds, batch_first=True, padding_value=self.llm.pad_token_id
+        )
+        new_position_ids = torch.nn.utils.rnn.pad_sequence(new_position_ids, batch_first=True, padding_value=-1)
+        new_labels = torch.nn.utils.rnn.pad_sequence(new_labels, batch_first=True, padding_value=IGNORE_INDEX)
+        new_attention_mask = new_position_ids.ne(-1)
+        assert new_attention_mask.sum() == attention_mask.sum()
+
+        return (
+            None,
+            new_position_ids,
+            new_attention_mask,
+            past_key_values,
+            new_inputs_embeds,
+            new_labels,
+            seqlens_in_batch,
+        )
+
     def initialize_vision_tokenizer(self, model_args, tokenizer):
         if model_args.mm_use_im_patch_token:
             tokenizer.add_tokens([DEFAULT_IMAGE_PATCH_TOKEN], special_tokens=True)
@@ -612,16 +682,58 @@ class VILAUMetaForCausalLM(ABC):
         return response
     
     @torch.inference_mode()
-    def generate_image_content(self, prompt: str, cfg: float = 3.0, generation_nums: int = 1) -> torch.Tensor:
-        input_ids_list = []
+    def generate_content_batch(self, media, prompts: List[str], generation_config: Optional[GenerationConfig] = None) -> List[str]:
+        message = {"from": "human", "value": [media]}
+        media = extract_media([message], self.config)
+        images = process_images(media["image"], self.vision_tower.image_processor, self.config).to(self.device, dtype=eval(self.config.model_dtype))
+
+        # encode the shared media once, all prompts reuse the image features
+        image_features, _ = self.encode_images(images, None)
+
+        inputs_embeds_list = []
+        for prompt in prompts:
+            conversation = [{"from": "human", "value": message["value"] + prompt}]
+            input_ids = tokenize_conversation(conversation, self.tokenizer, add_generation_prompt=True).cuda()
+            text_embeds = self.get_input_embeddings()(input_ids.clamp(min=0))
+            image_token_indices = [-1] + torch.where(input_ids == IMAGE_TOKEN_INDEX)[0].tolist() + [input_ids.shape[0]]
+
+            cur_inputs_embeds = []
+            for i in range(len(image_token_indices) - 1):
+                cur_inputs_embeds.append(text_embeds[image_token_indices[i] + 1 : image_token_indices[i + 1]])
+                if i < len(image_token_indices) - 2:
+                    cur_inputs_embeds.append(image_features[i].to(text_embeds.dtype))
+            inputs_embeds_list.append(torch.cat(cur_inputs_embeds))
+
+        max_length = max([len(inputs_embeds) for inputs_embeds in inputs_embeds_list])
+        inputs_embeds = torch.zeros((len(prompts), max_length, inputs_embeds_list[0].shape[-1]), dtype=inputs_embeds_list[0].dtype).cuda()
+        attention_mask = torch.zeros((len(prompts), max_length)).bool().cuda()
+        for i in range(len(inputs_embeds_list)):
+            inputs_embeds[i, -len(inputs_embeds_list[i]):] = inputs_embeds_list[i]
+            attention_mask[i, -len(inputs_embeds_list[i]):] = True
 
-        conversation = [{"from": "human", "value": prompt}]
-        input_ids = tokenize_conversation(conversation, self.tokenizer, add_generation_prompt=True, image_generation=True).cuda()
-        input_ids_list += [input_ids] * generation_nums
+        generation_config = generation_config or self.default_generation_config
 
-        cfg_conversation = [{"from": "human", "value": " "}]
-        cfg_input_ids = tokenize_conversation(cfg_conversation, self.tokenizer, add_generation_prompt=True, image_generation=True).cuda()
-        input_ids_list += [cfg_input_ids] * generation_nums
+        output_ids = self.llm.generate(inputs_embeds=inputs_embeds.to(self.dtype), attention_mask=attention_mask, generation_config=generation_config)
+
+        responses = [response.strip() for response in self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+
+        return responses
+    
+    @torch.inference_mode()
+    def prepare_cfg_inputs(self, input_ids: torch.Tensor, cfg_input_ids: torch.Tensor, generation_nums: int = 1, share_cfg_prefix: bool = True):
+        """
+        Build the left padded [cond] * N + [uncond] * N batch for cfg generation.
+        With share_cfg_prefix, the cond and uncond prompts are prefilled once (except the last token, which starts
+        the image generation in the first decoding step) and their kv cache is repeated for the N samples.
+        This saves the prefill compute and its 2N-row activations, but not kv cache memory: the repeated prefix
+        cache takes as much memory as a 2N-row prefill, since the decoding steps and StaticImageDecoder attend
+        over one contiguous per-row cache. The prefix is a few dozen tokens against the image tokens generated
+        per row, so the decoding cache dominates the memory either way.
+        """
+        if share_cfg_prefix:
+            input_ids_list = [input_ids, cfg_input_ids]
+        else:
+            input_ids_list = [input_ids] * generation_nums + [cfg_input_ids] * generation_nums
 
         max_length = max([len(input_ids) for input_ids in input_ids_list])
         input_ids = torch.zeros((len(input_ids_list), max_length), dtype=input_ids_list[0].dtype).cuda()
@@ -630,7 +742,40 @@ class VILAUMetaForCausalLM(ABC):
             input_ids[i, -len(input_ids_list[i]):] = input_ids_list[i]
             attention_mask[i, -len(input_ids_list[i]):] = True
 
-        image_ids = self.generate(input_ids=input_ids, attention_mask=attention_mask, cfg=cfg, max_new_tokens=self.vision_tower.image_tokens, use_cache=True)
+        if not share_cfg_prefix:
+            return input_ids, attention_mask, None
+
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        outputs = self.llm.model(
+            input_ids=input_ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            position_ids=position_ids[:, :-1],
+            use_cache=True,
+        )
+        past_key_values = tuple(
+            tuple(past_state.repeat_interleave(generation_nums, dim=0) for past_state in layer_past)
+            for layer_past in outputs.past_key_values
+        )
+        input_ids = input_ids.repeat_interleave(generation_nums, dim=0)
+        attention_mask = attention_mask.repeat_interleave(generation_nums, dim=0)
+
+        return input_ids, attention_mask, past_key_values
+
+    @torch.inference_mode()
+    def generate_image_content(self, prompt: str, cfg: float = 3.0, generation_nums: int = 1, share_cfg_prefix: bool = True, static_decode: bool = True, cuda_graph: bool = False) -> torch.Tensor:
+        conversation = [{"from": "human", "value": prompt}]
+        input_ids = tokenize_conversation(conversation, self.tokenizer, add_generation_prompt=True, image_generation=True).cuda()
+
+        cfg_conversation = [{"from": "human", "value": " "}]
+        cfg_input_ids = tokenize_conversation(cfg_conversation, self.tokenizer, add_generation_prompt=True, image_generation=True).cuda()
+
+        input_ids, attention_mask, past_key_values = self.prepare_cfg_inputs(input_ids, cfg_input_ids, generation_nums, share_cfg_prefix)
+        if static_decode:
+            image_ids = StaticImageDecoder(self, cfg=cfg, cuda_graph=cuda_graph).generate(input_ids, attention_mask, self.vision_tower.image_tokens, past_key_values)
+        else:
+            generation_kwargs = {"past_key_values": past_key_values} if past_key_values is not None else {}
+            image_ids = self.generate(input_ids=input_ids, attention_mask=attention_mask, cfg=cfg, max_new_tokens=self.vision_tower.image_tokens, use_cache=True, **generation_kwargs)
 
         image_embeds = self.vision_tower.vision_tower.rqtransformer.embed_with_model_aux(image_ids, self.vision_tower.vision_tower.rqvaesiglip)
         image_embeds = torch.cumsum(image_embeds, dim=-2)[:,:,-1,:]
@@ -640,26 +785,21 @@ class VILAUMetaForCausalLM(ABC):
         return response.chunk(2)[0]
     
     @torch.inference_mode()
-    def generate_video_content(self, prompt: str, cfg: float = 3.0, generation_nums: int = 1) -> torch.Tensor:
+    def generate_video_content(self, prompt: str, cfg: float = 3.0, generation_nums: int = 1, share_cfg_prefix: bool = True, static_decode: bool = True, cuda_graph: bool = False) -> torch.Tensor:
         GENERATION_VIDEO_FRAMES = 8
-        input_ids_list = []
 
         conversation = [{"from": "human", "value": prompt}]
         input_ids = tokenize_conversation(conversation, self.tokenizer, add_generation_prompt=True, video_generation=True).cuda()
-        input_ids_list += [input_ids] * generation_nums
 
         cfg_conversation = [{"from": "human", "value": " "}]
         cfg_input_ids = tokenize_conversation(cfg_conversation, self.tokenizer, add_generation_prompt=True, video_generation=True).cuda()
-        input_ids_list += [cfg_input_ids] * generation_nums
 
-        max_length = max([len(input_ids) for input_ids in input_ids_list])
-        input_ids = torch.zeros((len(input_ids_list), max_length), dtype=input_ids_list[0].dtype).cuda()
-        attention_mask = torch.zeros((len(input_ids_list), max_length)).bool().cuda()
-        for i in range(len(input_ids_list)):
-            input_ids[i, -len(input_ids_list[i]):] = input_ids_list[i]
-            attention_mask[i, -len(input_ids_list[i]):] = True
-
-        video_ids = self.generate(input_ids=input_ids, attention_mask=attention_mask, cfg=cfg, max_new_tokens=self.vision_tower.image_tokens * GENERATION_VIDEO_FRAMES, use_cache=True)
+        input_ids, attention_mask, past_key_values = self.prepare_cfg_inputs(input_ids, cfg_input_ids, generation_nums, share_cfg_prefix)
+        if static_decode:
+            video_ids = StaticImageDecoder(self, cfg=cfg, cuda_graph=cuda_graph).generate(input_ids, attention_mask, self.vision_tower.image_tokens * GENERATION_VIDEO_FRAMES, past_key_values)
+        else:
+            generation_kwargs = {"past_key_values": past_key_values} if past_key_values is not None else {}
+            video_ids = self.generate(input_ids=input_ids, attention_mask=attention_mask, cfg=cfg, max_new_tokens=self.vision_tower.image_tokens * GENERATION_VIDEO_FRAMES, use_cache=True, **generation_kwargs)
 
         video_embeds = self.vision_tower.vision_tower.rqtransformer.embed_with_model_aux(video_ids, self.vision_tower.vision_tower.rqvaesiglip)
         video_embeds = torch.cumsum(video_embeds, dim=-2)[:,:,-1,:]
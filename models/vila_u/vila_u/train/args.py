@@ -11,6 +11,7 @@ class DataArguments:
     lazy_preprocess: bool = False
     vflan_no_system_prompt: bool = False
     num_video_frames: int = 8
+    seq_packing: bool = False
 
 
 @dataclass
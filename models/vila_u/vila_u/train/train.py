@@ -192,6 +192,7 @@ def train():
     if vision_tower is not None:
         data_args.image_processor = vision_tower.image_processor
         data_args.is_multimodal = True
+        data_args.image_tokens = vision_tower.image_tokens
 
         model.config.num_video_frames = data_args.num_video_frames
         model.config.image_aspect_ratio = data_args.image_aspect_ratio
@@ -1,4 +1,5 @@
 import base64
+import bisect
 import gzip
 import hashlib
 import io
@@ -7,6 +8,7 @@ import random
 import re
 import sqlite3
 import sys
+import time
 import uuid
 import warnings
 import tempfile
@@ -19,7 +21,8 @@ import torch.distributed as dist
 
 from .wids_dl import download_and_open
 from .wids_lru import LRUCache
-from .wids_mmtar import MMIndexedTar
+from .wids_mmtar import MMIndexedTar, find_mmindex_file
+from .wids_prefetch import ShardPrefetcher
 from .wids_specs import load_dsdesc_and_resolve, urldir
 from .wids_tar import TarFileReader, find_index_file
 
@@ -250,7 +253,10 @@ class IndexedTarSamples:
         # stream = gzip.GzipFile(fileobj=stream)
         
         if use_mmap:
-            self.reader = MMIndexedTar(stream)
+            # the mmap reader keeps its own sidecar index format next to the shard
+            if index_file is find_index_file:
+                index_file = find_mmindex_file
+            self.reader = MMIndexedTar(stream, index_file=index_file)
         else:
             self.reader = TarFileReader(stream, index_file=index_file)
 
@@ -376,16 +382,20 @@ class LRUShards:
     are not deleted when they are no longer needed.
     """
 
-    def __init__(self, lru_size, keep=False, localname=default_localname()):
+    def __init__(self, lru_size, keep=False, localname=default_localname(), prefetcher=None):
         self.localname = localname
         # the cache contains the local name as the key and the downloaded path as the value
         self.lru = LRUCache(lru_size, release_handler=self.release_handler)
+        self.prefetcher = prefetcher
         # keep statistics
         self.reset_stats()
 
     def reset_stats(self):
         self.accesses = 0
         self.misses = 0
+        # how the misses were served when prefetching: ready ("hit"), waited for ("stall"), or opened here ("miss")
+        self.prefetch_stats = {"hit": 0, "stall": 0, "miss": 0}
+        self.stall_time = 0.0
 
     def __len__(self):
         return len(self.lru)
@@ -396,13 +406,36 @@ class LRUShards:
     def clear(self):
         self.lru.clear()
 
+    def open_shard(self, url):
+        local = self.localname(url)
+        with download_and_open(url, local) as stream:
+            return IndexedTarSamples(path=local, stream=stream)
+
+    def open_prefetched(self, url):
+        start = time.time()
+        itf, status = self.prefetcher.take(url)
+        if itf is None:
+            # DataLoader workers can't take the shards prefetched by the main process,
+            # but find them downloaded and indexed, or being downloaded
+            local = self.localname(url)
+            if os.path.exists(local + ".lock"):
+                status = "stall"
+            elif os.path.exists(find_mmindex_file(url if os.path.exists(url) else local)):
+                status = "hit"
+            itf = self.open_shard(url)
+        if status == "stall":
+            self.stall_time += time.time() - start
+        self.prefetch_stats[status] += 1
+        return itf
+
     def get_shard(self, url):
         assert isinstance(url, str)
         self.accesses += 1
         if url not in self.lru:
-            local = self.localname(url)
-            with download_and_open(url, local) as stream:
-                itf = IndexedTarSamples(path=local, stream=stream)
+            if self.prefetcher is not None:
+                itf = self.open_prefetched(url)
+            else:
+                itf = self.open_shard(url)
             self.lru[url] = itf
             self.misses += 1
             self.last_missed = True
@@ -473,6 +506,9 @@ class ShardListDataset(Dataset[T]):
         keep=False,
         base=None,
         options=None,
+        prefetch=0,
+        prefetch_bytes=int(2e10),
+        prefetch_threads=4,
     ):
         """Create a ShardListDataset.
 
@@ -481,6 +517,10 @@ class ShardListDataset(Dataset[T]):
             cache_size: the number of shards to keep in the cache
             lru_size: the number of shards to keep in the LRU cache
             localname: a function that maps URLs to local filenames
+            prefetch: the number of shards to download and open ahead of a ChunkedSampler, 0 to disable
+            prefetch_bytes: the maximum number of bytes, by the "filesize" of the shards, of the shards pending in the
+                prefetcher and of the files it downloaded, files of shards the sampler has passed are deleted to fit
+            prefetch_threads: the number of prefetch threads
 
         Note that there are two caches: an on-disk directory, and an in-memory LRU cache.
         """
@@ -552,6 +592,16 @@ class ShardListDataset(Dataset[T]):
                 "LRU size is very large; consider reducing it to avoid running out of file descriptors"
             )
         self.cache = LRUShards(lru_size, localname=self.localname, keep=keep)
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = ShardPrefetcher(
+                self.cache.open_shard,
+                ahead=prefetch,
+                max_bytes=prefetch_bytes,
+                threads=prefetch_threads,
+                localname=self.localname,
+            )
+            self.cache.prefetcher = self.prefetcher
 
     def add_transform(self, transform):
         """Add a transformation to the dataset."""
@@ -566,6 +616,15 @@ class ShardListDataset(Dataset[T]):
         """Return the number of cache accesses and misses."""
         return self.cache.accesses, self.cache.misses
 
+    def get_prefetch_stats(self):
+        """Return how the cache misses were served by the prefetcher and the seconds spent waiting for it.
+
+        The counts are kept per process: with DataLoader workers, the shards are
+        opened in the workers, so the counts of the main process stay zero and
+        each worker has its own (e.g. read them from `worker_init_fn` or
+        `get_worker_info().dataset` at the end of an epoch)."""
+        return dict(self.cache.prefetch_stats, stall_time=self.cache.stall_time)
+
     def check_cache_misses(self):
         """Check if the cache miss rate is too high."""
         accesses, misses = self.get_stats()
@@ -578,6 +637,23 @@ class ShardListDataset(Dataset[T]):
                 )
             )
 
+    def shard_url(self, shard_idx):
+        """Resolve the URL of a shard and store it in the shard descriptor."""
+        desc = self.shards[shard_idx]
+        url = desc["url"]
+        if url.startswith(("https://", "http://", "gs://", "/", "~")):
+            # absolute path or url path
+            url = url 
+        else:
+            # concat relative path
+            if self.base is None and "base_path" not in self.spec: 
+                raise FileNotFoundError("passing a relative path in shardlist but no base found.")
+            base_path = self.spec["base_path"] if "base_path" in self.spec else self.base
+            url = osp.abspath(osp.join(osp.expanduser(base_path), url))
+            
+        desc["url"] = url
+        return url
+
     def get_shard(self, index):
         """Get the shard and index within the shard corresponding to the given index."""
         # Find the shard corresponding to the given index.
@@ -592,18 +668,7 @@ class ShardListDataset(Dataset[T]):
 
         # Get the shard and return the corresponding element.
         desc = self.shards[shard_idx]
-        url = desc["url"]
-        if url.startswith(("https://", "http://", "gs://", "/", "~")):
-            # absolute path or url path
-            url = url 
-        else:
-            # concat relative path
-            if self.base is None and "base_path" not in self.spec: 
-                raise FileNotFoundError("passing a relative path in shardlist but no base found.")
-            base_path = self.spec["base_path"] if "base_path" in self.spec else self.base
-            url = osp.abspath(osp.join(osp.expanduser(base_path), url))
-            
-        desc["url"] = url
+        url = self.shard_url(shard_idx)
         try:
             shard = self.cache.get_shard(url)
         except UnicodeDecodeError as e:
@@ -632,6 +697,8 @@ class ShardListDataset(Dataset[T]):
 
     def close(self):
         """Close the dataset."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
         self.cache.clear()
 
 
@@ -663,19 +730,55 @@ def intersect_ranges(rangelist, r):
     return result
 
 
-def iterate_ranges(ranges, rng, indexshuffle=True, shardshuffle=True):
-    """Iterate over the ranges in a random order."""
+def shuffle_ranges(ranges, rng, shardshuffle=True):
+    """Return the ranges in the order they are iterated."""
     shard_indexes = list(range(len(ranges)))
     if shardshuffle:
         rng.shuffle(shard_indexes)
-    for i in shard_indexes:
-        lo, hi = ranges[i]
+    return [ranges[i] for i in shard_indexes]
+
+
+def iterate_ranges(ranges, rng, indexshuffle=True, shardshuffle=True):
+    """Iterate over the ranges in a random order."""
+    for lo, hi in shuffle_ranges(ranges, rng, shardshuffle=shardshuffle):
         sample_indexes = list(range(lo, hi))
         if indexshuffle:
             rng.shuffle(sample_indexes)
         yield from sample_indexes
 
 
+def prefetch_along(dataset, ranges, indexes):
+    """Yield the indexes, while the prefetcher of the dataset (if any) loads
+    the shards ahead of them.
+
+    The ranges are given in the order they are iterated. The shards of each
+    range are expected in ascending order, so within a shuffled range the
+    prefetch order is approximate.
+    """
+    prefetcher = getattr(dataset, "prefetcher", None)
+    if prefetcher is None:
+        yield from indexes
+        return
+    cum_lengths = list(dataset.cum_lengths)
+    order = {}
+    for lo, hi in ranges:
+        first = bisect.bisect_right(cum_lengths, lo)
+        last = bisect.bisect_right(cum_lengths, hi - 1)
+        for shard_idx in range(first, last + 1):
+            order.setdefault(shard_idx)
+    prefetcher.set_order(
+        [(dataset.shard_url(shard_idx), dataset.shards[shard_idx].get("filesize", 0)) for shard_idx in order]
+    )
+    seen = set()
+    for index in indexes:
+        shard_idx = bisect.bisect_right(cum_lengths, index)
+        if shard_idx not in seen:
+            # move on in the order when a new shard is used
+            seen.add(shard_idx)
+            prefetcher.advance(len(seen) - 1)
+        yield index
+
+
 class ShardListSampler(Sampler):
     """A sampler that samples consistent with a ShardListDataset.
 
@@ -695,6 +798,7 @@ class ShardListSampler(Sampler):
     """
 
     def __init__(self, dataset, *, lengths=None, seed=0, shufflefirst=False):
+        self.dataset = dataset
         if lengths is None:
             lengths = list(dataset.lengths)
         self.ranges = lengths_to_ranges(lengths)
@@ -705,7 +809,9 @@ class ShardListSampler(Sampler):
     def __iter__(self):
         self.rng = random.Random(self.seed + 1289738273 * self.epoch)
         shardshuffle = self.shufflefirst or self.epoch > 0
-        yield from iterate_ranges(self.ranges, self.rng, shardshuffle=shardshuffle)
+        ranges = shuffle_ranges(self.ranges, self.rng, shardshuffle=shardshuffle)
+        indexes = iterate_ranges(ranges, self.rng, shardshuffle=False)
+        yield from prefetch_along(self.dataset, ranges, indexes)
         self.epoch += 1
 
 
@@ -728,6 +834,7 @@ class ChunkedSampler(Sampler):
         shuffle=False,
         shufflefirst=False,
     ):
+        self.dataset = dataset
         if isinstance(num_samples, int):
             lo, hi = 0, num_samples
         elif num_samples is None:
@@ -749,12 +856,9 @@ class ChunkedSampler(Sampler):
     def __iter__(self):
         self.rng = random.Random(self.seed + 1289738273 * self.epoch)
         shardshuffle = self.shufflefirst or self.epoch > 0
-        yield from iterate_ranges(
-            self.ranges,
-            self.rng,
-            indexshuffle=self.shuffle,
-            shardshuffle=(self.shuffle and shardshuffle),
-        )
+        ranges = shuffle_ranges(self.ranges, self.rng, shardshuffle=(self.shuffle and shardshuffle))
+        indexes = iterate_ranges(ranges, self.rng, indexshuffle=self.shuffle, shardshuffle=False)
+        yield from prefetch_along(self.dataset, ranges, indexes)
         self.epoch += 1
 
 
@@ -5,6 +5,10 @@ import mmap
 import os
 import struct
 
+import numpy as np
+
+from .wids_tar import find_index_file
+
 TarHeader = collections.namedtuple(
     "TarHeader",
     [
@@ -44,6 +48,60 @@ def next_header(offset, header):
     return offset + block_size + padded_file_size
 
 
+# sidecar index: a header of (magic, shard size, shard mtime_ns, number of files, name width)
+# followed by one (offset, size, name) record per file
+INDEX_MAGIC = b"WIDSIDX1"
+INDEX_HEADER = struct.Struct("<8sqqqq")
+
+
+def index_dtype(name_width):
+    return np.dtype([("offset", "<i8"), ("size", "<i8"), ("name", f"S{name_width}")])
+
+
+def find_mmindex_file(file):
+    """Return the sidecar index file of a shard, e.g. shard.tar.mmindex.
+
+    It is named differently from the pickled index of TarFileReader."""
+    return find_index_file(file)[: -len(".index")] + ".mmindex"
+
+
+def load_mmindex(index_file, stat):
+    """Memory map the records of a sidecar index, or return None if it is
+    missing, corrupted, or stale w.r.t. the size and mtime of the shard."""
+    try:
+        with open(index_file, "rb") as stream:
+            header = stream.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            return None
+        magic, size, mtime_ns, count, name_width = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        dtype = index_dtype(name_width)
+        if os.path.getsize(index_file) != INDEX_HEADER.size + count * dtype.itemsize:
+            return None
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(index_file, dtype=dtype, mode="r", offset=INDEX_HEADER.size, shape=(count,))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def save_mmindex(index_file, stat, index):
+    """Write a sidecar index atomically, shards on read-only storage are skipped."""
+    temp_file = f"{index_file}.temp{os.getpid()}"
+    try:
+        with open(temp_file, "wb") as stream:
+            name_width = index.dtype["name"].itemsize
+            stream.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(index), name_width))
+            stream.write(index.tobytes())
+        os.rename(temp_file, index_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        return False
+    return True
+
+
 # TODO(ligeng): support gzip stream
 class MMIndexedTar:
     def __init__(self, fname, index_file=None, verbose=True, cleanup_callback=None):
@@ -58,7 +116,11 @@ class MMIndexedTar:
         self.mmapped_file = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
         if cleanup_callback:
             cleanup_callback(fname, self.stream.fileno(), "start")
-        self._build_index()
+        if callable(index_file):
+            path = self.fname or getattr(self.stream, "name", None)
+            index_file = index_file(path) if isinstance(path, str) else None
+        self.index_file = index_file
+        self._load_index()
 
     def close(self, dispose=False):
         if self.cleanup_callback:
@@ -66,9 +128,32 @@ class MMIndexedTar:
         self.mmapped_file.close()
         self.stream.close()
 
+    def _load_index(self):
+        """Load the sidecar index if it is up to date, otherwise scan the tar
+        headers and write the index for the next open."""
+        stat = os.fstat(self.stream.fileno())
+        index = None
+        if self.index_file is not None:
+            index = load_mmindex(self.index_file, stat)
+        if index is None:
+            index = self._build_index()
+            if self.index_file is not None:
+                saved = save_mmindex(self.index_file, stat, index)
+                if self.verbose and not saved:
+                    print("Could not write tar index", self.index_file)
+        self.index = index
+        self._by_name = None
+
+    @property
+    def by_name(self):
+        """Map the file names to their indices, built on the first lookup by
+        name, so opening a shard with a sidecar index does not touch the names."""
+        if self._by_name is None:
+            self._by_name = {name.decode("utf-8"): i for i, name in enumerate(self.index["name"].tolist())}
+        return self._by_name
+
     def _build_index(self):
-        self.by_name = {}
-        self.by_index = []
+        by_index = []
         offset = 0
         while offset >= 0 and offset < len(self.mmapped_file):
             header = parse_tar_header(self.mmapped_file[offset : offset + 500])
@@ -80,9 +165,10 @@ class MMIndexedTar:
                 except ValueError as exn:
                     print(header)
                     raise exn
-                self.by_name[name] = offset
-                self.by_index.append((name, offset, size))
+                by_index.append((offset, size, name.encode("utf-8")))
             offset = next_header(offset, header)
+        name_width = max([len(name) for _, _, name in by_index], default=1)
+        return np.array(by_index, dtype=index_dtype(name_width))
 
     def names(self):
         return self.by_name.keys()
@@ -95,16 +181,16 @@ class MMIndexedTar:
         return name, self.mmapped_file[start:end]
 
     def get_at_index(self, index):
-        name, offset, size = self.by_index[index]
-        return self.get_at_offset(offset)
+        offset, size, name = self.index[index].tolist()
+        start = offset + 512
+        return name.decode("utf-8"), self.mmapped_file[start : start + size]
 
     def get_by_name(self, name):
-        offset = self.by_name[name]
-        return self.get_at_offset(offset)
+        return self.get_at_index(self.by_name[name])
 
     def __iter__(self):
-        for name, offset, size in self.by_index:
-            yield name, self.mmapped_file[offset + 512 : offset + 512 + size]
+        for offset, size, name in self.index.tolist():
+            yield name.decode("utf-8"), self.mmapped_file[offset + 512 : offset + 512 + size]
 
     def __getitem__(self, key):
         if isinstance(key, int):
@@ -113,7 +199,7 @@ class MMIndexedTar:
             return self.get_by_name(key)
 
     def __len__(self):
-        return len(self.by_index)
+        return len(self.index)
 
     def get_file(self, i):
         fname, data = self.get_at_index(i)
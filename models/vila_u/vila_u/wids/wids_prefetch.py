@@ -0,0 +1,144 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .wids_mmtar import find_mmindex_file
+
+
+class ShardPrefetcher:
+    """Download, open and index shards in background threads ahead of the sampler.
+
+    The sampler passes the shards of an epoch in the order it will use them
+    (`set_order`), and tells the prefetcher how far it got (`advance`). The next
+    `ahead` shards are prefetched as long as they fit in `max_bytes`, and
+    prefetched shards that fall behind without being used are released.
+
+    With `localname`, the files downloaded for remote shards count against
+    `max_bytes` until they are deleted, whether the shards were taken here or
+    opened by DataLoader workers. When a shard does not fit, the downloaded
+    files of shards the sampler has passed are deleted, oldest first. Shards
+    that are local paths are opened in place and only count while pending.
+
+    A prefetched shard is taken by `take` when the dataset misses it in its LRU.
+    DataLoader workers run in other processes and can't take the opened shards,
+    but they find the shards downloaded and their sidecar indexes written, so
+    opening them does not block on I/O either.
+    """
+
+    def __init__(self, open_shard, ahead=4, max_bytes=int(2e10), threads=4, localname=None):
+        """Create a ShardPrefetcher.
+
+        Args:
+            open_shard: a function that downloads and opens a shard given its URL
+            ahead: the number of shards to prefetch
+            max_bytes: the maximum number of bytes of pending shards and downloaded files
+            threads: the number of download threads
+            localname: a function that maps URLs to the local files they are downloaded to
+        """
+        self.open_shard = open_shard
+        self.localname = localname
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="wids-prefetch")
+        self.lock = threading.Lock()
+        # the prefetched shards that are not taken yet as url -> (future, nbytes)
+        self.pending = {}
+        # the remote shards downloaded by the prefetcher whose files are not deleted yet as url -> nbytes
+        self.downloaded = {}
+        self.order = []
+        self.positions = {}
+        self.submitted = set()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["executor"] = None
+        state["lock"] = None
+        state["pending"] = {}
+        state["downloaded"] = {}
+        return state
+
+    def active(self):
+        """Threads don't survive fork, so only the creating process prefetches."""
+        return self.executor is not None and os.getpid() == self.pid
+
+    def set_order(self, shards):
+        """Set the shards of an epoch, as a list of (url, nbytes), in the order of first use."""
+        if not self.active():
+            return
+        self.order = shards
+        self.positions = {url: i for i, (url, _) in enumerate(shards)}
+        self.submitted = set()
+        self.advance(0)
+
+    def advance(self, position):
+        """Prefetch the shards from `position` of the order on."""
+        if not self.active():
+            return
+        with self.lock:
+            # shards that fall behind without being taken are released, with some slack since
+            # the sampler runs ahead of the dataset by the indexes of a batch
+            for url in list(self.pending):
+                if self.positions.get(url, -1) < position - self.ahead:
+                    self.release(self.pending.pop(url)[0])
+            for url, nbytes in self.order[position : position + self.ahead]:
+                if url in self.submitted:
+                    continue
+                if not self.fit(url, nbytes, position):
+                    break
+                self.submitted.add(url)
+                self.pending[url] = (self.executor.submit(self.open_shard, url), nbytes)
+                if self.localname is not None and not os.path.exists(url):
+                    self.downloaded[url] = nbytes
+
+    def nbytes_used(self):
+        pending = sum(nbytes for url, (_, nbytes) in self.pending.items() if url not in self.downloaded)
+        return pending + sum(self.downloaded.values())
+
+    def fit(self, url, nbytes, position):
+        """Delete the downloaded files of shards behind `position` until the shard
+        fits in `max_bytes`, and return whether it fits. A shard whose file is
+        still downloaded from an earlier epoch takes no more bytes."""
+        if url in self.downloaded:
+            nbytes = 0
+        for old in list(self.downloaded):
+            if self.nbytes_used() + nbytes <= self.max_bytes:
+                break
+            if old in self.pending or self.positions.get(old, -1) >= position - self.ahead:
+                continue
+            local = self.localname(old)
+            # a file being downloaded again by a DataLoader worker is left alone
+            if os.path.exists(local + ".lock"):
+                continue
+            for fname in (local, find_mmindex_file(local)):
+                if os.path.exists(fname):
+                    os.unlink(fname)
+            del self.downloaded[old]
+        return self.nbytes_used() + nbytes <= self.max_bytes
+
+    @staticmethod
+    def release(future):
+        if not future.cancel():
+            future.add_done_callback(lambda f: f.exception() is None and f.result().close())
+
+    def take(self, url):
+        """Return the shard and whether it was "hit" (ready) or "stall" (in flight),
+        or (None, "miss") if the shard is not prefetched."""
+        if not self.active():
+            return None, "miss"
+        with self.lock:
+            future, _ = self.pending.pop(url, (None, 0))
+        if future is None:
+            return None, "miss"
+        status = "hit" if future.done() else "stall"
+        return future.result(), status
+
+    def close(self):
+        if not self.active():
+            return
+        with self.lock:
+            for future, _ in self.pending.values():
+                self.release(future)
+            self.pending = {}
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,18 @@
+# shared by uni_eval and the adapters scoring multiple-choice options, models/* import it with the root at uni_eval
+
+# option letters of UniBench questions, the response code of a letter is its index in uni_eval
+OPTION_LETTERS = ['A', 'B', 'C', 'D', 'E']
+
+
+def option_token_ids(tokenizer, continuations):
+    """
+    Split the tokens of the option continuations, e.g. "(A)" to "(E)", into the prefix they share and the
+    first token telling them apart, whose logits after the prefix score the options.
+    """
+    tokens = [tokenizer.encode(text, add_special_tokens=False) for text in continuations]
+    n = 0
+    while all(len(t) > n + 1 for t in tokens) and len({t[n] for t in tokens}) == 1:
+        n += 1
+    option_ids = [t[n] for t in tokens]
+    assert len(set(option_ids)) == len(option_ids), "options are not told apart by one token"
+    return tokens[0][:n], option_ids
@@ -2,13 +2,42 @@ import os
 import sys
 import json
 import re
-import math
+import glob
+import gc
+import time
+import queue
 import argparse
 import torch
 import random
 import numpy as np
 from tqdm import tqdm
-import concurrent.futures
+import multiprocessing
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from option_scoring import OPTION_LETTERS
+
+
+# the response code of an option letter is its index, other responses are invalid
+RESPONSE_CODES = {letter: idx for idx, letter in enumerate(OPTION_LETTERS)}
+INVALID_RESPONSE = len(OPTION_LETTERS)
+ANSWER_PATTERN = re.compile(r'\(([ABCDE])|([ABCDE])\)')
+# per-worker folders save_path_[GPU_ID] of a run, e.g., _0 or _0,1
+WORKER_DIR_PATTERN = re.compile(r'_\d+(,\d+)*$')
+# threads of the background writer archiving in-memory images of each worker
+ARCHIVE_WORKERS = 4
+# an entry of text_records.txt, the raw reply is saved as a JSON string since replies may span several lines,
+# older records saved before replies and option probabilities were kept have no reply: or probs: line
+TEXT_RECORD_PATTERN = re.compile(r'img_name:(.*?)\ninput_prompt:(.*?)\nquestion:(.*?)\nanswer:(.*?)\n'
+                                 r'response:(.*?)\n(?:reply:(.*?)\n)?(?:probs:(.*?)\n)?model:(-?\d+)\n\n', re.S)
+
+
+def parse_options(question):
+    """
+    Parse the option contents of a question, e.g. "Options: (A) red, (B) blue, ..." -> ['red', 'blue', ...].
+    """
+
+    return [_.split(',')[0] for _ in question.split('\n')[1].split(') ')[1:]]
 
 
 def check_answer(reply, answer, options):
@@ -29,11 +58,11 @@ def check_answer(reply, answer, options):
     if reply == '':
         return -1, 'None'
 
-    pred = re.findall(r'\(([ABCDE])|([ABCDE])\)', reply)
+    pred = ANSWER_PATTERN.findall(reply)
 
     if len(pred) == 0:
         # for answer without (), match the last letter.
-        if reply[-1] in ['A', 'B', 'C', 'D', 'E']:
+        if reply[-1] in RESPONSE_CODES:
             pred = reply[-1]
 
         # for answer without option letter, use the last substr in options.
@@ -44,7 +73,7 @@ def check_answer(reply, answer, options):
 
             # last option as the answer
             if pos[last_idx] != -1:
-                pred = ['A', 'B', 'C', 'D', 'E'][last_idx]
+                pred = OPTION_LETTERS[last_idx]
 
             # not finded option and answer, invalid response
             else:
@@ -69,13 +98,182 @@ def check_answer(reply, answer, options):
             return 0, pred
 
 
-def statistics(records, uni_bench):
+def build_score_table(uni_bench):
+    """
+    Precompute the tables of UniBench used to score records, build it once to score many record sets.
+
+    Parameters:
+    - uni_bench: list of cases of UniBench
+
+    Return:
+    - score_table: A dict of arrays indexed by QA_id (tag and case of each QA), by tag (its L1 tag), by L1 tag
+      (its L0 tag) and by case (word size and QA size buckets), with tag names and bucket labels.
+    """
+
+    QA_num = max(QA['QA_id'] for item in uni_bench for QA in item['QAs']) + 1
+    QA_tag = np.full(QA_num, -1, dtype=np.int64)
+    QA_case = np.full(QA_num, -1, dtype=np.int64)
+    L2_ids, L1_ids, L0_ids = {}, {}, {}
+    word_sizes, QA_sizes = [], []
+
+    for idx, item in enumerate(uni_bench):
+        for QA in item['QAs']:
+            l0, l1, l2 = QA['tag'].split(', ')
+            L0_ids.setdefault(l0, len(L0_ids))
+            L1_ids.setdefault((l0, l1), len(L1_ids))
+            L2_ids.setdefault((l0, l1, l2), len(L2_ids))
+            QA_tag[QA['QA_id']] = L2_ids[(l0, l1, l2)]
+            QA_case[QA['QA_id']] = idx
+
+        word_sizes.append(len(item['prompt'].split()))
+        QA_sizes.append(len(item['QAs']))
+
+    score_table = {
+        'QA_tag': QA_tag,
+        'QA_case': QA_case,
+        'L2_names': [k[2] for k in L2_ids],
+        'L1_names': [k[1] for k in L1_ids],
+        'L0_names': list(L0_ids),
+        'L2_to_L1': np.array([L1_ids[k[:2]] for k in L2_ids], dtype=np.int64),
+        'L1_to_L0': np.array([L0_ids[k[0]] for k in L1_ids], dtype=np.int64),
+    }
+
+    # get the boundary size at 1/3 2/3 to decide few, middle, and many, middle use [], takes major cases beyond 1/3
+    for name, sizes in [('word', np.array(word_sizes)), ('QA', np.array(QA_sizes))]:
+        sorted_sizes = np.sort(sizes)
+        b1, b2 = sorted_sizes[len(sizes) // 3], sorted_sizes[len(sizes) * 2 // 3]
+        score_table[name + '_bucket'] = np.where(sizes < b1, 0, np.where(sizes <= b2, 1, 2))
+        score_table[name + '_ranges'] = ['[%d-%d]' % (sorted_sizes[0], b1 - 1), '[%d-%d]' % (b1, b2), \
+            '[%d-%d]' % (b2 + 1, sorted_sizes[-1])]
+
+    return score_table
+
+
+def records_to_arrays(records):
+    """
+    Convert records [[QA_id, model_true_false, model_response]] into columnar arrays.
+
+    Return:
+    - QA_ids: QA_id of each record.
+    - preds: model true (1), false (0) or invalid response (-1).
+    - responses: response code, 0-4 for the option A-E, 5 for invalid responses.
+    """
+
+    QA_ids = np.fromiter((r[0] for r in records), dtype=np.int64, count=len(records))
+    preds = np.fromiter((r[1] for r in records), dtype=np.int64, count=len(records))
+    responses = np.fromiter((RESPONSE_CODES.get(r[2], INVALID_RESPONSE) for r in records), dtype=np.int64, count=len(records))
+
+    return QA_ids, preds, responses
+
+
+def group_mean(groups, values, size):
+    """
+    Mean of values in each group 0..size-1, nan for empty groups.
+    """
+
+    counts = np.bincount(groups, minlength=size)
+    sums = np.bincount(groups, weights=values, minlength=size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+
+def first_seen(groups):
+    """
+    Unique groups in order of their first appearance.
+    """
+
+    uniques, first = np.unique(groups, return_index=True)
+
+    return uniques[np.argsort(first, kind='stable')]
+
+
+def score_records(records, score_table):
+    """
+    Compute the results of statistics() with grouped reductions over the records, without printing.
+
+    Parameters:
+    - records: model prediction records [[QA_id, model_true_false, model_response]],
+      or the arrays returned by records_to_arrays().
+    - score_table: tables of UniBench returned by build_score_table().
+
+    Return:
+    - results: the result dict of statistics().
+    """
+
+    QA_ids, preds, responses = records if isinstance(records, tuple) else records_to_arrays(records)
+    tag_ids = score_table['QA_tag'][QA_ids]
+    case_ids = score_table['QA_case'][QA_ids]
+    L2_to_L1, L1_to_L0 = score_table['L2_to_L1'], score_table['L1_to_L0']
+
+    # for invalid response, predict as 0
+    preds = np.maximum(preds, 0).astype(np.float64)
+    results = {}
+
+    # count distribution of selected option
+    option_ratio = np.bincount(responses, minlength=INVALID_RESPONSE + 1) / len(responses)
+    results['response-statistics'] = {k: round(float(v), 3) for k, v in \
+        zip(['A', 'B', 'C', 'D', 'E (N/A)', 'Invalid'], option_ratio)}
+
+    # count tag-level results, first get the mean accuracy across QAs of L2 tag then mean for the upper levels.
+    # tags are ordered by their first record, L2 (L1) scores are reduced in that order for their L1 (L0) tag.
+    L2_order = first_seen(tag_ids)
+    L2_score = group_mean(tag_ids, preds, len(L2_to_L1))
+    L1_order = first_seen(L2_to_L1[L2_order])
+    L1_score = group_mean(L2_to_L1[L2_order], L2_score[L2_order], len(L1_to_L0))
+    L0_order = first_seen(L1_to_L0[L1_order])
+    L0_score = group_mean(L1_to_L0[L1_order], L1_score[L1_order], len(score_table['L0_names']))
+
+    results['tag-L0'] = {}
+    results['tag-L1'] = {}
+    results['tag-L2'] = {}
+
+    for l0 in L0_order:
+        for l1 in L1_order[L1_to_L0[L1_order] == l0]:
+            for l2 in L2_order[L2_to_L1[L2_order] == l1]:
+                results['tag-L2'][score_table['L2_names'][l2]] = round(float(L2_score[l2]), 3)
+            results['tag-L1'][score_table['L1_names'][l1]] = round(float(L1_score[l1]), 3)
+        results['tag-L0'][score_table['L0_names'][l0]] = round(float(L0_score[l0]), 3)
+
+    # count case-level results, first get the mean accuracy across QAs of a text (the case Uniscore),
+    # then operate across texts. UniScoreA indicates QAs of a text are all correct.
+    case_num = len(score_table['word_bucket'])
+    case_mask = np.bincount(case_ids, minlength=case_num) > 0
+    case_uniScore = group_mean(case_ids, preds, case_num)[case_mask]
+    all_correct = (np.bincount(case_ids, weights=preds == 0, minlength=case_num) == 0)[case_mask].astype(np.float64)
+
+    for name, key in [('word', 'case-word-size'), ('QA', 'case-QA-size')]:
+        buckets = score_table[name + '_bucket'][case_mask]
+        ranges = score_table[name + '_ranges']
+        scores = group_mean(buckets, case_uniScore, 3)
+        scores_ac = group_mean(buckets, all_correct, 3)
+        results[key] = {}
+        for label, rng, score in zip(['few', 'middle', 'many'], ranges, scores):
+            results[key]['%s %s' % (label, rng)] = 'N/A' if np.isnan(score) else round(float(score), 3)
+        # keep the original key of word size "few  (all correct)"
+        for label, rng, score in zip(['few ' if name == 'word' else 'few', 'middle', 'many'], ranges, scores_ac):
+            results[key]['%s (all correct) %s' % (label, rng)] = 'N/A' if np.isnan(score) else round(float(score), 3)
+
+    # overall case-UniScore, macro accuracy for cases
+    results['case-UniScore'] = round(float(case_uniScore.mean()), 3)
+    results['UniScoreA'] = round(float(all_correct.mean()), 3)
+
+    # the final UniScore to report, micro for L1 tags. It's easier to report with more counted QAs than L2.
+    results['tag-L0-UniScore'] = round(sum(list(results['tag-L0'].values())) / len(results['tag-L0']), 3)
+    results['tag-L1-UniScore'] = round(sum(list(results['tag-L1'].values())) / len(results['tag-L1']), 3)
+    results['tag-L2-UniScore'] = round(sum(list(results['tag-L2'].values())) / len(results['tag-L2']), 3)
+
+    return results
+
+
+def statistics(records, uni_bench, score_table=None):
     """
     Statistics and Formatting for results ranked tag, complexity, co-variance, etc.
 
     Parameters:
     - records: model prediction records collected by tags: [[QA_id, model_true_false, model_response]].
     - uni_bench: list of cases of UniBench
+    - score_table: tables returned by build_score_table(uni_bench), built if not given.
 
     Return:
     - results: A result dict including:
@@ -202,138 +400,9 @@ def statistics(records, uni_bench):
         }
     }
 
-    # load information for each case and QA
-    case_records, tag_records, QA_info, results = {}, {}, {}, {}
-    word_sizes, QA_sizes, option_ratio = [], [], [0] * 6
-
-    for idx, item in enumerate(uni_bench):
-        for QA in item['QAs']:
-            QA_info[QA['QA_id']] = {'tag': QA['tag'], 'prompt_id': idx}
-
-        word_size = len(item['prompt'].split())
-        word_sizes.append(word_size)
-        QA_sizes.append(len(item['QAs']))
-        case_records[idx] = {'word_size': word_size, 'QA_size': len(item['QAs']), 'preds': []}
-
-    # put model predictions into case_record and tag_records
-    for QA_id, pred, response in records:
-        l0, l1, l2 = QA_info[QA_id]['tag'].split(', ')
-        prompt_id = QA_info[QA_id]['prompt_id']
-
-        # for invalid response, predict as 0
-        if pred < 0:
-            pred = 0
-
-        if l0 not in tag_records:
-            tag_records[l0] = {}
-        if l1 not in tag_records[l0]:
-            tag_records[l0][l1] = {}
-        if l2 not in tag_records[l0][l1]:
-            tag_records[l0][l1][l2] = []
-
-        tag_records[l0][l1][l2].append(pred)
-        case_records[prompt_id]['preds'].append(pred)
-
-        # count distribution of selected option
-        if response in ['A', 'B', 'C', 'D', 'E']:
-            option_ratio[ord(response) - ord('A')] += 1
-        else:
-            option_ratio[-1] += 1
-
-    option_sum = sum(option_ratio)
-    option_ratio = [_ / option_sum for _ in option_ratio]
-    results['response-statistics'] = {'A': round(option_ratio[0], 3), 'B': round(option_ratio[1], 3), \
-        'C': round(option_ratio[2], 3), 'D': round(option_ratio[3], 3), \
-        'E (N/A)': round(option_ratio[4], 3), 'Invalid': round(option_ratio[5], 3)}
-
-    # count tag-level results
-    results['tag-L0'] = {}
-    results['tag-L1'] = {}
-    results['tag-L2'] = {}
-
-    for l0 in tag_records.keys():
-        l0_score = []
-
-        for l1 in tag_records[l0].keys():
-            l1_score = []
-
-            for l2 in tag_records[l0][l1].keys():
-                l2_score = sum(tag_records[l0][l1][l2]) / len(tag_records[l0][l1][l2])
-                l1_score.append(l2_score)
-                results['tag-L2'][l2] = round(l2_score, 3)
-
-            l1_score = sum(l1_score) / len(l1_score)
-            l0_score.append(l1_score)
-            results['tag-L1'][l1] = round(l1_score, 3)
-
-        l0_score = sum(l0_score) / len(l0_score)
-        results['tag-L0'][l0] = round(l0_score, 3)
-
-    # calculate the divide size and count case-level results
-    # sort word_sizes, QA_sizes and get the boundary size at 1/3 2/3 to decide few, middle, and many
-    word_sizes.sort()
-    QA_sizes.sort()
-    word_b1, word_b2 = word_sizes[len(word_sizes) // 3], word_sizes[len(word_sizes) * 2 // 3]
-    QA_b1, QA_b2 = QA_sizes[len(QA_sizes) // 3], QA_sizes[len(QA_sizes) * 2 // 3]
-    few_words, mid_words, many_words = [], [], []
-    few_QAs, mid_QAs, many_QAs = [], [], []
-    few_words_ac, mid_words_ac, many_words_ac = [], [], [] # all correct
-    few_QAs_ac, mid_QAs_ac, many_QAs_ac = [], [], []
-    whole, whole_ac = [], []
-
-    for k, v in case_records.items():
-        if len(v['preds']) == 0:
-            continue
-        case_uniScore = sum(v['preds']) / len(v['preds'])
-        all_correct = 0 if 0 in v['preds'] else 1
-        whole.append(case_uniScore)
-        whole_ac.append(all_correct)
-
-        if v['word_size'] < word_b1:
-            few_words.append(case_uniScore)
-            few_words_ac.append(all_correct)
-        elif v['word_size'] <= word_b2:
-            mid_words.append(case_uniScore)
-            mid_words_ac.append(all_correct)
-        else:
-            many_words.append(case_uniScore)
-            many_words_ac.append(all_correct)
-
-        # middle use [], takes major cases beyond 1/3
-        if v['QA_size'] < QA_b1:
-            few_QAs.append(case_uniScore)
-            few_QAs_ac.append(all_correct)
-        elif v['QA_size'] <= QA_b2:
-            mid_QAs.append(case_uniScore)
-            mid_QAs_ac.append(all_correct)
-        else:
-            many_QAs.append(case_uniScore)
-            many_QAs_ac.append(all_correct)
-
-    results['case-word-size'] = \
-        {'few [%d-%d]' % (word_sizes[0], word_b1 - 1): round(sum(few_words) / len(few_words), 3) if len(few_words) > 0 else 'N/A', \
-         'middle [%d-%d]' % (word_b1, word_b2): round(sum(mid_words) / len(mid_words), 3) if len(mid_words) > 0 else 'N/A', \
-         'many [%d-%d]' % (word_b2 + 1, word_sizes[-1]): round(sum(many_words) / len(many_words), 3) if len(many_words) > 0 else 'N/A', \
-         'few  (all correct) [%d-%d]' % (word_sizes[0], word_b1 - 1): round(sum(few_words_ac) / len(few_words_ac), 3) if len(few_words_ac) > 0 else 'N/A', \
-         'middle (all correct) [%d-%d]' % (word_b1, word_b2): round(sum(mid_words_ac) / len(mid_words_ac), 3) if len(mid_words_ac) > 0 else 'N/A', \
-         'many (all correct) [%d-%d]' % (word_b2 + 1, word_sizes[-1]): round(sum(many_words_ac) / len(many_words_ac), 3) if len(many_words_ac) > 0 else 'N/A'}
-
-    results['case-QA-size'] = \
-        {'few [%d-%d]' % (QA_sizes[0], QA_b1 - 1): round(sum(few_QAs) / len(few_QAs), 3) if len(few_QAs) > 0 else 'N/A',\
-         'middle [%d-%d]' % (QA_b1, QA_b2): round(sum(mid_QAs) / len(mid_QAs), 3) if len(mid_QAs) > 0 else 'N/A', \
-         'many [%d-%d]' % (QA_b2 + 1, QA_sizes[-1]): round(sum(many_QAs) / len(many_QAs), 3) if len(many_QAs) > 0 else 'N/A', \
-         'few (all correct) [%d-%d]' % (QA_sizes[0], QA_b1 - 1): round(sum(few_QAs_ac) / len(few_QAs_ac), 3) if len(few_QAs_ac) > 0 else 'N/A',\
-         'middle (all correct) [%d-%d]' % (QA_b1, QA_b2): round(sum(mid_QAs_ac) / len(mid_QAs_ac), 3) if len(mid_QAs_ac) > 0 else 'N/A', \
-         'many (all correct) [%d-%d]' % (QA_b2 + 1, QA_sizes[-1]): round(sum(many_QAs_ac) / len(many_QAs_ac), 3) if len(many_QAs_ac) > 0 else 'N/A'}
-
-    # overall case-UniScore, macro accuracy for cases, UniScoreA indicates QAs of a text are all correct
-    results['case-UniScore'] = round(sum(whole) / len(whole), 3)
-    results['UniScoreA'] = round(sum(whole_ac) / len(whole_ac), 3)
-
-    # the final UniScore to report, micro for L1 tags. It's easier to report with more counted QAs than L2.
-    results['tag-L0-UniScore'] = round(sum(list(results['tag-L0'].values())) / len(results['tag-L0']), 3)
-    results['tag-L1-UniScore'] = round(sum(list(results['tag-L1'].values())) / len(results['tag-L1']), 3)
-    results['tag-L2-UniScore'] = round(sum(list(results['tag-L2'].values())) / len(results['tag-L2']), 3)
+    if score_table is None:
+        score_table = build_score_table(uni_bench)
+    results = score_records(records, score_table)
 
     # print results
     print('\n\n==================== response statistics ====================')
@@ -397,7 +466,322 @@ def statistics(records, uni_bench):
     return results
 
 
-def uni_eval(generate, understand, uni_bench, save_path='', img_num=4):
+class GeneratedImage:
+    """
+    An image returned in memory by generate(), passed to understand() directly instead of a file path.
+
+    Parameters:
+    - image: PIL image, HxWx3 uint8 array, or 3xHxW / HxWx3 uint8 tensor (on any device).
+    - path: The archive path of the image in save_path, '' if not saved.
+    """
+
+    def __init__(self, image, path=''):
+        self.image = image
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+
+def archive_image(image, path):
+    """
+    Save an in-memory image to path, run by the background writer to keep encoding off the critical path.
+    """
+
+    from PIL import Image
+
+    try:
+        if isinstance(image, torch.Tensor):
+            image = image.detach().cpu()
+            if image.shape[0] == 3:
+                image = image.permute(1, 2, 0)
+            image = image.numpy()
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(np.asarray(image, dtype=np.uint8))
+        image.save(path)
+    except Exception:
+        print('Failed to save %s:' % path)
+        traceback.print_exc()
+
+
+def generate_case(generate, item, save_path='', img_num=4, writer=None):
+    """
+    Generate N images for a case and move them into the case folder of save_path.
+    In-memory images returned by generate are kept for understanding and archived by the writer
+    (a ThreadPoolExecutor, saved at once if None).
+
+    Return:
+    - imgs: paths or GeneratedImage of the generated images, '' for failed generation.
+    """
+
+    imgs = list(generate(item['prompt'], img_num, os.path.join(save_path, 'temp')))
+    save_dir = ''
+
+    if save_path != '':
+        save_dir = os.path.join(save_path, str(item['prompt_id']))
+        os.makedirs(save_dir, exist_ok=True)
+        temp_dir = os.path.join(save_path, 'temp')
+        if os.path.exists(temp_dir) and len(os.listdir(temp_dir)) > 0:
+            os.system('mv %s/* %s/' % (temp_dir, save_dir))
+        imgs = [os.path.join(save_dir, os.path.basename(img)) if isinstance(img, str) and img != '' else img for img in imgs]
+
+    for i, img in enumerate(imgs):
+        if isinstance(img, str):
+            continue
+        path = os.path.join(save_dir, 'image_%d.png' % i) if save_dir != '' else ''
+        if path != '' and writer is not None:
+            writer.submit(archive_image, img, path)
+        elif path != '':
+            archive_image(img, path)
+        imgs[i] = GeneratedImage(img, path)
+
+    return imgs
+
+
+def understand_case(understand, item, imgs, understand_batch=None, score_options=None):
+    """
+    Answer all QAs of a case for each generated image.
+
+    With score_options, a callback (img, prompts) returning the probabilities of the options A-E for each
+    question from one forward pass, the most likely option is the response and no reply is generated.
+
+    Return:
+    - records: model prediction records of the case [[QA_id, model_true_false, model_response]],
+      scored records end with the option probabilities [..., [p_A, ..., p_E]].
+    - textRecord: understanding outputs in text format, with the raw replies to parse them again by rescore().
+    """
+
+    input_prompt = item['prompt']
+    QAs = item['QAs']
+    QA_options = [parse_options(QA['question']) for QA in QAs]
+    records, textRecord = [], ''
+
+    # Call the image understanding function for each generated image, in-memory images are passed directly
+    for img in imgs:
+        image = img.image if isinstance(img, GeneratedImage) else img
+        probs = [None] * len(QAs)
+        if img == '':
+            replies = [''] * len(QAs)
+        elif score_options is not None:
+            probs = [[round(float(p), 4) for p in _] for _ in score_options(image, [QA['question'] for QA in QAs])]
+            replies = ['(%s)' % OPTION_LETTERS[int(np.argmax(_))] for _ in probs]
+        elif understand_batch is not None:
+            replies = understand_batch(image, [QA['question'] for QA in QAs])
+        else:
+            replies = [understand(image, QA['question']) for QA in QAs]
+
+        for QA, options, reply, prob in zip(QAs, QA_options, replies, probs):
+            answer =  QA['answer']
+            isCorrect, response = check_answer(reply, answer, options)
+            if prob is None:
+                records.append([QA['QA_id'], isCorrect, response])
+                textRecord += 'img_name:%s\ninput_prompt:%s\nquestion:%s\nanswer:%s\nresponse:%s\nreply:%s\nmodel:%d\n\n' \
+                    % (img, input_prompt, QA['question'], QA['answer'], response, json.dumps(reply, ensure_ascii=False), isCorrect)
+            else:
+                records.append([QA['QA_id'], isCorrect, response, prob])
+                textRecord += 'img_name:%s\ninput_prompt:%s\nquestion:%s\nanswer:%s\nresponse:%s\nreply:%s\nprobs:%s\nmodel:%d\n\n' \
+                    % (img, input_prompt, QA['question'], QA['answer'], response, json.dumps(reply, ensure_ascii=False), json.dumps(prob), isCorrect)
+
+    return records, textRecord
+
+
+def understand_cases(understand, cases, understand_batch=None, score_options=None, understand_many=None):
+    """
+    Answer all QAs of several cases [(item, imgs)], see understand_case().
+
+    With understand_many, a callback (imgs, prompts) answering (image, question) pairs in batches, the pairs of
+    all cases are answered in one call, so the judge batches questions across images and cases.
+    score_options takes precedence over it.
+
+    Return:
+    - results: (records, textRecord) of each case.
+    """
+
+    if understand_many is None or score_options is not None:
+        return [understand_case(understand, item, imgs, understand_batch, score_options) for item, imgs in cases]
+
+    pairs = [(img.image if isinstance(img, GeneratedImage) else img, QA['question'])
+             for item, imgs in cases for img in imgs if img != '' for QA in item['QAs']]
+    replies = iter(understand_many([_[0] for _ in pairs], [_[1] for _ in pairs]) if len(pairs) > 0 else [])
+
+    # understand_case() asks for the replies of each image in the order the pairs were collected
+    return [understand_case(understand, item, imgs, lambda img, prompts: [next(replies) for _ in prompts])
+            for item, imgs in cases]
+
+
+def save_text_records(save_path, item, textRecord):
+    """
+    Save understanding outputs of a case into its folder, skipped if save_path is ''.
+    """
+
+    if save_path != '':
+        save_dir = os.path.join(save_path, str(item['prompt_id']))
+        os.makedirs(save_dir, exist_ok=True)
+        open(os.path.join(save_dir, 'text_records.txt'), 'w').write(textRecord)
+
+
+def records_store(save_path, worker):
+    """
+    Path of the append-only records store of a worker, all stores of a run are under save_path/records.
+    """
+
+    return os.path.join(save_path, 'records', 'worker_%s.jsonl' % worker)
+
+
+def append_records(store, item, case_records):
+    """
+    Append the records of a finished case to a JSONL store as one line, skipped if store is ''.
+    The line is flushed to disk, so a crash only loses the unfinished cases.
+    A line truncated by a crash is ended first, so the record is not merged into it on --resume.
+    """
+
+    if store != '':
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        truncated = False
+        if os.path.exists(store) and os.path.getsize(store) > 0:
+            with open(store, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b'\n'
+        with open(store, 'a') as f:
+            if truncated:
+                f.write('\n')
+            f.write(json.dumps({'prompt_id': item['prompt_id'], 'records': case_records}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def load_records(save_path, uni_bench, img_num=4):
+    """
+    Merge the records stores of all workers under save_path/records.
+
+    Return:
+    - done: A dict mapping prompt_id (str) to case records, only for cases with complete records.
+    """
+
+    store_dir = os.path.join(save_path, 'records')
+    stored = {}
+    if os.path.isdir(store_dir):
+        for name in sorted(os.listdir(store_dir)):
+            if not name.endswith('.jsonl'):
+                continue
+            for line in open(os.path.join(store_dir, name)):
+                # the last line may be truncated by a crash
+                try:
+                    case = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                stored[str(case['prompt_id'])] = case['records']
+
+    done = {}
+    for item in uni_bench:
+        case_records = stored.get(str(item['prompt_id']))
+        if case_records is not None and len(case_records) == img_num * len(item['QAs']):
+            done[str(item['prompt_id'])] = case_records
+
+    return done
+
+
+def parse_text_records(path):
+    """
+    Parse a text_records.txt file saved by save_text_records().
+
+    Return:
+    - entries: [[question, model_true_false, model_response, raw_reply]], raw_reply is None for files saved
+      before the replies were kept.
+    """
+
+    entries = []
+    for match in TEXT_RECORD_PATTERN.finditer(open(path).read()):
+        _, _, question, _, response, reply, _, isCorrect = match.groups()
+        entries.append([question, int(isCorrect), response, json.loads(reply) if reply is not None else None])
+
+    return entries
+
+
+def rescore_case(task):
+    """
+    Rebuild the records of a case from its text_records.txt, run by the processes of rescore().
+
+    Parameters:
+    - task: (path to text_records.txt, the case of UniBench, reparse). With reparse, check_answer() is called
+      again on the raw replies, entries without a raw reply keep their saved results.
+
+    Return:
+    - records: records of the case [[QA_id, model_true_false, model_response]].
+    - n_missing: the number of entries without a raw reply when reparse.
+    """
+
+    path, item, reparse = task
+    QAs = {QA['question']: (QA, parse_options(QA['question'])) for QA in item['QAs']}
+    records, n_missing = [], 0
+
+    for question, isCorrect, response, reply in parse_text_records(path):
+        if question not in QAs:
+            continue
+        QA, options = QAs[question]
+        if reparse and reply is not None:
+            isCorrect, response = check_answer(reply, QA['answer'], options)
+        elif reparse:
+            n_missing += 1
+        records.append([QA['QA_id'], isCorrect, response])
+
+    return records, n_missing
+
+
+def rescore(save_paths, uni_bench='uni_bench.json', reparse=False, workers=8):
+    """
+    Compute results from saved runs without models, the results.json of each run is rewritten.
+
+    Parameters:
+    - save_paths: The save paths of runs, the per-worker folders save_path_[GPU_ID] of a run are included.
+    - uni_bench: The path of uni_bench.json.
+    - reparse: Parse the saved raw replies with check_answer() again, e.g., after the parsing rules change.
+    - workers: The number of processes to read and parse text_records.txt files.
+
+    Returns:
+    - all_results: A dict mapping each save path to its results.
+    """
+
+    uni_bench = json.load(open(uni_bench))
+    cases = {str(item['prompt_id']): item for item in uni_bench}
+    score_table = build_score_table(uni_bench)
+    all_results = {}
+
+    with multiprocessing.Pool(workers) as pool:
+        for save_path in save_paths:
+            save_path = save_path.rstrip('/')
+
+            # case folders of the run and its per-worker folders, a case found twice uses the later folder
+            # sibling runs such as save_path_flow also match the glob, only GPU id suffixes are worker folders
+            run_dirs = [save_path] + sorted(_ for _ in glob.glob(save_path + '_*') if os.path.isdir(_)
+                                            and WORKER_DIR_PATTERN.fullmatch(_[len(save_path):]))
+            case_files = {}
+            for run_dir in run_dirs:
+                for prompt_id in os.listdir(run_dir) if os.path.isdir(run_dir) else []:
+                    path = os.path.join(run_dir, prompt_id, 'text_records.txt')
+                    if prompt_id in cases and os.path.isfile(path):
+                        case_files[prompt_id] = path
+
+            tasks = [(case_files[str(item['prompt_id'])], item, reparse) for item in uni_bench if str(item['prompt_id']) in case_files]
+            records, n_missing = [], 0
+            for case_records, case_missing in pool.imap(rescore_case, tasks, chunksize=16):
+                records.extend(case_records)
+                n_missing += case_missing
+
+            print('\n\n\n!!!!!!!!!!!!!!!! Rescore %s: %d of %d cases !!!!!!!!!!!!!!!!' % (save_path, len(tasks), len(uni_bench)))
+            if n_missing > 0:
+                print('%d answers have no saved reply, their saved results are kept.' % n_missing)
+            if len(records) == 0:
+                continue
+
+            all_results[save_path] = statistics(records, uni_bench, score_table)
+            open(os.path.join(save_path, 'results.json'), 'w').write(json.dumps(all_results[save_path], indent=4))
+
+    return all_results
+
+
+def uni_eval(generate, understand, uni_bench, save_path='', img_num=4, understand_batch=None, store='', score_options=None,
+             understand_many=None, judge_cases=8):
     """
     Evaluate unfied Multimodal Understanding and Generation.
 
@@ -407,6 +791,13 @@ def uni_eval(generate, understand, uni_bench, save_path='', img_num=4):
     - uni_bench: A list of loaded UniBench.
     - save_path: Path to save all generated images and answers for vis and analysis, defualt no saving.
     - img_num: generate N=4 images for each prompt
+    - understand_batch: Optional callback answering all questions of one image in a call (img, prompts),
+      the image is encoded once and shared by the questions. Fall back to understand if None.
+    - store: Optional JSONL records store, records of each finished case are appended to it.
+    - score_options: Optional callback (img, prompts) returning the option probabilities of each question,
+      used instead of understand to answer by the most likely option.
+    - understand_many: Optional callback answering (image, question) pairs in batches (imgs, prompts),
+      the QAs of judge_cases cases are answered in one call.
 
     Returns:
     - records: Return the records for batch evaluation.
@@ -414,41 +805,105 @@ def uni_eval(generate, understand, uni_bench, save_path='', img_num=4):
      
     # record model prediction for each QA [[QA_id, model_pred], ...]
     records = []
+    # seconds spent on understanding, generation is not counted in QA/s
+    und_cost = 0.0
+
+    # in-memory images are archived by background threads
+    with ThreadPoolExecutor(ARCHIVE_WORKERS) as writer:
+        cases = []
+        for i, item in tqdm(enumerate(uni_bench), total=len(uni_bench), desc="Evaluating Cases"):
+
+            # Call the image generation function to generate N imgs
+            imgs = generate_case(generate, item, save_path, img_num, writer)
+            cases.append((item, imgs))
+
+            # cases wait for the window of understand_many to fill up
+            if understand_many is not None and len(cases) < judge_cases and i + 1 < len(uni_bench):
+                continue
+
+            # save understanding outputs via txt files
+            start = time.time()
+            results = understand_cases(understand, cases, understand_batch, score_options, understand_many)
+            und_cost += time.time() - start
+            for (item, _), (case_records, textRecord) in zip(cases, results):
+                records.extend(case_records)
+                save_text_records(save_path, item, textRecord)
+                append_records(store, item, case_records)
+            cases = []
+
+    print('Understanding throughput: %d QAs in %.1fs, %.2f QA/s' % (len(records), und_cost, len(records) / und_cost if und_cost > 0 else 0))
+
+    uniScores = statistics(records, uni_bench)
+    if save_path != '':
+        open(os.path.join(save_path, 'results.json'), 'w').write(json.dumps(uniScores, indent=4))
+
+    return records
 
-    for i, item in tqdm(enumerate(uni_bench), total=len(uni_bench), desc="Evaluating Cases"):
 
-        input_prompt = item['prompt']
-        prompt_id = item['prompt_id']
-        QAs = item['QAs']
+def uni_gen(generate, uni_bench, save_path, img_num=4):
+    """
+    Phase 1 of the two-phase evaluation, generate images for all cases and save an image manifest.
 
-        # Call the image generation function to generate N imgs
-        imgs = generate(input_prompt, img_num, os.path.join(save_path, 'temp'))
+    Parameters:
+    - generate: A callback function that generates N image (text, num, temp_save_path).
+    - uni_bench: A list of loaded UniBench (or a shard).
+    - save_path: Path to save generated images and manifest.json.
+    - img_num: generate N=4 images for each prompt
 
-        # save understanding outputs via txt files
-        textRecord = ''
+    Returns:
+    - manifest: A dict mapping prompt_id (str) to the paths of generated images.
+    """
 
-        # Call the image understanding function for each generated image
-        for img in imgs:
-            for QA in QAs:
-                if img != '':
-                    reply = understand(img, QA['question'])
-                else:
-                    reply = ''
+    manifest = {}
 
-                answer =  QA['answer']
-                options = [_.split(',')[0] for _ in QA['question'].split('\n')[1].split(') ')[1:]]
-                isCorrect, response = check_answer(reply, answer, options)
-                records.append([QA['QA_id'], isCorrect, response])
-                textRecord += 'img_name:%s\ninput_prompt:%s\nquestion:%s\nanswer:%s\nresponse:%s\nmodel:%d\n\n' \
-                    % (img, input_prompt, QA['question'], QA['answer'], response, isCorrect)
-        
-        if save_path != '':
-            save_dir = os.path.join(save_path, str(prompt_id))
-            os.makedirs(save_dir, exist_ok=True)
-            temp_dir = os.path.join(save_path, 'temp')
-            if os.path.exists(temp_dir) and len(os.listdir(temp_dir)) > 0:
-                os.system('mv %s/* %s/' % (temp_dir, save_dir))
-            open(os.path.join(save_dir, 'text_records.txt'), 'w').write(textRecord)
+    # the manifest is saved after all in-memory images are archived
+    with ThreadPoolExecutor(ARCHIVE_WORKERS) as writer:
+        for item in tqdm(uni_bench, total=len(uni_bench), desc="Generating Cases"):
+            manifest[str(item['prompt_id'])] = [str(img) for img in generate_case(generate, item, save_path, img_num, writer)]
+
+    os.makedirs(save_path, exist_ok=True)
+    open(os.path.join(save_path, 'manifest.json'), 'w').write(json.dumps(manifest, indent=4))
+
+    return manifest
+
+
+def uni_und(understand, uni_bench, manifest, save_path='', img_num=4, understand_batch=None, store='', score_options=None,
+            understand_many=None, judge_cases=8):
+    """
+    Phase 2 of the two-phase evaluation, answer QAs of all cases on the images listed in the manifest.
+
+    Parameters:
+    - understand: A callback function that understans images with text outputs (img, prompt).
+    - uni_bench: A list of loaded UniBench (or a shard).
+    - manifest: The image manifest from uni_gen(), cases not in the manifest count as failed generation.
+    - save_path: Path to save answers and results, defualt no saving.
+    - img_num: N images for each prompt, used for cases missing in the manifest.
+    - understand_batch: Optional batched understanding callback (img, prompts).
+    - store: Optional JSONL records store, records of each finished case are appended to it.
+    - score_options: Optional option scoring callback (img, prompts), see uni_eval().
+    - understand_many: Optional batched (image, question) pairs callback (imgs, prompts), see uni_eval().
+
+    Returns:
+    - records: Return the records for batch evaluation.
+    """
+
+    records = []
+    window = judge_cases if understand_many is not None else 1
+    start = time.time()
+
+    pbar = tqdm(total=len(uni_bench), desc="Understanding Cases")
+    for i in range(0, len(uni_bench), window):
+        cases = [(item, manifest.get(str(item['prompt_id']), [''] * img_num)) for item in uni_bench[i:i + window]]
+        results = understand_cases(understand, cases, understand_batch, score_options, understand_many)
+        for (item, _), (case_records, textRecord) in zip(cases, results):
+            records.extend(case_records)
+            save_text_records(save_path, item, textRecord)
+            append_records(store, item, case_records)
+        pbar.update(len(cases))
+    pbar.close()
+
+    cost = time.time() - start
+    print('Understanding throughput: %d QAs in %.1fs, %.2f QA/s' % (len(records), cost, len(records) / cost if cost > 0 else 0))
 
     uniScores = statistics(records, uni_bench)
     if save_path != '':
@@ -568,6 +1023,31 @@ def load_model(model_name):
     return model
 
 
+def get_understand_batch(model):
+    """
+    Return the batched understanding callback of a model, None if the model only supports understand.
+    """
+    return getattr(model, 'understand_batch', None)
+
+
+def get_understand_many(model):
+    """
+    Return the batched (image, question) pairs callback of a model, or None if it is not defined.
+    """
+    return getattr(model, 'understand_many', None)
+
+
+def get_score_options(model, score=False):
+    """
+    Return the option scoring callback of a model if score, None to answer by generation.
+    """
+    if not score:
+        return None
+    if getattr(model, 'score_options', None) is None:
+        print('%s has no score_options(), questions are answered by generation.' % type(model).__name__)
+    return getattr(model, 'score_options', None)
+
+
 # Setting seeds helps with reproducibility.
 # Note that different devices,  CUDA, and dependency may lead to different results.
 # Without seed, the difference of overall UniScore is generally within 1%.
@@ -583,23 +1063,245 @@ def seed_everything(seed=1024):
         torch.backends.cudnn.benchmark = False
 
 
-# process partail cases for batch eval
-def process_chunk(model_name, chunk, save_path, gpu_id, extra_model):
+# run the evaluation of one worker, phase in ['interleave', 'two_phase', 'gen', 'und']
+def run_worker(model_name, uni_bench, save_path, gpu_id, extra_model='', phase='interleave', manifest=None, store='', score=False):
     os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
-    model = load_model(model_name)
+    # put the extra model in another gpu if there are multi-gpus (avoid out-of-memory)
+    und_device = 'cuda:1' if ',' in gpu_id else 'cuda:0'
+
+    if phase == 'interleave':
+        model = load_model(model_name)
+        seed_everything()
+
+        # for Unified model
+        if extra_model == '':
+            return uni_eval(model.generate, model.understand, uni_bench, save_path,
+                            understand_batch=get_understand_batch(model), store=store,
+                            score_options=get_score_options(model, score), understand_many=get_understand_many(model))
+
+        # Gen-only eval
+        else:
+            model_ = load_model(extra_model)
+            model_.model.to(und_device)
+            return uni_eval(model.generate, model_.understand, uni_bench, save_path,
+                            understand_batch=get_understand_batch(model_), store=store,
+                            score_options=get_score_options(model_, score), understand_many=get_understand_many(model_))
+
+    # phase 1: load the generation model once and generate images for all cases
+    model = None
+    if phase in ['two_phase', 'gen']:
+        model = load_model(model_name)
+        seed_everything()
+        manifest = uni_gen(model.generate, uni_bench, save_path)
+        if phase == 'gen':
+            return manifest
+
+    # phase 2: load the understanding model once, gen-only models are released before loading the extra model
+    if extra_model != '':
+        if model is not None:
+            del model
+            gc.collect()
+            torch.cuda.empty_cache()
+        model = load_model(extra_model)
+        model.model.to(und_device)
+    elif model is None:
+        model = load_model(model_name)
     seed_everything()
 
-    if extra_model == '':
-        return uni_eval(model.generate, model.understand, chunk, save_path + '_' + gpu_id)
+    return uni_und(model.understand, uni_bench, manifest, save_path,
+                   understand_batch=get_understand_batch(model), store=store,
+                   score_options=get_score_options(model, score), understand_many=get_understand_many(model))
 
-    else:
-        model_ = load_model(extra_model)
-        # put in another gpu if there are multi-gpus
-        model_.model.to('cuda:1' if ',' in gpu_id else 'cuda:0')
-        return uni_eval(model.generate, model_.understand, chunk, save_path + '_' + gpu_id)
 
+# persistent worker of the dynamic scheduler, stages in ['eval', 'gen', 'und']
+# the model is loaded once per stage, then batches of cases are pulled from the stage queue until a None task
+def queue_worker(model_name, save_path, gpu_id, extra_model, stages, task_queues, result_queue, store='', score=False, img_num=4):
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+    # put the extra model in another gpu if there are multi-gpus (avoid out-of-memory)
+    und_device = 'cuda:1' if ',' in gpu_id else 'cuda:0'
+
+    model, und_model = None, None
+    for stage in stages:
+        if stage in ['eval', 'gen']:
+            model = load_model(model_name)
+            und_model = model
+            if stage == 'eval' and extra_model != '':
+                und_model = load_model(extra_model)
+                und_model.model.to(und_device)
+
+        # gen-only models are released before loading the extra model, und_model still refers to it after 'gen'
+        elif extra_model != '':
+            model = und_model = None
+            gc.collect()
+            torch.cuda.empty_cache()
+            und_model = load_model(extra_model)
+            und_model.model.to(und_device)
+        elif model is None:
+            model = load_model(model_name)
+            und_model = model
+        seed_everything()
+        score_options = get_score_options(und_model, score) if stage != 'gen' else None
+
+        # images of the stage are archived before the worker reports the stage is finished
+        writer = ThreadPoolExecutor(ARCHIVE_WORKERS)
+        while True:
+            task = task_queues[stage].get()
+            if task is None:
+                break
+
+            cases, manifest = task
+            start = time.time()
+            result = {} if stage == 'gen' else []
+            n_finished = 0
+            cases_imgs = []
+            for item in cases:
+                # a failed case is skipped and left to --resume, the worker goes on with other cases
+                try:
+                    if stage == 'gen':
+                        result[str(item['prompt_id'])] = [str(img) for img in generate_case(model.generate, item, save_path, img_num, writer)]
+                        n_finished += 1
+                    elif stage == 'eval':
+                        cases_imgs.append((item, generate_case(model.generate, item, save_path, img_num, writer)))
+                    else:
+                        cases_imgs.append((item, manifest.get(str(item['prompt_id']), [''] * img_num)))
+                except Exception:
+                    print('Case %s failed on worker %s:' % (item['prompt_id'], gpu_id))
+                    traceback.print_exc()
+
+            # the QAs of a task are answered together by understand_many, otherwise case by case
+            understand_many = get_understand_many(und_model) if stage != 'gen' and score_options is None else None
+            understand_batch = get_understand_batch(und_model) if stage != 'gen' else None
+            results = None
+            if understand_many is not None and len(cases_imgs) > 0:
+                try:
+                    results = understand_cases(und_model.understand, cases_imgs, understand_batch, score_options, understand_many)
+                except Exception:
+                    # a failed batch is retried case by case, so only the cases that really fail are skipped
+                    print('Batched cases %s failed on worker %s, retrying case by case:'
+                          % ([item['prompt_id'] for item, _ in cases_imgs], gpu_id))
+                    traceback.print_exc()
+            for i, (item, imgs) in enumerate(cases_imgs):
+                try:
+                    if results is not None:
+                        case_records, textRecord = results[i]
+                    else:
+                        case_records, textRecord = understand_case(und_model.understand, item, imgs, understand_batch, score_options)
+                    result.extend(case_records)
+                    save_text_records(save_path, item, textRecord)
+                    append_records(store, item, case_records)
+                    n_finished += 1
+                except Exception:
+                    print('Case %s failed on worker %s:' % (item['prompt_id'], gpu_id))
+                    traceback.print_exc()
+            result_queue.put((gpu_id, n_finished, len(cases), result, time.time() - start))
+
+        # tell the parent this worker has finished the stage
+        writer.shutdown()
+        result_queue.put((gpu_id, 0, 0, None, 0))
+
+
+def schedule(model_name, uni_bench, save_path, gpus, extra_model='', phase='interleave', manifest=None, batch_cases=2, score=False,
+             img_num=4):
+    """
+    Dynamic multi-GPU evaluation, small batches of cases are handed out to workers as they finish,
+    so the slowest worker no longer decides the wall-clock time.
+    Failed cases and dead workers are reported without stopping the run, their cases are left to --resume.
+
+    Parameters:
+    - gpus: A list of GPU ids, one persistent worker for each (e.g., ['0', '1'] or ['0,1', '2,3']).
+    - manifest: The image manifest for the 'und' phase.
+    - batch_cases: The number of cases in a task, small batches balance workers better.
+    - img_num: N images for each prompt.
+    - others: See main().
 
-def main(model_name, gpus='0', save_path='', uni_bench='uni_bench.json', extra_model=''):
+    Returns:
+    - records: The merged records of all workers, or the merged manifest for the 'gen' phase.
+    """
+
+    stages = {'interleave': ['eval'], 'two_phase': ['gen', 'und'], 'gen': ['gen'], 'und': ['und']}[phase]
+    # one queue per stage, a fast worker never takes the end signal of a stage it has not reached
+    task_queues = {stage: multiprocessing.Queue() for stage in stages}
+    result_queue = multiprocessing.Queue()
+
+    workers = []
+    for gpu_id in gpus:
+        worker = multiprocessing.Process(target=queue_worker, args=(
+            model_name, save_path + '_' + gpu_id, gpu_id, extra_model, stages, task_queues, result_queue,
+            records_store(save_path, gpu_id) if save_path != '' else '', score, img_num))
+        worker.start()
+        workers.append(worker)
+
+    records, manifest = [], manifest or {}
+    throughput = {}
+    # workers killed by e.g. out-of-memory or segfault, the others take over the remaining tasks
+    dead = set()
+    for stage in stages:
+        # cases failed in the generation stage are left to --resume
+        stage_cases = [item for item in uni_bench if str(item['prompt_id']) in manifest] \
+            if stage == 'und' and 'gen' in stages else uni_bench
+        for i in range(0, len(stage_cases), batch_cases):
+            cases = stage_cases[i:i + batch_cases]
+            task_manifest = {str(item['prompt_id']): manifest[str(item['prompt_id'])]
+                             for item in cases if str(item['prompt_id']) in manifest} if stage == 'und' else None
+            task_queues[stage].put((cases, task_manifest))
+        for _ in workers:
+            task_queues[stage].put(None)
+
+        # [finished cases, busy seconds, answered QAs] of each worker
+        stats = {gpu_id: [0, 0.0, 0] for gpu_id in gpus}
+        done = set()
+        n_failed = 0
+        pbar = tqdm(total=len(stage_cases), desc="Scheduling Cases (%s)" % stage)
+        while len(done | dead) < len(workers):
+            try:
+                gpu_id, n_finished, n_cases, result, cost = result_queue.get(timeout=30)
+            except queue.Empty:
+                for gpu_id, worker in zip(gpus, workers):
+                    if gpu_id not in done and gpu_id not in dead and not worker.is_alive():
+                        print('Worker %s exited unexpectedly (exitcode %s), its unfinished cases are left to --resume.'
+                              % (gpu_id, worker.exitcode))
+                        dead.add(gpu_id)
+                continue
+
+            if result is None:
+                done.add(gpu_id)
+                continue
+
+            if stage == 'gen':
+                manifest.update(result)
+            else:
+                records.extend(result)
+                stats[gpu_id][2] += len(result)
+            n_failed += n_cases - n_finished
+            stats[gpu_id][0] += n_finished
+            stats[gpu_id][1] += cost
+            pbar.update(n_cases)
+            pbar.set_postfix({gpu_id: '%.3f case/s' % (n / t) for gpu_id, (n, t, _) in stats.items() if t > 0})
+        pbar.close()
+
+        print('Throughput of the %s stage (%d failed cases):' % (stage, n_failed))
+        for gpu_id, (n, t, n_QAs) in stats.items():
+            print('  worker %s: %d cases in %.1fs, %.3f case/s' % (gpu_id, n, t, n / t if t > 0 else 0)
+                  + ('' if stage == 'gen' else ', %d QAs, %.2f QA/s' % (n_QAs, n_QAs / t if t > 0 else 0)))
+        throughput[stage] = {gpu_id: {'cases': n, 'seconds': round(t, 1)} if stage == 'gen' else
+                             {'cases': n, 'seconds': round(t, 1), 'QAs': n_QAs} for gpu_id, (n, t, n_QAs) in stats.items()}
+
+        # merge manifests of workers for the understanding stage
+        if stage == 'gen':
+            os.makedirs(save_path, exist_ok=True)
+            open(os.path.join(save_path, 'manifest.json'), 'w').write(json.dumps(manifest, indent=4))
+
+    for worker in workers:
+        worker.join()
+
+    if save_path != '':
+        os.makedirs(save_path, exist_ok=True)
+        open(os.path.join(save_path, 'throughput.json'), 'w').write(json.dumps(throughput, indent=4))
+
+    return manifest if phase == 'gen' else records
+
+
+def main(model_name, gpus='0', save_path='', uni_bench='uni_bench.json', extra_model='', phase='interleave', batch_cases=2, resume=False, score=False):
     """
     Conduct uni_eval.
     Support Unified models and Gen only models.
@@ -611,63 +1313,88 @@ def main(model_name, gpus='0', save_path='', uni_bench='uni_bench.json', extra_m
     - save_path: The dump path to save records and results, '' indicats no saving.
     - uni_bench: The path of uni_bench.json.
     - extra_model: A extra model providing to evaluate the understanding part of generation-only model.
+    - phase: 'interleave' generates and understands case by case.
+             'two_phase' generates images of all cases first, then understands all cases, each model loads once per phase.
+             'gen' only runs phase 1 and saves save_path/manifest.json, 'und' only runs phase 2 from the saved manifest.
+    - batch_cases: The number of cases a worker pulls at a time in batch eval.
+    - resume: Skip cases with complete records in the records store of save_path, and compute results from the merged store.
+    - score: Answer by the option probabilities of one forward pass (score_options() of the und model) instead of generation.
 
     Returns:
     - print results anf save records
     """
 
     uni_bench = json.load(open(uni_bench))
+
+    if resume and save_path == '':
+        print('Please set --save_path to resume from saved records!')
+        os._exit(0)
+
+    manifest = None
+    if phase != 'interleave':
+        if save_path == '':
+            print('Please set --save_path to keep generated images between phases!')
+            os._exit(0)
+        if phase == 'und':
+            manifest = json.load(open(os.path.join(save_path, 'manifest.json')))
     
+    # skip finished cases, or clear records stores of the previous run
+    todo = uni_bench
+    if resume:
+        done = load_records(save_path, uni_bench)
+        todo = [item for item in uni_bench if str(item['prompt_id']) not in done]
+        print('Resume from %s: %d cases finished, %d cases to run.' % (save_path, len(done), len(todo)))
+    elif save_path != '' and phase != 'gen' and os.path.isdir(os.path.join(save_path, 'records')):
+        for name in os.listdir(os.path.join(save_path, 'records')):
+            if name.endswith('.jsonl'):
+                os.remove(os.path.join(save_path, 'records', name))
+
     # split by _ for batch_test (valid input, e.g., 0; 0_1; 0,1_2,3)
     gpus = gpus.split('_')
     n_workers = len(gpus)
 
     # single worker eval
     if n_workers == 1:
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpus[0]
-        model = load_model(model_name)
-        seed_everything()
-        
-        # for Unified model
-        if extra_model == '':
-            uni_eval(model.generate, model.understand, uni_bench, save_path)
-        
-        # Gen-only eval
-        else:
-            model_ = load_model(extra_model)
-            # put in another gpu if there are multi-gpus (avoid out-of-memory)
-            model_.model.to('cuda:1' if ',' in gpus[0] else 'cuda:0')
-            uni_eval(model.generate, model_.understand, uni_bench, save_path)
-
-    # batch eval
+        if len(todo) > 0:
+            run_worker(model_name, todo, save_path, gpus[0], extra_model, phase, manifest,
+                       records_store(save_path, gpus[0]) if save_path != '' else '', score)
+        # results of all cases are already printed and saved without resuming
+        if phase == 'gen' or not resume:
+            return
+
+    # batch eval, cases are dispatched to persistent workers on demand
     else:
-        chunk_size = math.ceil(len(uni_bench) / n_workers)
-        chunks = []
-        for i in range(0, len(uni_bench), chunk_size):
-            chunks.append(uni_bench[i:i + chunk_size])
-
-        records = []
-        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
-            if extra_model == '':
-                futures = {
-                    executor.submit(process_chunk, model_name, chunk, save_path, gpu_id, ''): chunk
-                    for gpu_id, chunk in zip(gpus, chunks)}
-            else:
-                futures = {
-                    executor.submit(process_chunk, model_name, chunk, save_path, gpu_id, extra_model): chunk
-                    for gpu_id, chunk in zip(gpus, chunks)}
-
-            for future in concurrent.futures.as_completed(futures):
-                records.extend(future.result())
-        
-        print('\n\n\n!!!!!!!!!!!!!!!! The Final Batch Eval Results !!!!!!!!!!!!!!!!')
-        uniScores = statistics(records, uni_bench)
-        if save_path != '':
-            os.makedirs(save_path, exist_ok=True)
-            open(os.path.join(save_path, 'results.json'), 'w').write(json.dumps(uniScores, indent=4))
+        records = schedule(model_name, todo, save_path, gpus, extra_model, phase, manifest, batch_cases, score) if len(todo) > 0 else []
+        if phase == 'gen':
+            return
+
+    # compute results from the merged records store, so resumed runs include cases of previous runs
+    if save_path != '':
+        done = load_records(save_path, uni_bench)
+        records = [record for item in uni_bench if str(item['prompt_id']) in done for record in done[str(item['prompt_id'])]]
+        if len(done) < len(uni_bench):
+            print('%d cases are unfinished, rerun with --resume to complete them.' % (len(uni_bench) - len(done)))
+
+    print('\n\n\n!!!!!!!!!!!!!!!! The Final Batch Eval Results !!!!!!!!!!!!!!!!')
+    uniScores = statistics(records, uni_bench)
+    if save_path != '':
+        os.makedirs(save_path, exist_ok=True)
+        open(os.path.join(save_path, 'results.json'), 'w').write(json.dumps(uniScores, indent=4))
 
 
 if __name__ == '__main__': 
+    # python uni_eval.py rescore [SAVE_PATHS], compute results from saved runs without models
+    if len(sys.argv) > 1 and sys.argv[1] == 'rescore':
+        parser = argparse.ArgumentParser(description='UniEval rescore.', prog='uni_eval.py rescore')
+        parser.add_argument('save_paths', type=str, nargs='+', help='Save paths of runs, per-worker folders save_path_[GPU_ID] are included.')
+        parser.add_argument('--uni_bench', type=str, default='uni_bench.json', help="Path to uni_bench.json")
+        parser.add_argument('--reparse', action='store_true', help='Parse the saved raw replies again with check_answer().')
+        parser.add_argument('--workers', type=int, default=8, help='The number of processes to read records.')
+
+        args = parser.parse_args(sys.argv[2:])
+        rescore(args.save_paths, args.uni_bench, args.reparse, args.workers)
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description='UniEval.')
     
     parser.add_argument('model_name', type=str, help='Model name of Unified model')
@@ -675,7 +1402,13 @@ if __name__ == '__main__':
     parser.add_argument('--save_path', type=str, default='', help="The folder to save records and results, default don't save, just print results.")
     parser.add_argument('--uni_bench', type=str, default='uni_bench.json', help="Path to uni_bench.json")
     parser.add_argument('--extra_model', type=str, default='', help='The model name of extra understand model to eval Gen only model.')
+    parser.add_argument('--phase', type=str, default='interleave', choices=['interleave', 'two_phase', 'gen', 'und'],
+                        help="'two_phase' generates all images before understanding so each model loads once per phase; 'gen'/'und' run a single phase.")
+    parser.add_argument('--batch_cases', type=int, default=2, help='The number of cases a worker pulls at a time in batch eval.')
+    parser.add_argument('--resume', action='store_true', help='Skip cases with complete records in --save_path and merge results with them.')
+    parser.add_argument('--score_options', action='store_true', help='Answer by the option probabilities of one forward pass instead of generation.')
     
     args = parser.parse_args()
 
-    main(args.model_name, args.gpus, args.save_path, args.uni_bench, args.extra_model)
+    main(args.model_name, args.gpus, args.save_path, args.uni_bench, args.extra_model, args.phase, args.batch_cases, args.resume,
+         args.score_options)